@@ -0,0 +1,2141 @@
+from io import BytesIO
+import json
+import os
+import hashlib
+import time
+import urllib.parse
+import urllib.request
+import mimetypes
+import re
+import io
+import tempfile
+import shutil
+import importlib.util
+import random
+import wave
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+from tracing import trace_span, bind_trace_context
+from usage_ledger import update_usage_count, current_session_id
+from model_router import (
+    MODEL_PRIORITY_LIST, MODEL_CALL_TIMEOUT_SECONDS, ROUTER_MAX_WAIT_SECONDS, CircuitOpenError,
+    acquire_model, release_model, record_rate_limited, is_rate_limit_error, get_model_call_slots,
+    begin_model_call, end_circuit_probe, is_circuit_open, record_model_success, record_model_failure,
+)
+
+# ==========================================
+# 3. 系統提示詞
+# ==========================================
+SYSTEM_INSTRUCTION = """
+你是一位專業的行政秘書。請分析使用者提供的檔案（文件、錄音或圖片），並根據使用者的要求產出對應的 JSON 資料。
+請嚴格遵守以下規則：
+
+1. **Memo (指定格式)**：
+   若任務是 Memo，請回傳 JSON 包含以下欄位。
+   **重要：針對 'method', 'official', 'note' 等勾選欄位，請輸出「包含所有選項的完整字串」，並將判斷應勾選的項目符號改為「實心方塊 ■」，未選項目維持「空心方塊 □」。**
+   {
+       "time": "時間 (請完整填寫，如：113年12月25日 14:00)",
+       "location": "地點",
+       "method": "方式 (例如：'□電話 □活動 ■會議 □公文批示 □其他')",
+       "official": "長官 (例如：'■部長 □次長 □主任秘書 □立法委員 □其他：')",
+       "meeting_name": "會議名稱",
+       "chair": "主席",
+       "attendees": "出席人員",
+       "related_dept": "相關部會",
+       "guest_dept": "列席單位",
+       "conclusions": ["結論1 (請以條列式呈現)", "結論2"],
+       "action_items": ["辦理事項1 (請以條列式呈現)", "辦理事項2"],
+       "note": "附言 (例如：'□請回電話 □請惠處 ■請參酌 □其他')",
+       "filename_prefix": "建議檔名 (不含副檔名)"
+   }
+
+2. **簡易開會通知單 (指定格式)**：
+   若任務是開會通知，請回傳 JSON 包含以下欄位：
+   {
+       "date": "發文日期 (例如: 113年12月25日)",
+       "dept": "發文單位 (例如: 政策規劃組)",
+       "reason": "開會事由",
+       "full_time": "開會完整時間 (例如: 113年12月30日(星期二) 下午 4:00 - 5:00)",
+       "location": "地點",
+       "host": "主持人",
+       "attendees": "出席人員 (若無資訊填寫 '詳如簽到表')",
+       "note": "簡述/討論議題說明",
+       "agenda_table": [ ["時間1", "主題1", "備註1"], ["時間2", "主題2", "備註2"] ],
+       "filename_prefix": "建議檔名"
+   }
+
+3. **談參 (指定歸納邏輯)**：
+   若任務是談參，請回傳 JSON 包含以下三個主要區塊：
+   {
+       "title": "談參主題",
+       "background": ["背景說明點1", "背景說明點2"], 
+       "discussion_points": [
+           {"subtitle": "小標題 (5-10字)", "content": "詳細說明 (50-100字)"},
+           {"subtitle": "小標題 (5-10字)", "content": "詳細說明 (50-100字)"}
+       ],
+       "unit_opinion": "單位意見與立場說明 (請整合為一段完整的發言內容)",
+       "filename_prefix": "建議檔名"
+   }
+   **邏輯規則：**
+   - **背景說明**：請歸納 1-2 點背景資訊。
+   - **討論重點**：請提供 5-10 點。每點必須包含一個「5-10字的小標題」以及對應的內容。
+   - **單位意見**：請基於單位立場，提出具體的發言建議或立場聲明。
+
+4. **數據提取 (Excel)**：
+   請回傳一個 List，包含多個 Dictionary，每個 Dictionary 代表一行數據。
+
+5. **語言與翻譯強制規則**：
+   - **所有輸出內容必須為「繁體中文 (Traditional Chinese, Taiwan)」**。
+   - 若原始資料包含外文，請務必先將其**翻譯並潤飾**為通順的繁體中文。
+"""
+
+# ==========================================
+# 3-1. 🗄️ 分析結果快取 (內容定址)
+# ==========================================
+ANALYSIS_CACHE_DIR = "analysis_cache"
+ANALYSIS_CACHE_MAX_BYTES = 200 * 1024 * 1024   # 快取總容量上限 (超過時依最久未使用淘汰)
+ANALYSIS_CACHE_TTL_SECONDS = 7 * 24 * 3600     # 單筆快取有效期限
+SYSTEM_INSTRUCTION_VERSION = hashlib.sha256(SYSTEM_INSTRUCTION.encode("utf-8")).hexdigest()[:12]
+
+@st.cache_resource
+def get_analysis_cache_stats():
+    # 跨 rerun、跨使用者共用的命中統計
+    return {"hits": 0, "misses": 0, "evictions": 0}
+
+def compute_file_digests(file_list):
+    return [(f.name, hashlib.sha256(f.getvalue()).hexdigest()) for f in file_list]
+
+# preprocess：是否先壓縮圖片與錄音；開關不同送出的內容就不同，結果分開快取
+def compute_analysis_cache_key(file_digests, task_type, user_instruction, model_name, preprocess=True):
+    h = hashlib.sha256()
+    for field in (SYSTEM_INSTRUCTION_VERSION, model_name, task_type, user_instruction or "", "preprocess" if preprocess else "raw"):
+        h.update(field.encode("utf-8"))
+        h.update(b"\x00")
+    for file_name, digest in file_digests:
+        h.update(file_name.encode("utf-8"))
+        h.update(digest.encode("ascii"))
+    return h.hexdigest()
+
+def load_cached_analysis(cache_key):
+    path = os.path.join(ANALYSIS_CACHE_DIR, f"{cache_key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry.get("created", 0) > ANALYSIS_CACHE_TTL_SECONDS:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)  # 更新存取時間，作為 LRU 依據
+    except OSError:
+        pass
+    meta = entry.get("meta")
+    return set_meta_info(entry["result"], meta) if isinstance(meta, dict) else entry["result"]
+
+# 統計資訊與結果分開存放：數據提取的 List 結果無法夾帶 _meta_info，命中快取時再依結果型別掛回
+def save_cached_analysis(cache_key, result):
+    os.makedirs(ANALYSIS_CACHE_DIR, exist_ok=True)
+    path = os.path.join(ANALYSIS_CACHE_DIR, f"{cache_key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    meta = get_meta_info(result)
+    payload = {k: v for k, v in result.items() if k != "_meta_info"} if isinstance(result, dict) else list(result)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"created": time.time(), "result": payload, "meta": meta}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    evict_analysis_cache()
+
+def evict_analysis_cache():
+    entries = []
+    now = time.time()
+    stats = get_analysis_cache_stats()
+    for entry in os.scandir(ANALYSIS_CACHE_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            st_info = entry.stat()
+        except OSError:
+            continue
+        entries.append((st_info.st_mtime, st_info.st_size, entry.path))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if total_size <= ANALYSIS_CACHE_MAX_BYTES and now - mtime <= ANALYSIS_CACHE_TTL_SECONDS:
+            continue
+        try:
+            os.remove(path)
+            stats["evictions"] += 1
+        except OSError:
+            pass
+        total_size -= size
+
+# ==========================================
+# 3-2. 📤 Gemini File API 上傳代號重用
+# ==========================================
+FILE_API_THRESHOLD_BYTES = 4 * 1024 * 1024   # 超過此大小改走 File API，不再內嵌 bytes
+FILE_HANDLE_REGISTRY = "gemini_file_handles.json"
+FILE_HANDLE_SAFETY_SECONDS = 3600             # 到期前一小時即視為失效，避免呼叫途中過期
+FILE_API_ACTIVE_TIMEOUT = 300                 # 等待檔案處理完成 (PROCESSING -> ACTIVE) 的上限秒數
+# 設定後改以 HTTP 上傳至此端點 (例如本機替身伺服器)，回應格式比照 Gemini files.create
+FILE_API_UPLOAD_URL = os.environ.get("GEMINI_FILE_UPLOAD_URL", "")
+
+def load_file_handles():
+    if not os.path.exists(FILE_HANDLE_REGISTRY):
+        return {}
+    try:
+        with open(FILE_HANDLE_REGISTRY, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_file_handles(handles):
+    now = time.time()
+    handles = {k: v for k, v in handles.items() if v.get("expires_at", 0) > now}
+    tmp_path = f"{FILE_HANDLE_REGISTRY}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(handles, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, FILE_HANDLE_REGISTRY)
+
+def _file_handle_key(digest, api_key):
+    # 上傳的檔案只屬於該 API Key 的專案，因此代號需依 Key 區隔
+    return f"{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}:{digest}"
+
+def _parse_expiration(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if value:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    return time.time() + 47 * 3600  # File API 預設保存 48 小時
+
+def _upload_file_via_http(file_bytes, mime_type, display_name, api_key):
+    separator = "&" if "?" in FILE_API_UPLOAD_URL else "?"
+    request = urllib.request.Request(
+        f"{FILE_API_UPLOAD_URL}{separator}key={api_key}",
+        data=file_bytes,
+        method="POST",
+        headers={
+            "Content-Type": mime_type,
+            "X-Goog-Upload-Protocol": "raw",
+            "X-Goog-Upload-File-Name": urllib.parse.quote(display_name),
+        },
+    )
+    with urllib.request.urlopen(request, timeout=FILE_API_ACTIVE_TIMEOUT) as resp:
+        payload = json.load(resp)
+    file_info = payload.get("file", payload)
+    return {
+        "name": file_info["name"],
+        "uri": file_info["uri"],
+        "mime_type": file_info.get("mimeType", mime_type),
+        "expires_at": _parse_expiration(file_info.get("expirationTime")),
+    }
+
+def _upload_file_via_genai(file_bytes, mime_type, display_name):
+    import google.generativeai as genai
+    uploaded = genai.upload_file(byte_stream(file_bytes), mime_type=mime_type, display_name=display_name)
+    deadline = time.time() + FILE_API_ACTIVE_TIMEOUT
+    while uploaded.state.name == "PROCESSING":
+        if time.time() > deadline:
+            raise TimeoutError(f"{display_name} 處理逾時")
+        time.sleep(2)
+        uploaded = genai.get_file(uploaded.name)
+    if uploaded.state.name != "ACTIVE":
+        raise ValueError(f"{display_name} 上傳後狀態異常: {uploaded.state.name}")
+    return {
+        "name": uploaded.name,
+        "uri": uploaded.uri,
+        "mime_type": uploaded.mime_type,
+        "expires_at": _parse_expiration(uploaded.expiration_time),
+    }
+
+# 回傳 (content_part, 是否重用既有代號)；同一內容在到期前只上傳一次
+def get_file_part(file_bytes, digest, mime_type, display_name, api_key):
+    key = _file_handle_key(digest, api_key)
+    handles = load_file_handles()
+    handle = handles.get(key)
+    reused = bool(handle and handle["expires_at"] - FILE_HANDLE_SAFETY_SECONDS > time.time())
+    if not reused:
+        if FILE_API_UPLOAD_URL:
+            handle = _upload_file_via_http(file_bytes, mime_type, display_name, api_key)
+        else:
+            handle = _upload_file_via_genai(file_bytes, mime_type, display_name)
+        handles = load_file_handles()
+        handles[key] = handle
+        save_file_handles(handles)
+    return {"file_data": {"mime_type": handle["mime_type"], "file_uri": handle["uri"]}}, reused
+
+# ==========================================
+# 3-4. 📁 檔案包裝與記憶體預算 (批次模式與背景工作用)
+# ==========================================
+LOCAL_MIME_TYPES = {
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+    ".wav": "audio/wav",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+}
+
+# 每個請求留在記憶體中的檔案總量上限；單檔超過 UPLOAD_SPOOL_THRESHOLD_BYTES 或總量超出預算的檔案
+# 改寫入暫存檔並以 mmap 唯讀對應，getvalue() 回傳 memoryview，後續雜湊、擷取與上傳都直接讀取同一塊對應，不再複製
+UPLOAD_SPOOL_THRESHOLD_BYTES = int(os.environ.get("UPLOAD_SPOOL_MB", "8")) * 1024 * 1024
+REQUEST_MEMORY_BUDGET_BYTES = int(os.environ.get("REQUEST_MEMORY_BUDGET_MB", "64")) * 1024 * 1024
+UPLOAD_SPOOL_CHUNK_BYTES = 1024 * 1024
+
+def _map_readonly(f):
+    import mmap
+    return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+# 模擬 Streamlit UploadedFile 的最小介面 (name / type / size / getvalue)，讓批次流程共用分析函數
+class LocalFile:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        ext = os.path.splitext(self.name)[1].lower()
+        self.type = LOCAL_MIME_TYPES.get(ext) or mimetypes.guess_type(self.name)[0] or "application/octet-stream"
+        self.size = os.path.getsize(path)
+
+    def getvalue(self):
+        with open(self.path, "rb") as f:
+            if self.size > UPLOAD_SPOOL_THRESHOLD_BYTES:
+                return _map_readonly(f)
+            return f.read()
+
+# 背景工作用：上傳檔在 rerun 後即失效，提交時先保留內容
+class MemoryFile:
+    def __init__(self, name, mime_type, data):
+        self.name = name
+        self.type = mime_type
+        self.data = data
+        self.size = len(data)
+
+    def getvalue(self):
+        return self.data
+
+# 背景工作用：大型上傳檔逐塊寫入暫存檔 (已解除連結，行程結束或物件回收即消失)，排隊與分析期間不佔用常駐記憶體
+class SpooledFile:
+    def __init__(self, name, mime_type, source):
+        self.name = name
+        self.type = mime_type
+        with tempfile.TemporaryFile() as tmp:
+            source.seek(0)
+            shutil.copyfileobj(source, tmp, UPLOAD_SPOOL_CHUNK_BYTES)
+            tmp.flush()
+            self.size = tmp.tell()
+            self.view = _map_readonly(tmp)
+
+    def getvalue(self):
+        return self.view
+
+def spool_uploads(file_list):
+    files, in_memory = [], 0
+    for f in file_list:
+        size = f.size if getattr(f, "size", None) is not None else len(f.getvalue())
+        if size and (size > UPLOAD_SPOOL_THRESHOLD_BYTES or in_memory + size > REQUEST_MEMORY_BUDGET_BYTES) and hasattr(f, "seek"):
+            files.append(SpooledFile(f.name, f.type, f))
+        else:
+            files.append(MemoryFile(f.name, f.type, f.getvalue()))
+            in_memory += size
+    return files
+
+class BufferStream(io.RawIOBase):
+    # 唯讀、可 seek 的串流，直接讀取既有緩衝區 (bytes / mmap / memoryview)；每次 read 只複製所需的片段
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast("B")
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(min(len(b), len(self.view) - self.pos), 0)
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}[whence]
+        self.pos = max(base + offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+def byte_stream(file_bytes):
+    # 交給 python-docx / pypdf / PIL / wave 等讀取；bytes 放進 BytesIO 不會複製，mmap 的 memoryview 則改用 BufferStream
+    if isinstance(file_bytes, bytes):
+        return BytesIO(file_bytes)
+    return BufferStream(file_bytes)
+
+def _sdk_parts(content_parts):
+    # SDK 的內嵌資料欄位只接受 bytes：memoryview 在送出前才轉換 (僅小於 File API 門檻或上傳失敗的內嵌檔案)
+    return [
+        dict(part, data=bytes(part["data"])) if isinstance(part, dict) and isinstance(part.get("data"), memoryview) else part
+        for part in content_parts
+    ]
+
+# --- 每個請求的峰值 RSS：背景執行緒定期取樣整個行程的常駐記憶體 (同時進行的其他請求也會算入) ---
+RSS_SAMPLE_SECONDS = 0.05
+
+@st.cache_resource
+def get_memory_stats():
+    return {"lock": threading.Lock(), "requests": 0, "peak_rss_mb": 0.0, "max_delta_mb": 0.0}
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if importlib.util.find_spec("psutil") is not None:
+        import psutil
+        return psutil.Process().memory_info().rss
+    return None
+
+class RssSampler:
+    def __enter__(self):
+        self.start = self.peak = current_rss_bytes()
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.start is not None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, current_rss_bytes() or 0)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.peak = max(self.peak, current_rss_bytes() or 0)
+        return False
+
+    def report(self):
+        if self.start is None:
+            return None
+        mb = 1024 * 1024
+        report = {"start_mb": round(self.start / mb, 1), "peak_mb": round(self.peak / mb, 1), "delta_mb": round((self.peak - self.start) / mb, 1)}
+        stats = get_memory_stats()
+        with stats["lock"]:
+            stats["requests"] += 1
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], report["peak_mb"])
+            stats["max_delta_mb"] = max(stats["max_delta_mb"], report["delta_mb"])
+        return report
+
+# ==========================================
+# 3-5. 📡 串流輸出與增量 JSON 解析
+# ==========================================
+STREAM_POLL_SECONDS = 0.3   # 串流模式下，主執行緒更新預覽畫面的間隔
+
+class CallCancelled(Exception):
+    pass
+
+def _close_json(text):
+    # 掃描未完成的 JSON，補上未結束的字串與括號；回傳 (補齊後字串, 結構性逗號位置)
+    stack = []
+    commas = []
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+        elif ch == ",":
+            commas.append(i)
+    closed = text
+    if in_string:
+        closed += "\\" if escaped else ""
+        closed += '"'
+    closed = closed.rstrip()
+    if closed.endswith(","):
+        closed = closed[:-1]
+    return closed + "".join(reversed(stack)), commas
+
+def parse_partial_json(text):
+    # 盡量解析尚未完整的 JSON 前綴；不完整的鍵或常值會被退回到上一個逗號之前
+    text = text.strip()
+    if not text:
+        return None
+    candidate = text
+    for _ in range(8):
+        closed, commas = _close_json(candidate)
+        try:
+            return json.loads(closed)
+        except ValueError:
+            if not commas:
+                break
+            candidate = candidate[:commas[-1]]
+    for opener in ("{", "["):
+        if text.startswith(opener):
+            return {} if opener == "{" else []
+    return None
+
+def render_partial_result(placeholder, partial, model_name):
+    # 依欄位逐步呈現串流中的結果 (例如 discussion_points 一點一點出現)
+    lines = [f"**📡 {model_name} 即時輸出中...**"]
+    if isinstance(partial, dict):
+        for key, value in partial.items():
+            if key == "_meta_info":
+                continue
+            if isinstance(value, dict):
+                # 多重輸出：各份文件只顯示已產生的欄位
+                lines.append(f"- **{key}**：{'、'.join(value)}")
+            elif isinstance(value, list):
+                lines.append(f"- **{key}**：")
+                for item in value:
+                    if isinstance(item, dict):
+                        lines.append("    - " + "：".join(str(v) for v in item.values()))
+                    else:
+                        lines.append(f"    - {item}")
+            else:
+                lines.append(f"- **{key}**：{value}")
+    elif isinstance(partial, list):
+        lines.append(f"已擷取 {len(partial)} 筆資料")
+    placeholder.markdown("\n".join(lines))
+
+# ==========================================
+# 3-6. 🔌 LLM 後端 (可抽換；stub 供離線壓測)
+# ==========================================
+# LLM_BACKEND=stub 時不連網、不需 API Key，依任務類型回傳格式正確的假資料，
+# 延遲、錯誤率與 429 比例皆可由環境變數調整，用於量測吞吐、備援行為與端到端延遲
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "gemini")
+STUB_LATENCY_SECONDS = float(os.environ.get("STUB_LATENCY_SECONDS", "1.5"))    # 平均延遲
+STUB_LATENCY_JITTER = float(os.environ.get("STUB_LATENCY_JITTER", "0.5"))      # 延遲隨機浮動 (±秒)
+STUB_ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", "0"))                # 一般錯誤 (5xx) 機率
+STUB_RATE_LIMIT_RATE = float(os.environ.get("STUB_RATE_LIMIT_RATE", "0"))      # 429 機率
+STUB_RETRY_AFTER_SECONDS = float(os.environ.get("STUB_RETRY_AFTER_SECONDS", "2"))   # 429 回應建議的重試秒數
+STUB_TRUNCATE_RATE = float(os.environ.get("STUB_TRUNCATE_RATE", "0"))          # 回應在中途被截斷的機率 (測試 JSON 修復)
+STUB_FAILING_MODELS = [m for m in os.environ.get("STUB_FAILING_MODELS", "").split(",") if m]   # 一律失敗的模型 (測試備援)
+STUB_STREAM_CHUNKS = 8
+STUB_PREFILL_TOKENS_PER_SECOND = float(os.environ.get("STUB_PREFILL_TOKENS_PER_SECOND", "0"))   # 依未快取的輸入量加計延遲 (0 為不模擬)
+STUB_EXCEL_ROWS = int(os.environ.get("STUB_EXCEL_ROWS", "20"))
+
+class RateLimitError(Exception):
+    code = 429
+
+class LLMReply:
+    # chunks：文字片段 (非串流時只有一段)；讀完後呼叫 usage() 取得 (input, output, total, cached) tokens，無資訊時為 None
+    # input 含 cached (由 context cache 提供、未重送的部分)
+    def __init__(self, chunks, usage):
+        self.chunks = chunks
+        self.usage = usage
+
+class GeminiBackend:
+    name = "gemini"
+    billable = True           # 計入用量帳本並寫入分析快取
+    supports_file_api = True
+    supports_context_cache = True
+
+    def __init__(self):
+        # 本行程建立或延長過的 CachedContent，呼叫時直接交給 from_cached_content，省去一次 CachedContent.get
+        self.cached_contents = {}
+
+    def configure(self, api_key):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+
+    def create_context_cache(self, model_name, content_parts, ttl_seconds):
+        from google.generativeai import caching
+        cache = caching.CachedContent.create(
+            model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+            system_instruction=SYSTEM_INSTRUCTION,
+            contents=[{"role": "user", "parts": _sdk_parts(content_parts)}],
+            ttl=timedelta(seconds=ttl_seconds),
+        )
+        self.cached_contents[cache.name] = cache
+        return {"name": cache.name, "expires_at": _parse_expiration(cache.expire_time), "tokens": cache.usage_metadata.total_token_count}
+
+    def extend_context_cache(self, name, ttl_seconds):
+        from google.generativeai import caching
+        cache = caching.CachedContent.get(name)
+        cache.update(ttl=timedelta(seconds=ttl_seconds))
+        self.cached_contents[name] = cache
+        return _parse_expiration(cache.expire_time)
+
+    def generate(self, model_name, content_parts, generation_config, stream=False, task_type=None, cached_content=None):
+        import google.generativeai as genai
+        if cached_content:
+            # 系統提示已在快取內；重新啟動後才沿用的快取只有名稱，由 SDK 取回一次
+            model = genai.GenerativeModel.from_cached_content(
+                self.cached_contents.get(cached_content, cached_content), generation_config=generation_config
+            )
+        else:
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                system_instruction=SYSTEM_INSTRUCTION
+            )
+        response = model.generate_content(_sdk_parts(content_parts), stream=stream, request_options={"timeout": MODEL_CALL_TIMEOUT_SECONDS})
+
+        def usage():
+            if not hasattr(response, 'usage_metadata'):
+                return None
+            meta = response.usage_metadata
+            return meta.prompt_token_count, meta.candidates_token_count, meta.total_token_count, getattr(meta, "cached_content_token_count", 0) or 0
+
+        chunks = (chunk.text for chunk in response) if stream else iter([response.text])
+        return LLMReply(chunks, usage)
+
+class StubBackend:
+    name = "stub"
+    billable = False
+    supports_file_api = False
+    supports_context_cache = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rng = random.Random(os.environ.get("STUB_SEED"))
+        self.calls = 0
+        self.contexts = {}
+
+    def configure(self, api_key):
+        pass
+
+    def create_context_cache(self, model_name, content_parts, ttl_seconds):
+        tokens = estimate_request_tokens(content_parts)
+        if STUB_PREFILL_TOKENS_PER_SECOND:
+            time.sleep(tokens / STUB_PREFILL_TOKENS_PER_SECOND)
+        with self.lock:
+            name = f"cachedContents/stub-{len(self.contexts):06d}"
+            self.contexts[name] = tokens
+        return {"name": name, "expires_at": time.time() + ttl_seconds, "tokens": tokens}
+
+    def extend_context_cache(self, name, ttl_seconds):
+        return time.time() + ttl_seconds
+
+    def _draw(self):
+        with self.lock:
+            self.calls += 1
+            return self.rng.random(), self.rng.uniform(-STUB_LATENCY_JITTER, STUB_LATENCY_JITTER), self.rng.getrandbits(32)
+
+    def generate(self, model_name, content_parts, generation_config, stream=False, task_type=None, cached_content=None):
+        roll, jitter, seed = self._draw()
+        latency = max(STUB_LATENCY_SECONDS + jitter, 0.0)
+        uncached_tokens = estimate_request_tokens(content_parts)
+        if STUB_PREFILL_TOKENS_PER_SECOND:
+            latency += uncached_tokens / STUB_PREFILL_TOKENS_PER_SECOND
+        if model_name in STUB_FAILING_MODELS or roll < STUB_ERROR_RATE:
+            time.sleep(latency / 2)
+            raise RuntimeError(f"500 Internal error (stub: {model_name})")
+        if roll < STUB_ERROR_RATE + STUB_RATE_LIMIT_RATE:
+            time.sleep(0.05)
+            raise RateLimitError(f"429 Resource has been exhausted (stub: {model_name}). Please retry in {STUB_RETRY_AFTER_SECONDS:g}s.")
+
+        text = json.dumps(stub_payload(task_type, random.Random(seed)), ensure_ascii=False)
+        cut = random.Random(seed + 1)
+        if cut.random() < STUB_TRUNCATE_RATE:
+            text = text[:int(len(text) * cut.uniform(0.3, 0.9))]
+        cached_tokens = self.contexts.get(cached_content, 0)
+        input_tokens = uncached_tokens + cached_tokens
+        output_tokens = estimate_text_tokens(text)
+
+        def chunks():
+            pieces = STUB_STREAM_CHUNKS if stream else 1
+            step = -(-len(text) // pieces)
+            for i in range(0, len(text), step):
+                time.sleep(latency / pieces)
+                yield text[i:i + step]
+
+        return LLMReply(chunks(), lambda: (input_tokens, output_tokens, input_tokens + output_tokens, cached_tokens))
+
+LLM_BACKENDS = {"gemini": GeminiBackend, "stub": StubBackend}
+
+@st.cache_resource
+def get_llm_backend():
+    if LLM_BACKEND not in LLM_BACKENDS:
+        raise ValueError(f"未知的 LLM_BACKEND：{LLM_BACKEND} (可用：{', '.join(LLM_BACKENDS)})")
+    return LLM_BACKENDS[LLM_BACKEND]()
+
+# 依 SYSTEM_INSTRUCTION 的格式產生假資料
+def stub_payload(task_type, rng):
+    outputs = parse_multi_output_task(task_type)
+    if outputs:
+        return {MULTI_OUTPUT_TASKS[task]: stub_payload(task, rng) for task in outputs}
+
+    def text(n):
+        return "".join(rng.choice("會議討論決議辦理事項單位意見背景說明預算計畫審查進度報告") for _ in range(n))
+
+    if task_type == "Memo (指定格式)":
+        return {
+            "time": "113年12月25日 14:00", "location": text(5), "method": "□電話 □活動 ■會議 □公文批示 □其他",
+            "official": "■部長 □次長 □主任秘書 □立法委員 □其他：", "meeting_name": text(10), "chair": text(3),
+            "attendees": text(20), "related_dept": text(6), "guest_dept": text(6),
+            "conclusions": [text(40) for _ in range(rng.randint(2, 5))],
+            "action_items": [text(30) for _ in range(rng.randint(1, 4))],
+            "note": "□請回電話 □請惠處 ■請參酌 □其他", "filename_prefix": "Stub_Memo",
+        }
+    if task_type == "簡易開會通知單 (指定格式)":
+        return {
+            "date": "113年12月25日", "dept": text(5), "reason": text(15),
+            "full_time": "113年12月30日(星期二) 下午 4:00 - 5:00", "location": text(5), "host": text(3),
+            "attendees": "詳如簽到表", "note": text(60),
+            "agenda_table": [[f"{16 + i // 4}:{(i % 4) * 15:02d}", text(10), text(4)] for i in range(rng.randint(2, 6))],
+            "filename_prefix": "Stub_Notice",
+        }
+    if task_type == "談參":
+        return {
+            "title": text(10), "background": [text(50) for _ in range(2)],
+            "discussion_points": [{"subtitle": text(rng.randint(5, 10)), "content": text(rng.randint(50, 100))} for _ in range(rng.randint(5, 10))],
+            "unit_opinion": text(150), "filename_prefix": "Stub_TalkingPoints",
+        }
+    if task_type == "數據提取 (Excel)":
+        return [{"項目": text(6), "數量": rng.randint(1, 500), "金額": round(rng.uniform(0, 1e5), 2), "備註": text(8)} for _ in range(STUB_EXCEL_ROWS)]
+    return {"title": text(10), "summary": text(200), "decisions": [text(40) for _ in range(3)], "filename_prefix": "Stub_Minutes"}
+
+# ==========================================
+# 3-8. 🧾 多重輸出 (一次分析產出多份文件)
+# ==========================================
+# 同一批資料常依序製作 Memo、開會通知單與談參；合併為一次請求，模型回傳以文件類型為鍵的組合 JSON，
+# 上傳、分析與額度只花一次，各份文件再由同一份結果分別套印。
+# 任務名稱編碼為「多重輸出：Memo (指定格式)＋談參」，分析快取、背景工作與批次流程皆沿用字串任務名稱
+MULTI_OUTPUT_TASKS = {
+    "Memo (指定格式)": "memo",
+    "簡易開會通知單 (指定格式)": "notice",
+    "談參": "talking_points",
+    "數據提取 (Excel)": "data_rows",
+}
+MULTI_OUTPUT_PREFIX = "多重輸出："
+MULTI_OUTPUT_SEPARATOR = "＋"
+
+def multi_output_task(outputs):
+    return MULTI_OUTPUT_PREFIX + MULTI_OUTPUT_SEPARATOR.join(t for t in MULTI_OUTPUT_TASKS if t in outputs)
+
+def parse_multi_output_task(task_type):
+    if not task_type or not task_type.startswith(MULTI_OUTPUT_PREFIX):
+        return None
+    outputs = [t for t in task_type[len(MULTI_OUTPUT_PREFIX):].split(MULTI_OUTPUT_SEPARATOR) if t in MULTI_OUTPUT_TASKS]
+    return outputs or None
+
+def multi_output_prompt(outputs):
+    lines = [f"本次請一次製作 {len(outputs)} 份文件，回傳「單一 JSON 物件」，各鍵的內容依系統提示中對應任務的格式："]
+    for task in outputs:
+        lines.append(f'- "{MULTI_OUTPUT_TASKS[task]}"：{task} 的 JSON' + (" (List)" if task == "數據提取 (Excel)" else ""))
+    lines.append("各份文件來自同一批資料，時間、地點、人員與單位等資訊請前後一致；不要輸出上述以外的鍵。")
+    return "\n".join(lines)
+
+# 拆出各份文件的結果：單一任務回傳 [(task, data)]；多重輸出依選取順序回傳模型實際有產出的部分
+def split_multi_output(result_data, task_type):
+    outputs = parse_multi_output_task(task_type)
+    if outputs is None:
+        return [(task_type, result_data)]
+    if not isinstance(result_data, dict):
+        return []
+    parts = []
+    for task in outputs:
+        # 模型偶爾以任務全名為鍵，一併接受
+        data = result_data.get(MULTI_OUTPUT_TASKS[task], result_data.get(task))
+        if data:
+            parts.append((task, data))
+    return parts
+
+# ==========================================
+# 3-9. 🧠 Context cache (系統提示 + 檔案的共用前綴)
+# ==========================================
+# 同一批資料常只改補充指令或任務就重新分析：把「系統提示 + 檔案內容」建立為伺服器端 context cache，
+# 之後的請求只送出任務與指令，快取部分不必重送、也不必重新處理。
+# 前綴依檔案順序逐份累計雜湊，新增檔案時沿用既有快取，只把新檔案接在請求中送出；
+# 新增部分本身也夠大時，才為完整前綴另建快取
+CONTEXT_CACHE_ENABLED = os.environ.get("CONTEXT_CACHE", "1") != "0"
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", "4096"))   # 模型可快取的最低量，亦為值得建立快取的門檻
+CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("CONTEXT_CACHE_TTL_SECONDS", "900"))  # 每次使用後延長；存放依時間計費，不宜過長
+CONTEXT_CACHE_SAFETY_SECONDS = 30          # 剩餘時間少於此視為失效，避免呼叫途中過期
+CONTEXT_CACHE_RETRY_SECONDS = 600          # 建立失敗 (如模型不支援) 後暫停嘗試的時間
+CONTEXT_CACHE_REGISTRY = "gemini_context_caches.json"
+
+@st.cache_resource
+def get_context_cache_state():
+    # entries 只在計費後端時寫入檔案 (快取存在於伺服器端，重新啟動後仍可沿用)；模擬後端只存於記憶體
+    entries = {}
+    if os.path.exists(CONTEXT_CACHE_REGISTRY):
+        try:
+            with open(CONTEXT_CACHE_REGISTRY, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+    return {"lock": threading.Lock(), "entries": entries, "disabled_until": {}, "hits": 0, "creates": 0}
+
+def _save_context_caches(state):
+    now = time.time()
+    entries = {k: v for k, v in state["entries"].items() if v["expires_at"] > now and v.get("persist")}
+    tmp_path = f"{CONTEXT_CACHE_REGISTRY}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, CONTEXT_CACHE_REGISTRY)
+
+def _part_fingerprint(part):
+    if isinstance(part, str):
+        return part.encode("utf-8")
+    if isinstance(part, dict) and "data" in part:
+        return f"{part.get('mime_type')}:{hashlib.sha256(part['data']).hexdigest()}".encode("utf-8")
+    if isinstance(part, dict) and "file_data" in part:
+        return part["file_data"]["file_uri"].encode("utf-8")
+    return repr(part).encode("utf-8")
+
+# 請求需以檔案開頭 (_build_request(files_first=True))；spans[i] 為前 i+1 份檔案的結尾位置、累計雜湊與 token 數
+def plan_context_prefix(groups, api_key, backend):
+    h = hashlib.sha256(SYSTEM_INSTRUCTION_VERSION.encode("utf-8"))
+    spans = []
+    end = tokens = 0
+    for g in groups:
+        for part in g["parts"]:
+            h.update(_part_fingerprint(part))
+            h.update(b"\0")
+        end += len(g["parts"])
+        tokens += g["tokens"]
+        spans.append({"end": end, "hash": h.hexdigest(), "tokens": tokens})
+    owner = f"{backend.name}:{hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]}"
+    return {"owner": owner, "spans": spans}
+
+# 回傳 {"name", "end", "tokens", "created", "create_ms"}：請求中 content_parts[:end] 改由快取提供；
+# 無可用快取時回傳 None，建立失敗且無舊快取可用時 name 為 None 並附上 error
+def resolve_context_cache(backend, model_name, context, content_parts):
+    state = get_context_cache_state()
+    now = time.time()
+    full = context["spans"][-1]
+    with state["lock"]:
+        if state["disabled_until"].get(model_name, 0) > now:
+            return None
+        best = entry = None
+        for span in reversed(context["spans"]):
+            entry = state["entries"].get(f"{context['owner']}:{model_name}:{span['hash']}")
+            if entry and entry["expires_at"] - CONTEXT_CACHE_SAFETY_SECONDS > now:
+                best = span
+                break
+
+    # 沒有可用前綴，或新增的檔案本身也達門檻時，為完整前綴建立快取；否則沿用既有前綴、新增部分照常送出
+    tail_tokens = full["tokens"] - (best["tokens"] if best else 0)
+    if best is not full and full["tokens"] >= CONTEXT_CACHE_MIN_TOKENS and (best is None or tail_tokens >= CONTEXT_CACHE_MIN_TOKENS):
+        started = time.perf_counter()
+        try:
+            with trace_span("context_cache.create", model=model_name, tokens=full["tokens"]):
+                created = backend.create_context_cache(model_name, content_parts[:full["end"]], CONTEXT_CACHE_TTL_SECONDS)
+        except Exception as e:
+            with state["lock"]:
+                state["disabled_until"][model_name] = time.time() + CONTEXT_CACHE_RETRY_SECONDS
+            if best is None:
+                return {"name": None, "end": 0, "tokens": 0, "created": False, "create_ms": 0, "error": str(e)}
+        else:
+            created["persist"] = backend.billable
+            with state["lock"]:
+                state["entries"][f"{context['owner']}:{model_name}:{full['hash']}"] = created
+                state["creates"] += 1
+                if backend.billable:
+                    _save_context_caches(state)
+            return {"name": created["name"], "end": full["end"], "tokens": created["tokens"], "created": True,
+                    "create_ms": round((time.perf_counter() - started) * 1000)}
+    if best is None:
+        return None
+
+    if entry["expires_at"] - now < CONTEXT_CACHE_TTL_SECONDS / 2:
+        try:
+            expires_at = backend.extend_context_cache(entry["name"], CONTEXT_CACHE_TTL_SECONDS)
+        except Exception:
+            expires_at = entry["expires_at"]
+        with state["lock"]:
+            entry["expires_at"] = expires_at
+            if backend.billable:
+                _save_context_caches(state)
+    with state["lock"]:
+        state["hits"] += 1
+    return {"name": entry["name"], "end": best["end"], "tokens": entry["tokens"], "created": False, "create_ms": 0}
+
+def forget_context_cache(name):
+    # 伺服器端快取已失效 (過期或遭刪除) 時移除登記，下次重新建立
+    state = get_context_cache_state()
+    backend = get_llm_backend()
+    with state["lock"]:
+        for key in [k for k, v in state["entries"].items() if v["name"] == name]:
+            del state["entries"][key]
+        getattr(backend, "cached_contents", {}).pop(name, None)
+        if backend.billable:
+            _save_context_caches(state)
+
+# ==========================================
+# 3-10. 📐 回應格式 (Response schema) 與 JSON 修復
+# ==========================================
+# SYSTEM_INSTRUCTION 中各任務的 JSON 格式，以 response_schema 傳給模型，從源頭約束輸出。
+# 回應仍無法解析時 (多半是輸出被截斷)，先在本機救回可用的部分，只請同一模型續寫缺少的欄位
+# (List 則從最後一筆之後繼續)，不再整份丟棄、改由下一個模型從頭重來；其餘缺漏欄位補上預設值
+JSON_CONTINUATION_MAX_ROUNDS = 2   # List 續寫可能再次被截斷，最多續寫幾輪
+
+_STRING = {"type": "string"}
+_STRING_LIST = {"type": "array", "items": _STRING}
+
+def _json_object(fields):
+    return {"type": "object", "properties": fields, "required": list(fields)}
+
+TASK_RESPONSE_SCHEMAS = {
+    "Memo (指定格式)": _json_object({
+        "time": _STRING, "location": _STRING, "method": _STRING, "official": _STRING,
+        "meeting_name": _STRING, "chair": _STRING, "attendees": _STRING, "related_dept": _STRING,
+        "guest_dept": _STRING, "conclusions": _STRING_LIST, "action_items": _STRING_LIST,
+        "note": _STRING, "filename_prefix": _STRING,
+    }),
+    "簡易開會通知單 (指定格式)": _json_object({
+        "date": _STRING, "dept": _STRING, "reason": _STRING, "full_time": _STRING, "location": _STRING,
+        "host": _STRING, "attendees": _STRING, "note": _STRING,
+        "agenda_table": {"type": "array", "items": _STRING_LIST},
+        "filename_prefix": _STRING,
+    }),
+    "談參": _json_object({
+        "title": _STRING, "background": _STRING_LIST,
+        "discussion_points": {"type": "array", "items": _json_object({"subtitle": _STRING, "content": _STRING})},
+        "unit_opinion": _STRING, "filename_prefix": _STRING,
+    }),
+    # 欄位由資料決定，只能約束為「物件的 List」；Gemini 的 schema 不接受沒有 properties 的物件，故只用於本機驗證
+    "數據提取 (Excel)": {"type": "array", "items": {"type": "object"}},
+}
+
+@st.cache_resource
+def get_json_repair_stats():
+    # repaired：無法直接解析但已救回的回應 (即省下的重新生成次數)；failed：救不回、交由備援模型重來
+    return {"lock": threading.Lock(), "repaired": 0, "continuations": 0, "defaults": 0, "failed": 0}
+
+def _record_json_repair(**counts):
+    stats = get_json_repair_stats()
+    with stats["lock"]:
+        for key, value in counts.items():
+            stats[key] += value
+
+def get_task_schema(task_type):
+    outputs = parse_multi_output_task(task_type)
+    if outputs:
+        return _json_object({MULTI_OUTPUT_TASKS[t]: TASK_RESPONSE_SCHEMAS[t] for t in outputs})
+    return TASK_RESPONSE_SCHEMAS.get(task_type)
+
+def _api_schema_supported(schema):
+    if schema.get("type") == "object" and not schema.get("properties"):
+        return False
+    children = list(schema.get("properties", {}).values())
+    if "items" in schema:
+        children.append(schema["items"])
+    return all(_api_schema_supported(child) for child in children)
+
+# 可傳給模型的 response_schema；含無法表達的格式 (如數據提取) 時回傳 None，僅指定 JSON 輸出
+def get_response_schema(task_type):
+    schema = get_task_schema(task_type)
+    return schema if schema is not None and _api_schema_supported(schema) else None
+
+def _schema_default(schema):
+    return {"object": {}, "array": []}.get(schema.get("type"), "")
+
+# 依 schema 修正型別並補齊必要欄位 (依 schema 的欄位順序輸出，額外欄位保留於後)；defaulted 收集補預設值的欄位路徑
+def conform_to_schema(value, schema, defaulted, path=""):
+    kind = schema.get("type")
+    if kind == "object":
+        if isinstance(value, list) and len(value) == 1 and isinstance(value[0], dict):
+            value = value[0]
+        if not isinstance(value, dict):
+            defaulted.append(path or "$")
+            # 物件位置只給了文字 (如討論重點只有一句話)：保留為最後一個文字欄位 (content) 的內容
+            text_fields = [k for k, sub in schema.get("properties", {}).items() if sub.get("type") == "string"]
+            value = {text_fields[-1]: value} if isinstance(value, str) and value and text_fields else {}
+        properties = schema.get("properties")
+        if not properties:
+            return value
+        result = {}
+        for key, sub_schema in properties.items():
+            sub_path = f"{path}.{key}" if path else key
+            if value.get(key) is not None:
+                result[key] = conform_to_schema(value[key], sub_schema, defaulted, sub_path)
+            elif key in schema.get("required", ()):
+                defaulted.append(sub_path)
+                result[key] = _schema_default(sub_schema)
+        for key, item in value.items():
+            result.setdefault(key, item)
+        return result
+    if kind == "array":
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            value = [value]
+        items = schema.get("items")
+        if not items:
+            return value
+        return [conform_to_schema(item, items, defaulted, f"{path}[{i}]") for i, item in enumerate(value)]
+    if kind == "string" and not isinstance(value, str):
+        if value is None:
+            return ""
+        if isinstance(value, list):
+            return "、".join(v if isinstance(v, str) else json.dumps(v, ensure_ascii=False) for v in value)
+        if isinstance(value, dict):
+            return json.dumps(value, ensure_ascii=False)
+        return str(value)
+    return value
+
+# 多重輸出只檢查模型有產出的文件，缺少的整份交由 split_multi_output 回報，不以空白文件補上
+def validate_result(result, task_type):
+    defaulted = []
+    outputs = parse_multi_output_task(task_type)
+    if outputs:
+        if isinstance(result, dict):
+            for task in outputs:
+                key = MULTI_OUTPUT_TASKS[task]
+                if result.get(key) is not None:
+                    result[key] = conform_to_schema(result[key], TASK_RESPONSE_SCHEMAS[task], defaulted, key)
+        return result, defaulted
+    schema = TASK_RESPONSE_SCHEMAS.get(task_type)
+    if schema is None:
+        return result, defaulted
+    return conform_to_schema(result, schema, defaulted), defaulted
+
+# 回傳 (結果, 是否被截斷)；完全無法解析時結果為 None
+def repair_json_text(text):
+    cleaned = text.strip()
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*(?:```)?$", cleaned, re.S)
+    if fenced:
+        cleaned = fenced.group(1)
+    starts = [i for i in (cleaned.find("{"), cleaned.find("[")) if i >= 0]
+    if not starts:
+        return None, False
+    cleaned = cleaned[min(starts):]
+    try:
+        return json.JSONDecoder().raw_decode(cleaned)[0], False   # 容許結尾多出的說明文字
+    except ValueError:
+        pass
+    try:
+        return json.loads(re.sub(r",\s*([}\]])", r"\1", cleaned)), False   # 多餘的結尾逗號
+    except ValueError:
+        pass
+    partial = parse_partial_json(cleaned)
+    return (partial, True) if partial else (None, False)
+
+def _continuation_request(task_type, partial):
+    # 回傳 (續寫提示, 續寫的 response_schema, 合併函式)；已無可續寫的部分時回傳 None
+    schema = get_task_schema(task_type)
+    if isinstance(partial, list):
+        # 最後一筆可能只輸出一半，捨棄後從該筆重新續寫
+        kept = partial[:-1]
+        if not kept:
+            return None
+        prompt = (
+            f"你先前輸出的 JSON List 在途中被截斷，已完整輸出 {len(kept)} 筆，最後一筆為：{json.dumps(kept[-1], ensure_ascii=False)}。"
+            "請從下一筆開始，輸出其餘尚未輸出的資料：格式相同的 JSON List，不要重複已輸出的資料。"
+        )
+        return prompt, get_response_schema(task_type), lambda more: kept + (more if isinstance(more, list) else [])
+    if not isinstance(partial, dict) or not partial:
+        return None
+    required = list(schema["properties"]) if schema else []
+    # 截斷處的欄位 (最後一個鍵) 內容不完整，與未輸出的欄位一併續寫
+    missing = list(dict.fromkeys([k for k in required if k not in partial] + list(partial)[-1:]))
+    kept = {k: v for k, v in partial.items() if k not in missing}
+    if not kept:
+        return None
+    prompt = (
+        f"你先前的 JSON 回覆在輸出途中被截斷。已完成的欄位如下 (請勿重複輸出)：{json.dumps(kept, ensure_ascii=False)}\n"
+        f"請只輸出缺少的欄位：{', '.join(missing)}，回傳只含這些欄位的 JSON 物件，各欄位格式與原任務相同。"
+    )
+    sub_schema = None
+    if schema and _api_schema_supported(schema) and any(k in schema["properties"] for k in missing):
+        sub_schema = _json_object({k: schema["properties"][k] for k in missing if k in schema["properties"]})
+    return prompt, sub_schema, lambda more: {**kept, **{k: v for k, v in (more if isinstance(more, dict) else {}).items() if k in missing}}
+
+# ==========================================
+# 4. Gemini API 分析函數
+# ==========================================
+# 分析結果的統計資訊：dict 結果放在 "_meta_info" 鍵；數據提取回傳 List，改以帶 meta_info 屬性的 ResultRows 承載
+class ResultRows(list):
+    meta_info = None
+
+def get_meta_info(result):
+    meta = result.get("_meta_info") if isinstance(result, dict) else getattr(result, "meta_info", None)
+    return meta if isinstance(meta, dict) else None
+
+def set_meta_info(result, meta):
+    if isinstance(result, dict):
+        result["_meta_info"] = meta
+    elif isinstance(result, list):
+        result = result if isinstance(result, ResultRows) else ResultRows(result)
+        result.meta_info = meta
+    return result
+
+def pop_meta_info(result):
+    if isinstance(result, dict):
+        return result.pop("_meta_info", None)
+    meta = getattr(result, "meta_info", None)
+    if isinstance(result, ResultRows):
+        result.meta_info = None
+    return meta
+
+# 在工作執行緒中執行，不可呼叫 Streamlit 元件；用量與斷路器狀態在此記錄，
+# 因此被取消但仍完成的併發呼叫也會如實計入額度；尚未送出就被取消的呼叫則退還每日次數
+# context：plan_context_prefix() 的結果；有值時請求開頭的檔案改由 context cache 提供
+# on_partial：串流模式下逐一收到原始文字片段 (不在此解析，由派送迴圈每次輪詢解析一次)
+def _call_model(model_name, content_parts, generation_config, task_type=None, session_id=None, on_partial=None, cancel_event=None, context=None):
+    backend = get_llm_backend()
+    started = time.perf_counter()
+    first_token_ms = None
+    cache_info = None
+    probe = begin_model_call(model_name)
+    try:
+        with get_model_call_slots(), trace_span("model.call", model=model_name, backend=backend.name, streamed=on_partial is not None) as span:
+            if cancel_event is not None and cancel_event.is_set():
+                release_model(model_name)
+                raise CallCancelled(f"{model_name} 已取消 (尚未送出)")
+            if context is not None and backend.supports_context_cache:
+                cache_info = resolve_context_cache(backend, model_name, context, content_parts)
+            cached_name = cache_info["name"] if cache_info else None
+            request_parts = content_parts[cache_info["end"]:] if cached_name else content_parts
+            try:
+                reply = backend.generate(
+                    model_name, request_parts, generation_config,
+                    stream=on_partial is not None, task_type=task_type, cached_content=cached_name
+                )
+            except Exception as e:
+                if not cached_name or is_rate_limit_error(e):
+                    raise
+                # 伺服器端快取已失效 (過期或遭刪除)：移除登記，改送完整內容
+                forget_context_cache(cached_name)
+                cache_info = dict(cache_info, name=None, error=str(e))
+                cached_name, request_parts = None, content_parts
+                reply = backend.generate(model_name, content_parts, generation_config, stream=on_partial is not None, task_type=task_type)
+            span.set(context_cache=bool(cache_info and cache_info["name"]))
+            if on_partial is None:
+                response_text = "".join(reply.chunks)
+            else:
+                # 串流模式：邊收邊交出片段，被取消時停止讀取剩餘內容
+                chunks = []
+                for chunk in reply.chunks:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise CallCancelled(f"{model_name} 已取消")
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - started) * 1000
+                    chunks.append(chunk)
+                    on_partial(chunk)
+                response_text = "".join(chunks)
+            span.set(ttft_ms=first_token_ms, response_chars=len(response_text))
+
+        if not response_text:
+            raise ValueError("API 回傳空值")
+
+        truncated = False
+        with trace_span("model.json_parse", model=model_name, chars=len(response_text)) as parse_span:
+            try:
+                json_result = json.loads(response_text)
+                repair = None
+            except ValueError:
+                json_result, truncated = repair_json_text(response_text)
+                if json_result is None:
+                    _record_json_repair(failed=1)
+                    raise
+                repair = {"truncated": truncated, "continuations": 0}
+            parse_span.set(repaired=repair is not None, truncated=truncated)
+        # 已付費的回應被截斷：只請同一模型續寫缺少的部分
+        continuation_usages = []
+        if truncated:
+            json_result, continuation_usages = _continue_truncated(
+                backend, model_name, request_parts, generation_config, task_type, cached_name, json_result
+            )
+            repair["continuations"] = len(continuation_usages)
+        json_result, defaulted = validate_result(json_result, task_type)
+    except CallCancelled:
+        if probe:
+            end_circuit_probe(model_name)
+        raise
+    except Exception as e:
+        if is_rate_limit_error(e):
+            record_rate_limited(model_name, e)
+        record_model_failure(model_name)
+        raise
+    record_model_success(model_name)
+    if repair is not None:
+        _record_json_repair(repaired=1, continuations=repair["continuations"])
+    if defaulted:
+        _record_json_repair(defaults=1)
+
+    latency_ms = (time.perf_counter() - started) * 1000
+    usage = reply.usage()
+    if usage is not None:
+        input_t, output_t, total_t, cached_t = usage
+        if backend.billable:
+            update_usage_count(model_name, input_t, output_t, latency_ms, task_type, session_id)
+        for extra in filter(None, continuation_usages):
+            if backend.billable:
+                update_usage_count(model_name, extra[0], extra[1], None, task_type, session_id)
+            input_t, output_t, total_t, cached_t = (a + b for a, b in zip((input_t, output_t, total_t, cached_t), extra))
+        if isinstance(json_result, (dict, list)):
+            json_result = set_meta_info(json_result, {
+                "model": model_name,
+                "input_tokens": input_t,
+                "output_tokens": output_t,
+                "total_tokens": total_t,
+                "latency_ms": round(latency_ms),
+                "ttft_ms": round(first_token_ms) if first_token_ms is not None else None,
+                "streamed": on_partial is not None,
+                "backend": backend.name,
+                "cached_tokens": cached_t,
+            })
+            if cache_info:
+                get_meta_info(json_result)["context_cache"] = {k: v for k, v in cache_info.items() if k != "end"}
+            if repair is not None or defaulted:
+                get_meta_info(json_result)["json_repair"] = dict(repair or {"truncated": False, "continuations": 0}, repaired=repair is not None, defaults=defaulted[:20])
+    return json_result
+
+# 回傳 (續寫合併後的結果, 各次續寫的 usage)；完全沒有可救回的內容時拋出例外，交由備援模型重來
+def _continue_truncated(backend, model_name, request_parts, generation_config, task_type, cached_name, partial):
+    usages = []
+    result = partial
+    for round_index in range(JSON_CONTINUATION_MAX_ROUNDS):
+        plan = _continuation_request(task_type, result)
+        if plan is None:
+            if round_index == 0:
+                raise ValueError("回應在輸出途中被截斷，且沒有可救回的內容")
+            break
+        prompt, schema, merge = plan
+        config = {k: v for k, v in generation_config.items() if k != "response_schema"}
+        if schema is not None:
+            config["response_schema"] = schema
+        with get_model_call_slots(), trace_span("model.continuation", model=model_name, round=round_index + 1):
+            reply = backend.generate(model_name, list(request_parts) + [prompt], config, task_type=task_type, cached_content=cached_name)
+            text = "".join(reply.chunks)
+        usages.append(reply.usage())
+        more, truncated = repair_json_text(text)
+        result = merge(more)
+        if not truncated:
+            return result, usages
+    # 續寫仍被截斷：List 捨棄可能不完整的最後一筆，其餘欄位由 validate_result 補上預設值
+    return (result[:-1] if isinstance(result, list) else result), usages
+
+def extract_docx_text(file_bytes):
+    from docx import Document
+    doc = Document(byte_stream(file_bytes))
+    full_text = []
+    for para in doc.paragraphs:
+        if para.text.strip():
+            full_text.append(para.text)
+    for table in doc.tables:
+        for row in table.rows:
+            row_text = [cell.text for cell in row.cells]
+            full_text.append(" | ".join(row_text))
+    return "\n".join(full_text)
+
+# --- 媒體前處理：照片縮圖重新編碼、WAV 轉單聲道語音取樣率並裁掉長靜音，降低上傳量與 token ---
+# 依任務類型選用設定；None 表示該任務不做前處理
+PREPROCESS_PROFILES = {
+    "default": {"image_max_side": 1600, "jpeg_quality": 80, "audio_rate": 16000, "trim_silence": True},
+    "數據提取 (Excel)": {"image_max_side": 2400, "jpeg_quality": 90, "audio_rate": 16000, "trim_silence": True},   # 表格小字需較高解析度
+    "會議紀錄": {"image_max_side": 1600, "jpeg_quality": 80, "audio_rate": 16000, "trim_silence": True},
+}
+IMAGE_PREPROCESS_MIN_BYTES = 300 * 1024   # 小於此大小且尺寸未超過上限的圖片不處理
+SILENCE_FRAME_SECONDS = 0.03
+SILENCE_RMS = 0.01                        # 以滿刻度為 1 的 RMS 門檻
+SILENCE_MIN_SECONDS = 2.0                 # 超過此長度的靜音才裁切
+SILENCE_KEEP_SECONDS = 0.5                # 裁切後保留的靜音長度
+WAV_BLOCK_SECONDS = 30                    # 分塊處理，長錄音不必整段載入為浮點陣列
+WAV_MIME_TYPES = ("audio/wav", "audio/x-wav", "audio/wave")
+
+def get_preprocess_profile(task_type):
+    # 多重輸出共用同一次上傳：取所選文件中最高的保真度 (例如含數據提取時保留表格小字的解析度)
+    outputs = parse_multi_output_task(task_type)
+    if outputs:
+        profiles = [get_preprocess_profile(task) for task in outputs]
+        return {
+            "image_max_side": max(p["image_max_side"] for p in profiles),
+            "jpeg_quality": max(p["jpeg_quality"] for p in profiles),
+            "audio_rate": max(p["audio_rate"] for p in profiles),
+            "trim_silence": all(p["trim_silence"] for p in profiles),
+        }
+    return PREPROCESS_PROFILES.get(task_type, PREPROCESS_PROFILES["default"])
+
+def _preprocess_image(file_bytes, mime_type, profile):
+    if importlib.util.find_spec("PIL") is None:
+        return None
+    from PIL import Image, ImageOps
+    with Image.open(byte_stream(file_bytes)) as image:
+        size = image.size
+        if len(file_bytes) < IMAGE_PREPROCESS_MIN_BYTES and max(size) <= profile["image_max_side"]:
+            return None
+        image = ImageOps.exif_transpose(image)   # 手機照片的旋轉資訊，重新編碼後會遺失
+        image.thumbnail((profile["image_max_side"], profile["image_max_side"]), Image.LANCZOS)
+        out = BytesIO()
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if has_alpha:
+            image.save(out, format="PNG", optimize=True)
+            new_mime = "image/png"
+        else:
+            image.convert("RGB").save(out, format="JPEG", quality=profile["jpeg_quality"], optimize=True)
+            new_mime = "image/jpeg"
+    if out.tell() >= len(file_bytes):
+        return None
+    return out.getvalue(), new_mime, f"{size[0]}x{size[1]} → {image.size[0]}x{image.size[1]}"
+
+def _wav_to_float(frames, sample_width, channels):
+    import numpy as np
+    if sample_width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    elif sample_width == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)
+        samples = ((raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16)) << 8 >> 8).astype(np.float32) / 8388608
+    else:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648
+    return samples.reshape(-1, channels).mean(axis=1)
+
+def _trim_silence(samples, rate):
+    import numpy as np
+    frame = max(int(rate * SILENCE_FRAME_SECONDS), 1)
+    usable = len(samples) - len(samples) % frame
+    if not usable:
+        return samples, 0.0
+    framed = samples[:usable].reshape(-1, frame)
+    rms = np.sqrt(np.einsum("ij,ij->i", framed, framed) / frame)   # 不建立整段平方後的暫存陣列
+    silent = rms < SILENCE_RMS
+    min_frames = int(SILENCE_MIN_SECONDS / SILENCE_FRAME_SECONDS)
+    keep_frames = int(SILENCE_KEEP_SECONDS / SILENCE_FRAME_SECONDS)
+    keep = np.ones(len(silent), dtype=bool)
+    # 找出連續靜音區段，只保留頭尾各一半的 SILENCE_KEEP_SECONDS
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.astype(np.int8), [0]))))
+    for start, end in zip(edges[::2], edges[1::2]):
+        if end - start >= min_frames:
+            keep[start + keep_frames // 2:end - keep_frames // 2] = False
+    if keep.all():
+        return samples, 0.0
+    trimmed = np.concatenate((framed[keep].ravel(), samples[usable:]))
+    return trimmed, (len(samples) - len(trimmed)) / rate
+
+def _preprocess_wav(file_bytes, profile):
+    if importlib.util.find_spec("numpy") is None:
+        return None
+    import numpy as np
+    target = profile["audio_rate"]
+    with wave.open(byte_stream(file_bytes)) as src:
+        channels, sample_width, rate, total = src.getnchannels(), src.getsampwidth(), src.getframerate(), src.getnframes()
+        if channels == 1 and rate <= target and sample_width == 2 and not profile["trim_silence"]:
+            return None
+        target = min(target, rate)
+        # 先以整數倍區塊平均降頻 (兼作簡易低通)，再線性內插到目標取樣率；分塊處理並維持全域時間軸連續
+        factor = max(rate // target, 1)
+        mid_rate = rate / factor
+        block = max(int(rate * WAV_BLOCK_SECONDS) // factor * factor, factor)
+        pieces, mid_offset, next_out = [], 0, 0
+        carry = prev = np.zeros(0, dtype=np.float32)
+        while True:
+            frames = src.readframes(block)
+            if not frames:
+                break
+            mono = np.concatenate((carry, _wav_to_float(frames, sample_width, channels)))
+            usable = len(mono) - len(mono) % factor
+            carry = mono[usable:]
+            mid = mono[:usable].reshape(-1, factor).mean(axis=1)
+            if not len(mid):
+                continue
+            last_out = int((mid_offset + len(mid) - 1) * target / mid_rate)
+            positions = np.arange(next_out, last_out + 1) * mid_rate / target
+            # 接上前一塊的最後一點，落在兩塊之間的輸出點才能內插而不是取到本塊第一點
+            xp = np.arange(mid_offset - len(prev), mid_offset + len(mid))
+            pieces.append(np.interp(positions, xp, np.concatenate((prev, mid))).astype(np.float32))
+            prev = mid[-1:]
+            mid_offset += len(mid)
+            next_out = last_out + 1
+    samples = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+    del pieces
+    trimmed_seconds = 0.0
+    if profile["trim_silence"]:
+        samples, trimmed_seconds = _trim_silence(samples, target)
+    out = BytesIO()
+    with wave.open(out, "wb") as dst:
+        dst.setnchannels(1)
+        dst.setsampwidth(2)
+        dst.setframerate(target)
+        # 分塊轉回 16-bit，避免整段音訊同時存在多份暫存陣列
+        step = max(int(target * WAV_BLOCK_SECONDS), 1)
+        for i in range(0, len(samples), step):
+            dst.writeframes((np.clip(samples[i:i + step], -1, 1) * 32767).astype("<i2").tobytes())
+    if out.tell() >= len(file_bytes):
+        return None
+    note = f"{channels}ch {rate / 1000:g} kHz → 1ch {target / 1000:g} kHz ({total / rate / 60:.1f} 分鐘)"
+    if trimmed_seconds >= 1:
+        note += f"，裁掉靜音 {trimmed_seconds:.0f} 秒"
+    return out.getvalue(), "audio/wav", note
+
+# 回傳 (bytes, mime_type, 說明)；不需處理或處理後未變小時回傳 None
+def preprocess_media(file_bytes, mime_type, profile):
+    if profile is None:
+        return None
+    if mime_type in ("image/png", "image/jpeg"):
+        return _preprocess_image(file_bytes, mime_type, profile)
+    if mime_type in WAV_MIME_TYPES:
+        return _preprocess_wav(file_bytes, profile)
+    return None
+
+# --- 本機文字擷取：文字型格式先轉為精簡的結構化文字，只有掃描頁或以圖片為主的投影片才附上原始內容 ---
+# 擷取函數回傳 {"text": 文字, "binary": [(bytes, mime_type, 標籤), ...]}；回傳 None 表示無法擷取，整份改以原檔傳送
+PDF_MIN_TEXT_CHARS = 40            # 單頁文字少於此數視為掃描頁，改以該頁 PDF 傳送
+PDF_MAX_SCANNED_RATIO = 0.5        # 掃描頁超過此比例時整份以原檔傳送
+PPTX_IMAGE_SLIDE_MAX_CHARS = 30    # 文字少於此數且含圖片的投影片，附上其圖片
+PPTX_MAX_IMAGES = 20
+TEXT_FILE_ENCODINGS = ("utf-8-sig", "utf-16", "cp950", "big5hkscs", "gb18030")
+
+def _docx_extractor(file_bytes):
+    return {"text": extract_docx_text(file_bytes), "binary": []}
+
+def _decode_text_file(file_bytes):
+    if file_bytes[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return str(file_bytes, "utf-16")
+    for encoding in TEXT_FILE_ENCODINGS:
+        if encoding == "utf-16":
+            continue
+        try:
+            return str(file_bytes, encoding)
+        except UnicodeDecodeError:
+            continue
+    return str(file_bytes, "utf-8", errors="ignore")
+
+def _txt_extractor(file_bytes):
+    # 去除行尾空白與連續空行，保留段落結構
+    raw_text = _decode_text_file(file_bytes)
+    lines = [line.rstrip() for line in raw_text.splitlines()]
+    return {"text": re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip(), "binary": [], "raw_tokens": estimate_text_tokens(raw_text)}
+
+def _pdf_extractor(file_bytes):
+    if importlib.util.find_spec("pypdf") is None:
+        return None   # 未安裝 pypdf (選用套件) 時以原檔傳送
+    from pypdf import PdfReader, PdfWriter
+    reader = PdfReader(byte_stream(file_bytes))
+    pages, scanned = [], []
+    for index, page in enumerate(reader.pages):
+        text = re.sub(r"[ \t]+\n", "\n", page.extract_text() or "").strip()
+        if len(text) < PDF_MIN_TEXT_CHARS:
+            scanned.append(index)
+            pages.append(f"--- 第 {index + 1} 頁 (掃描頁，見附件) ---")
+        else:
+            pages.append(f"--- 第 {index + 1} 頁 ---\n{text}")
+    if not reader.pages or len(scanned) > len(reader.pages) * PDF_MAX_SCANNED_RATIO:
+        return None
+    text = "\n\n".join(pages)
+    # 模型以每頁固定 token 計價 PDF；排版密集的頁面轉成文字反而較貴時，維持原檔
+    if estimate_text_tokens(text) > (len(reader.pages) - len(scanned)) * PDF_TOKENS_PER_PAGE:
+        return None
+    binary = []
+    if scanned:
+        writer = PdfWriter()
+        for index in scanned:
+            writer.add_page(reader.pages[index])
+        out = BytesIO()
+        writer.write(out)
+        binary.append((out.getvalue(), "application/pdf", f"掃描頁 {', '.join(str(i + 1) for i in scanned)}"))
+    return {"text": text, "binary": binary, "raw_tokens": len(reader.pages) * PDF_TOKENS_PER_PAGE}
+
+def _pptx_extractor(file_bytes):
+    import zipfile
+    import posixpath
+    from xml.etree import ElementTree
+    ns = {
+        "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+        "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+        "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+        "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+    }
+
+    def rels_of(zf, part):
+        rels_path = posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
+        if rels_path not in zf.namelist():
+            return {}
+        root = ElementTree.fromstring(zf.read(rels_path))
+        return {
+            rel.get("Id"): (rel.get("Type").rsplit("/", 1)[-1], posixpath.normpath(posixpath.join(posixpath.dirname(part), rel.get("Target"))))
+            for rel in root.findall("rel:Relationship", ns)
+        }
+
+    def paragraphs(element):
+        lines = []
+        for para in element.iter(f"{{{ns['a']}}}p"):
+            line = "".join(t.text or "" for t in para.iter(f"{{{ns['a']}}}t")).strip()
+            if line:
+                lines.append(line)
+        return lines
+
+    with zipfile.ZipFile(byte_stream(file_bytes)) as zf:
+        # 依 presentation.xml 的投影片順序 (檔名編號不一定等於播放順序)
+        presentation = ElementTree.fromstring(zf.read("ppt/presentation.xml"))
+        pres_rels = rels_of(zf, "ppt/presentation.xml")
+        slide_parts = [pres_rels[s.get(f"{{{ns['r']}}}id")][1] for s in presentation.iter(f"{{{ns['p']}}}sldId")]
+        sections, binary = [], []
+        for number, part in enumerate(slide_parts, 1):
+            root = ElementTree.fromstring(zf.read(part))
+            slide_rels = rels_of(zf, part)
+            lines = []
+            for shape in root.iter(f"{{{ns['p']}}}sp"):
+                lines.extend(paragraphs(shape))
+            for table in root.iter(f"{{{ns['a']}}}tbl"):
+                for row in table.iter(f"{{{ns['a']}}}tr"):
+                    lines.append(" | ".join(" ".join(paragraphs(cell)) for cell in row.iter(f"{{{ns['a']}}}tc")))
+            notes = [target for kind, target in slide_rels.values() if kind == "notesSlide"]
+            note_lines = []
+            if notes and notes[0] in zf.namelist():
+                note_root = ElementTree.fromstring(zf.read(notes[0]))
+                for shape in note_root.iter(f"{{{ns['p']}}}sp"):
+                    # 略過備忘稿中的投影片編號等預留位置
+                    ph = shape.find(".//p:nvPr/p:ph", ns)
+                    if ph is None or ph.get("type") == "body":
+                        note_lines.extend(paragraphs(shape))
+            images = [
+                slide_rels[blip.get(f"{{{ns['r']}}}embed")][1] for blip in root.iter(f"{{{ns['a']}}}blip")
+                if blip.get(f"{{{ns['r']}}}embed") in slide_rels
+            ]
+            section = [f"--- 投影片 {number} ---"] + lines
+            if note_lines:
+                section.append("[備忘稿] " + " ".join(note_lines))
+            if images and len("".join(lines)) < PPTX_IMAGE_SLIDE_MAX_CHARS:
+                for target in images:
+                    mime_type = mimetypes.guess_type(target)[0]
+                    if len(binary) < PPTX_MAX_IMAGES and mime_type in ("image/png", "image/jpeg", "image/webp", "image/gif"):
+                        binary.append((zf.read(target), mime_type, f"投影片 {number} 圖片"))
+                        section.append(f"(圖片見附件：投影片 {number} 圖片)")
+            elif images:
+                section.append(f"(本頁含 {len(images)} 張圖片)")
+            sections.append("\n".join(section))
+    return {"text": "\n\n".join(sections), "binary": binary, "raw_tokens": len(slide_parts) * PPTX_TOKENS_PER_SLIDE}
+
+# 以副檔名登錄；新增格式時在此加入一筆即可
+TEXT_EXTRACTORS = {
+    ".docx": ("docx", _docx_extractor),
+    ".pptx": ("pptx", _pptx_extractor),
+    ".pdf": ("pdf", _pdf_extractor),
+    ".txt": ("txt", _txt_extractor),
+}
+
+def get_text_extractor(file_name, mime_type):
+    # 先依 MIME 對應，瀏覽器回報的 MIME 不可靠時再以副檔名判斷；回傳 (正規化後的 MIME, 擷取器或 None)
+    ext = next((e for e in TEXT_EXTRACTORS if LOCAL_MIME_TYPES[e] == mime_type), None) or os.path.splitext(file_name)[1].lower()
+    if ext not in TEXT_EXTRACTORS:
+        return mime_type, None
+    return LOCAL_MIME_TYPES[ext], TEXT_EXTRACTORS[ext]
+
+# 每個檔案組成一組 content parts (開始標記 / 內容 / 結束標記)，並保留切分與估算所需的資訊
+def _build_file_groups(file_list, file_digests, media_part, preprocess_profile=None):
+    groups = []
+    for uploaded_file, (_, digest) in zip(file_list, file_digests):
+        file_name = uploaded_file.name
+        file_bytes = uploaded_file.getvalue()
+        mime_type = uploaded_file.type
+        
+        if file_name.lower().endswith('.m4a'):
+             mime_type = 'audio/mp4'
+
+        preprocessed = None
+        if preprocess_profile is not None:
+            raw_bytes = len(file_bytes)
+            started = time.perf_counter()
+            try:
+                with trace_span(f"preprocess.{mime_type.split('/')[0]}", bytes=raw_bytes, mime_type=mime_type):
+                    processed = preprocess_media(file_bytes, mime_type, preprocess_profile)
+            except Exception:
+                processed = None   # 無法解析的檔案維持原樣傳送
+            if processed is not None:
+                file_bytes, mime_type, note = processed
+                digest = None      # 內容已改變，File API 代號依處理後內容計算
+                preprocessed = {"raw_bytes": raw_bytes, "bytes": len(file_bytes), "seconds": time.perf_counter() - started, "note": note}
+
+        mime_type, extractor = get_text_extractor(file_name, mime_type)
+        extracted = None
+        if extractor is not None:
+            kind, extract = extractor
+            try:
+                with trace_span(f"extract.{kind}", bytes=len(file_bytes)):
+                    extracted = extract(file_bytes)
+            except Exception as e:
+                # docx 沒有原檔可退 (模型不接受)，其餘格式擷取失敗時改以原檔傳送
+                if kind in ("docx", "pptx"):
+                    raise ValueError(f"檔案 {file_name} 讀取失敗: {str(e)}")
+
+        if extracted is not None:
+            text = extracted["text"]
+            parts = [text]
+            tokens = estimate_text_tokens(text)
+            sent_bytes = len(text.encode("utf-8"))
+            for data, part_mime, label in extracted["binary"]:
+                parts += [f"\n[附件：{label}]\n", media_part(data, part_mime, f"{file_name} ({label})")]
+                tokens += estimate_file_tokens(part_mime, data)
+                sent_bytes += len(data)
+            if extracted["binary"]:
+                text = None   # 含附件時不依文字切分，避免分段時遺漏附件
+        else:
+            text = None
+            parts = [media_part(file_bytes, mime_type, file_name, digest)]
+            tokens = estimate_file_tokens(mime_type, file_bytes)
+            sent_bytes = len(file_bytes)
+
+        groups.append({
+            "name": file_name,
+            "mime_type": mime_type,
+            "bytes": file_bytes,
+            "text": text,
+            "tokens": tokens,
+            "parts": [f"\n=== 檔案開始：{file_name} ===\n", *parts, f"\n=== 檔案結束：{file_name} ===\n"],
+            "preprocessed": preprocessed,
+            "extraction": {
+                "extracted": extracted is not None,
+                "raw_bytes": len(file_bytes),
+                "sent_bytes": sent_bytes,
+                # 與直接傳送原檔相比的節省量：原檔 token 由擷取器以同一算法估算 (txt 依解碼後全文、pdf / pptx 依頁數)，
+                # 無可靠估算的格式 (如 docx，模型不接受原檔) 為 None，不列入節省量
+                "raw_tokens": extracted.get("raw_tokens") if extracted is not None else tokens,
+                "tokens": tokens,
+            },
+        })
+    return groups
+
+# files_first=True 時檔案置於最前、任務說明接在後面，讓「系統提示 + 檔案」成為可共用的 context cache 前綴
+def _build_request(task_type, part_groups, file_inventory, user_instruction, lead_prompt=None, files_first=False):
+    content_parts = []
+    if files_first:
+        for parts in part_groups:
+            content_parts.extend(parts)
+    base_prompt = lead_prompt or (
+        f"你是一位專業行政秘書。請分析{'上述' if files_first else '接下來'}提供的多份文件，並製作：{task_type}。"
+        "請注意：若不同文件內容有衝突，請以「日期較新」或「使用者補充指令」為主。"
+    )
+    content_parts.append(base_prompt)
+    outputs = parse_multi_output_task(task_type)
+    if outputs:
+        content_parts.append(multi_output_prompt(outputs))
+    if not files_first:
+        for parts in part_groups:
+            content_parts.extend(parts)
+
+    final_instruction_block = f"""
+    \n
+    ---
+    **資料清單**：{', '.join(file_inventory)}
+    
+    【重要：使用者特別補充指令】
+    請在分析上述檔案時，優先遵守以下指示：
+    {user_instruction if user_instruction else "無特別指令，請依照標準格式產出。"}
+    
+    **注意**：
+    1. 若上述「使用者指令」與檔案內容有出入，請以「使用者指令」為準。
+    2. 請務必輸出純 JSON 格式。
+    ---
+    """
+    content_parts.append(final_instruction_block)
+    return content_parts
+
+# 依 MODEL_PRIORITY_LIST 呼叫模型 (含斷路器、併發備援與串流預覽)；status_container 只在呼叫端執行緒中操作
+# 回傳 (json_result, model_name)；全部失敗時回傳 (None, 最後錯誤訊息)
+def _dispatch_models(content_parts, generation_config, task_type, status_container, hedge_delay=None, stream=False, estimated_tokens=None, context=None):
+    candidates = [m for m in MODEL_PRIORITY_LIST if not is_circuit_open(m)]
+    for m in MODEL_PRIORITY_LIST:
+        if m not in candidates:
+            status_container.write(f"🔌 {m} 近期連續失敗，冷卻中略過")
+    if not candidates:
+        return None, "所有模型皆在斷路冷卻中，請稍後再試"
+
+    # hedge_delay 為 None 時依序備援；否則前一個模型逾時未回應就同時啟動下一個，先成功者勝出
+    tokens = estimated_tokens if estimated_tokens is not None else estimate_request_tokens(content_parts)
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    pending = {}
+    cancel_events = {}
+    last_error = ""
+    session_id = current_session_id()
+    hedge_deadline = None
+
+    # 串流預覽只能在主執行緒更新畫面：工作執行緒只附加收到的原始片段，由下方迴圈每次輪詢解析一次後呈現
+    # (每個片段都重新解析全文會隨回應長度呈平方成長)
+    preview = status_container.empty() if stream and hasattr(status_container, "empty") else None
+    streamed_chunks = {}
+    latest_partial = {}   # 模型 -> (已解析的片段數, 部分結果)
+
+    # 依配額挑選下一個模型；併發備援時不排隊 (max_wait=0)，以免延誤取回已在途的結果
+    def launch_next(max_wait=ROUTER_MAX_WAIT_SECONDS):
+        nonlocal hedge_deadline
+        model_name = acquire_model(candidates, tokens, status_container, max_wait)
+        if model_name is None:
+            hedge_deadline = None
+            return False
+        status_container.write(f"正在呼叫模型：**{model_name}** ...")
+        cancel_event = threading.Event()
+        on_partial = streamed_chunks.setdefault(model_name, []).append if stream else None
+        future = executor.submit(bind_trace_context(_call_model), model_name, content_parts, generation_config, task_type, session_id, on_partial, cancel_event, context)
+        pending[future] = model_name
+        cancel_events[future] = cancel_event
+        hedge_deadline = time.time() + hedge_delay if hedge_delay is not None else None
+        return True
+
+    try:
+        if not launch_next():
+            return None, "所有模型皆已達配額上限 (每分鐘或每日)，請稍後再試"
+        while pending:
+            timeouts = []
+            if hedge_deadline is not None and candidates:
+                timeouts.append(max(hedge_deadline - time.time(), 0))
+            if preview is not None:
+                timeouts.append(STREAM_POLL_SECONDS)
+            done, _ = wait(pending, timeout=min(timeouts) if timeouts else None, return_when=FIRST_COMPLETED)
+            if preview is not None:
+                for model_name in pending.values():
+                    received = streamed_chunks.get(model_name, ())
+                    parsed_count, partial = latest_partial.get(model_name, (0, None))
+                    if len(received) > parsed_count:
+                        parsed_count = len(received)
+                        partial = parse_partial_json("".join(received[:parsed_count]))
+                        latest_partial[model_name] = (parsed_count, partial)
+                    if partial is not None:
+                        render_partial_result(preview, partial, model_name)
+                        break
+            if not done:
+                if hedge_deadline is not None and candidates and time.time() >= hedge_deadline:
+                    status_container.write(f"⏱️ {', '.join(pending.values())} 超過 {hedge_delay:g} 秒未回應，併發啟動備援模型")
+                    if not launch_next(max_wait=0):
+                        status_container.write("🚦 備援模型目前皆無額度，繼續等待原模型")
+                continue
+            for future in done:
+                model_name = pending.pop(future)
+                cancel_events.pop(future)
+                try:
+                    json_result = future.result()
+                except Exception as e:
+                    release_model(model_name)
+                    last_error = str(e)
+                    status_container.write(f"⚠️ {model_name} 發生錯誤: {last_error}，切換備援...")
+                    continue
+
+                # 只有尚未開始的呼叫能真正取消並退還每日次數；已送出的請求仍會完成並計費
+                for other, other_model in pending.items():
+                    cancel_events[other].set()
+                    if other.cancel():
+                        release_model(other_model)
+                if pending:
+                    status_container.write(f"🛑 已取消其餘模型：{', '.join(pending.values())}")
+                if preview is not None:
+                    preview.empty()
+                pending.clear()
+                return json_result, model_name
+            if not pending and candidates and not launch_next():
+                last_error = f"{last_error}；其餘模型皆已達配額上限" if last_error else "所有模型皆已達配額上限"
+    finally:
+        # 中途離開 (如例外或使用者中止) 時，未取回結果的呼叫一併取消；尚未開始的退還每日次數
+        for future, model_name in pending.items():
+            cancel_events[future].set()
+            if future.cancel():
+                release_model(model_name)
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None, last_error
+
+# status_container 可由呼叫端傳入 (如批次模式的主控台輸出)，需提供 write() 與 update()
+# preprocess=True 時依任務設定 (PREPROCESS_PROFILES) 先壓縮圖片與錄音
+def analyze_content_with_gemini(file_list, task_type, api_key, user_instruction="", hedge_delay=None, status_container=None, stream=False, preprocess=True):
+    with trace_span("analyze", task=task_type, files=len(file_list or []), stream=stream) as span:
+        with RssSampler() as rss:
+            result = _analyze_content(file_list, task_type, api_key, user_instruction, hedge_delay, status_container, stream, preprocess)
+        memory = rss.report()
+        if memory:
+            span.set(peak_rss_mb=memory["peak_mb"], rss_delta_mb=memory["delta_mb"])
+        meta = get_meta_info(result)
+        if meta:
+            meta["memory"] = memory
+            span.set(result_model=meta.get("model"), cache_hit=bool(meta.get("cache_hit")))
+        elif isinstance(result, dict) and "error" in result:
+            span.set(error=result["error"][:200])
+        return result
+
+def _analyze_content(file_list, task_type, api_key, user_instruction, hedge_delay, status_container, stream, preprocess):
+    backend = get_llm_backend()
+    if not api_key and backend.billable:
+        return {"error": "請先在側邊欄輸入 API Key"}
+    if not file_list:
+        return {"error": "請至少上傳一個檔案"}
+
+    # 相同檔案 + 任務 + 指令 + 模型 已分析過時，直接回傳快取結果，不呼叫模型也不計入用量
+    cache_stats = get_analysis_cache_stats()
+    with trace_span("analyze.hash_files"):
+        file_digests = compute_file_digests(file_list)
+    for model_name in (MODEL_PRIORITY_LIST if backend.billable else []):
+        with trace_span("analyze.cache_lookup", model=model_name):
+            cached = load_cached_analysis(compute_analysis_cache_key(file_digests, task_type, user_instruction, model_name, preprocess))
+        if cached is not None:
+            cache_stats["hits"] += 1
+            cached_meta = get_meta_info(cached)
+            if cached_meta is not None:
+                cached_meta['cache_hit'] = True
+            if status_container is not None:
+                status_container.write(f"⚡ 命中分析快取 ({model_name})，未消耗額度")
+            else:
+                st.toast(f"⚡ 命中分析快取 ({model_name})，未消耗額度", icon="🗄️")
+            return cached
+    if backend.billable:
+        cache_stats["misses"] += 1
+
+    backend.configure(api_key)
+    generation_config = {
+        "temperature": 0.2, 
+        "response_mime_type": "application/json"
+    }
+    response_schema = get_response_schema(task_type)
+    if response_schema is not None:
+        generation_config["response_schema"] = response_schema
+
+    if status_container is None:
+        status_container = st.status("🤖 AI 行政秘書正在多模態分析中...", expanded=True)
+
+    def media_part(file_bytes, mime_type, file_name, digest=None):
+        if len(file_bytes) < FILE_API_THRESHOLD_BYTES or not backend.supports_file_api:
+            return {"mime_type": mime_type, "data": file_bytes}
+        # 大型媒體改走 File API：上傳一次，所有備援模型與重試共用同一代號
+        try:
+            with trace_span("file_api.upload", bytes=len(file_bytes), mime_type=mime_type) as span:
+                file_part, reused = get_file_part(file_bytes, digest or hashlib.sha256(file_bytes).hexdigest(), mime_type, file_name, api_key)
+                span.set(reused=reused)
+            status_container.write(f"{'♻️ 重用已上傳檔案' if reused else '📤 已上傳檔案'}：{file_name}")
+            return file_part
+        except Exception as e:
+            status_container.write(f"⚠️ {file_name} 上傳 File API 失敗 ({e})，改為內嵌傳送")
+            return {"mime_type": mime_type, "data": file_bytes}
+
+    try:
+        with trace_span("analyze.prepare_files", files=len(file_list)):
+            groups = _build_file_groups(file_list, file_digests, media_part, get_preprocess_profile(task_type) if preprocess else None)
+    except ValueError as e:
+        status_container.update(label="❌ 檔案讀取失敗", state="error")
+        return {"error": str(e)}
+    file_inventory = [g["name"] for g in groups]
+    for g in groups:
+        pre = g["preprocessed"]
+        if pre:
+            status_container.write(
+                f"🗜️ {g['name']}：{pre['raw_bytes'] / 1024:,.0f} KB → {pre['bytes'] / 1024:,.0f} KB ({pre['note']}，處理 {pre['seconds']:.1f} 秒)"
+            )
+        ex = g["extraction"]
+        if ex["extracted"]:
+            token_note = f"，約 {ex['raw_tokens']:,} → {ex['tokens']:,} tokens" if ex["raw_tokens"] is not None else ""
+            status_container.write(
+                f"📝 {g['name']}：已轉為文字，{ex['raw_bytes'] / 1024:,.0f} KB → {ex['sent_bytes'] / 1024:,.0f} KB{token_note}"
+            )
+
+    # 預估輸入 token；超過門檻時改走分段分析 (Map-Reduce)，避免超出上下文或延遲失控
+    estimated_tokens = sum(g["tokens"] for g in groups)
+    status_container.write(f"📏 預估輸入約 {estimated_tokens:,} tokens")
+    chunks = plan_chunks(groups, MAP_CHUNK_TOKEN_BUDGET, media_part) if estimated_tokens > MAP_REDUCE_THRESHOLD_TOKENS else []
+    # 無法再切分的單位 (整份 PDF、壓縮音訊等) 仍可能超出每段上限；超出模型輸入上限時直接拒絕，不送出必定失敗的請求
+    for chunk in chunks or [[(g["name"], g["parts"], g["tokens"]) for g in groups]]:
+        chunk_tokens = sum(tokens for _, _, tokens in chunk)
+        labels = "、".join(label for label, _, _ in chunk)
+        if chunk_tokens > MODEL_CONTEXT_TOKENS:
+            status_container.update(label="❌ 內容超出模型輸入上限", state="error")
+            return {"error": f"{labels} 預估約 {chunk_tokens:,} tokens，超過模型輸入上限 {MODEL_CONTEXT_TOKENS:,}，且無法再切分；請分割檔案後再上傳"}
+        if chunks and chunk_tokens > MAP_CHUNK_TOKEN_BUDGET:
+            status_container.write(f"⚠️ {labels} 無法再切分，單段約 {chunk_tokens:,} tokens (超過每段上限 {MAP_CHUNK_TOKEN_BUDGET:,})")
+    if len(chunks) > 1:
+        with trace_span("analyze.map_reduce", chunks=len(chunks), estimated_tokens=estimated_tokens):
+            json_result, model_name = run_map_reduce(
+                chunks, task_type, file_inventory, user_instruction, generation_config,
+                status_container, estimated_tokens, hedge_delay, stream
+            )
+    else:
+        # 檔案量達 context cache 門檻時，改以檔案開頭的版面送出，之後只改指令或任務的請求可沿用快取
+        context = None
+        if CONTEXT_CACHE_ENABLED and backend.supports_context_cache and estimated_tokens >= CONTEXT_CACHE_MIN_TOKENS:
+            context = plan_context_prefix(groups, api_key, backend)
+        with trace_span("analyze.build_request", estimated_tokens=estimated_tokens):
+            content_parts = _build_request(task_type, [g["parts"] for g in groups], file_inventory, user_instruction, files_first=context is not None)
+        with trace_span("analyze.dispatch", hedged=hedge_delay is not None):
+            json_result, model_name = _dispatch_models(
+                content_parts, generation_config, task_type, status_container, hedge_delay, stream,
+                max(estimated_tokens, estimate_request_tokens(content_parts)), context
+            )
+        cache_info = (get_meta_info(json_result) or {}).get("context_cache")
+        if cache_info and cache_info["name"]:
+            verb = "已建立" if cache_info["created"] else "重用"
+            status_container.write(f"🧠 {verb} context cache：{cache_info['tokens']:,} tokens 的系統提示與檔案不必重送")
+        elif cache_info and cache_info.get("error"):
+            status_container.write(f"⚠️ context cache 無法使用，已改送完整內容：{cache_info['error']}")
+
+    if json_result is None:
+        status_container.update(label="❌ 所有模型皆失敗", state="error")
+        return {"error": f"所有模型嘗試皆失敗。最後錯誤: {model_name}"}
+    outputs = parse_multi_output_task(task_type)
+    if outputs:
+        produced = [task for task, _ in split_multi_output(json_result, task_type)]
+        if not produced:
+            status_container.update(label="❌ 模型未依組合格式回傳", state="error")
+            return {"error": f"模型回傳的結果中找不到任何一份文件 (預期鍵：{', '.join(MULTI_OUTPUT_TASKS[t] for t in outputs)})"}
+        missing = [task for task in outputs if task not in produced]
+        if missing:
+            status_container.write(f"⚠️ 模型未產出：{'、'.join(missing)}，其餘文件仍可下載")
+        meta = get_meta_info(json_result)
+        if meta:
+            meta["multi_output"] = {"produced": produced, "missing": missing}
+    meta = get_meta_info(json_result)
+    if meta:
+        extracted = [g["extraction"] for g in groups if g["extraction"]["extracted"]]
+        estimated = [ex for ex in extracted if ex["raw_tokens"] is not None]
+        meta["extraction"] = {
+            "files": len(extracted),
+            "bytes_saved": sum(ex["raw_bytes"] - ex["sent_bytes"] for ex in extracted),
+            "tokens_saved": sum(ex["raw_tokens"] - ex["tokens"] for ex in estimated) if estimated else None,
+        }
+        preprocessed = [g["preprocessed"] for g in groups if g["preprocessed"]]
+        meta["preprocess"] = {
+            "files": len(preprocessed),
+            "bytes_saved": sum(p["raw_bytes"] - p["bytes"] for p in preprocessed),
+            "seconds": round(sum(p["seconds"] for p in preprocessed), 2),
+        }
+
+    try:
+        if backend.billable:
+            # 分段後本機合併 (local-merge) 不屬於任何模型，存在主要模型的鍵下，查詢時才找得到
+            cache_model = model_name if model_name in MODEL_PRIORITY_LIST else MODEL_PRIORITY_LIST[0]
+            with trace_span("analyze.cache_save"):
+                save_cached_analysis(compute_analysis_cache_key(file_digests, task_type, user_instruction, cache_model, preprocess), json_result)
+    except OSError as e:
+        status_container.write(f"⚠️ 分析快取寫入失敗: {e}")
+
+    status_container.update(label=f"✅ 分析完成！使用模型：{model_name}", state="complete", expanded=False)
+    return json_result
+
+# ==========================================
+# 4-1. 🧩 長內容分段分析 (Map-Reduce)
+# ==========================================
+MODEL_CONTEXT_TOKENS = 1_000_000        # gemini flash 系列的輸入上限
+MAP_REDUCE_THRESHOLD_TOKENS = 200_000   # 預估輸入超過此值即分段 (遠低於上限，以控制單次延遲)
+MAP_CHUNK_TOKEN_BUDGET = 100_000        # 每段的 token 上限
+MAP_REDUCE_MAX_WORKERS = 4              # 同時分析的段數
+AUDIO_TOKENS_PER_SECOND = 32            # Gemini 音訊計價：每秒 32 tokens
+IMAGE_TOKENS = 258
+PDF_TOKENS_PER_PAGE = 258
+PPTX_TOKENS_PER_SLIDE = 258    # 投影片原檔以每頁一張圖估算 (僅用於計算擷取的節省量)
+COMPRESSED_AUDIO_BYTES_PER_SECOND = 16000   # 無法讀取長度的壓縮音訊以 128 kbps 估算
+
+def estimate_text_tokens(text):
+    # 中日韓文字約 1 字 1 token，其他文字約 4 字元 1 token
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+# File API 代號 (file_data) 無法得知內容，由呼叫端以檔案階段的估算值補上
+def estimate_request_tokens(content_parts):
+    tokens = 0
+    for part in content_parts:
+        if isinstance(part, str):
+            tokens += estimate_text_tokens(part)
+        elif isinstance(part, dict) and "data" in part:
+            tokens += estimate_file_tokens(part["mime_type"], part["data"])
+    return tokens
+
+def _audio_seconds(mime_type, file_bytes):
+    if mime_type in ("audio/wav", "audio/x-wav", "audio/wave"):
+        try:
+            with wave.open(byte_stream(file_bytes)) as wav:
+                return wav.getnframes() / float(wav.getframerate())
+        except (wave.Error, EOFError):
+            pass
+    return len(file_bytes) / COMPRESSED_AUDIO_BYTES_PER_SECOND
+
+def estimate_file_tokens(mime_type, file_bytes, text=None):
+    if text is not None:
+        return estimate_text_tokens(text)
+    if mime_type.startswith("image/"):
+        return IMAGE_TOKENS
+    if mime_type.startswith("audio/"):
+        return int(_audio_seconds(mime_type, file_bytes) * AUDIO_TOKENS_PER_SECOND)
+    if mime_type == "application/pdf":
+        return max(len(re.findall(rb"/Type\s*/Page(?!s)", file_bytes)), 1) * PDF_TOKENS_PER_PAGE
+    return len(file_bytes) // 4
+
+def _split_wav(file_bytes, seconds_per_chunk):
+    with wave.open(byte_stream(file_bytes)) as src:
+        params = src.getparams()
+        frames_per_chunk = max(int(params.framerate * seconds_per_chunk), 1)
+        while True:
+            frames = src.readframes(frames_per_chunk)
+            if not frames:
+                break
+            out = BytesIO()
+            with wave.open(out, "wb") as dst:
+                dst.setparams(params)
+                dst.writeframes(frames)
+            yield out.getvalue()
+
+# 將單一檔案切成不超過 budget 的單位：文字依段落、WAV 依時間區段；其他格式無法切分則整份保留
+def _split_long_line(line, budget):
+    # 單行超過 budget (如整份無換行的文字檔) 時依字數硬切；每字最多估 1 token，budget - 1 字必定不超過 budget
+    if estimate_text_tokens(line) <= budget:
+        return [line]
+    size = max(budget - 1, 1)
+    return [line[i:i + size] for i in range(0, len(line), size)]
+
+def _split_group(group, budget, media_part):
+    if group["tokens"] <= budget:
+        return [(group["name"], group["parts"], group["tokens"])]
+    units = []
+    if group["text"] is not None:
+        # 硬切出的片段與前一片直接相接，只有原本的換行才補回 "\n"
+        lines, line_tokens = [], 0
+        for raw in group["text"].splitlines():
+            for index, piece in enumerate(_split_long_line(raw, budget)):
+                tokens = estimate_text_tokens(piece)
+                if lines and line_tokens + tokens > budget:
+                    units.append("".join(lines))
+                    lines, line_tokens = [], 0
+                lines.append("\n" + piece if index == 0 and lines else piece)
+                line_tokens += tokens
+        if lines:
+            units.append("".join(lines))
+        return [
+            (f"{group['name']} 第 {i} 段", [f"\n=== 檔案開始：{group['name']} (第 {i}/{len(units)} 段) ===\n", text, f"\n=== 檔案結束：{group['name']} (第 {i}/{len(units)} 段) ===\n"], estimate_text_tokens(text))
+            for i, text in enumerate(units, 1)
+        ]
+    if group["mime_type"] in ("audio/wav", "audio/x-wav", "audio/wave"):
+        seconds = budget / AUDIO_TOKENS_PER_SECOND
+        segments = list(_split_wav(group["bytes"], seconds))
+        for i, segment in enumerate(segments, 1):
+            start_min = (i - 1) * seconds / 60
+            label = f"{group['name']} 第 {start_min:.0f} 分起"
+            units.append((label, [
+                f"\n=== 錄音開始：{group['name']} (第 {i}/{len(segments)} 段，自第 {start_min:.0f} 分鐘起) ===\n",
+                media_part(segment, group["mime_type"], f"{group['name']}.part{i}"),
+                f"\n=== 錄音結束：{group['name']} (第 {i}/{len(segments)} 段) ===\n",
+            ], estimate_file_tokens(group["mime_type"], segment)))
+        return units
+    return [(group["name"], group["parts"], group["tokens"])]
+
+def plan_chunks(groups, budget, media_part):
+    units = []
+    for group in groups:
+        units.extend(_split_group(group, budget, media_part))
+    chunks, current, current_tokens = [], [], 0
+    for label, parts, tokens in units:
+        if current and current_tokens + tokens > budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append((label, parts, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+# 工作執行緒版的備援呼叫 (不觸碰 Streamlit 元件)
+def _call_with_fallback(content_parts, generation_config, task_type, session_id, estimated_tokens=None):
+    last_error = None
+    tokens = estimated_tokens if estimated_tokens is not None else estimate_request_tokens(content_parts)
+    candidates = [m for m in MODEL_PRIORITY_LIST if not is_circuit_open(m)]
+    if not candidates:
+        raise CircuitOpenError("所有模型皆在斷路冷卻中，請稍後再試")
+    while candidates:
+        model_name = acquire_model(candidates, tokens)
+        if model_name is None:
+            break
+        try:
+            return _call_model(model_name, content_parts, generation_config, task_type, session_id), model_name
+        except Exception as e:
+            release_model(model_name)
+            last_error = e
+    raise last_error or RuntimeError("所有模型皆已達配額上限")
+
+def merge_partial_results(partials):
+    # 模型合併失敗時的本機合併：清單欄位串接去重，文字欄位取第一個非空值
+    if all(isinstance(p, list) for p in partials):
+        return [row for p in partials for row in p]
+    merged = {}
+    for partial in partials:
+        if not isinstance(partial, dict):
+            continue
+        for key, value in partial.items():
+            if key == "_meta_info":
+                continue
+            if isinstance(value, list):
+                bucket = merged.setdefault(key, [])
+                for item in value:
+                    if item not in bucket:
+                        bucket.append(item)
+            elif isinstance(value, dict):
+                # 多重輸出的各份文件分別合併
+                merged[key] = merge_partial_results([merged.get(key) or {}, value])
+            elif value not in ("", None) and not merged.get(key):
+                merged[key] = value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+def run_map_reduce(chunks, task_type, file_inventory, user_instruction, generation_config, status_container, estimated_tokens, hedge_delay=None, stream=False):
+    started = time.perf_counter()
+    total = len(chunks)
+    status_container.write(f"🧩 內容過長，分為 {total} 段平行分析後再合併")
+    session_id = current_session_id()
+    requests = []
+    for i, chunk in enumerate(chunks, 1):
+        labels = "、".join(label for label, _, _ in chunk)
+        lead_prompt = (
+            f"你是一位專業行政秘書。以下是完整資料的第 {i}/{total} 部分（{labels}）。"
+            f"請只根據這一部分製作：{task_type}，並依相同 JSON 格式輸出；此部分沒有資訊的欄位請填空字串或空陣列。"
+        )
+        requests.append((
+            _build_request(task_type, [parts for _, parts, _ in chunk], file_inventory, user_instruction, lead_prompt),
+            sum(tokens for _, _, tokens in chunk) + estimate_text_tokens(lead_prompt),
+        ))
+
+    partials = [None] * total
+    metas = []
+    with ThreadPoolExecutor(max_workers=min(MAP_REDUCE_MAX_WORKERS, total)) as executor:
+        futures = {
+            executor.submit(bind_trace_context(_call_with_fallback), content_parts, generation_config, task_type, session_id, chunk_tokens): index
+            for index, (content_parts, chunk_tokens) in enumerate(requests)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                partial, model_name = future.result()
+            except Exception as e:
+                status_container.write(f"⚠️ 第 {index + 1}/{total} 段分析失敗: {e}")
+                continue
+            if get_meta_info(partial):
+                metas.append(pop_meta_info(partial))
+            partials[index] = partial
+            status_container.write(f"✅ 第 {index + 1}/{total} 段完成 ({model_name})")
+
+    partials = [p for p in partials if p is not None]
+    if not partials:
+        return None, "所有分段皆分析失敗"
+
+    reduce_prompt = (
+        f"你是一位專業行政秘書。以下是同一批資料分 {len(partials)} 段分別分析所得的「{task_type}」JSON 結果。"
+        f"請合併為單一份完整的 {task_type} JSON，格式與各段相同：合併重複項目、保留所有重要資訊，清單依時間或邏輯順序排列。"
+        f"使用者補充指令：{user_instruction or '無'}。請務必輸出純 JSON 格式。\n\n"
+        + json.dumps(partials, ensure_ascii=False)
+    )
+    status_container.write("🔗 合併各段結果...")
+    json_result, model_name = _dispatch_models([reduce_prompt], generation_config, task_type, status_container, hedge_delay, stream)
+    if json_result is None:
+        status_container.write(f"⚠️ 模型合併失敗 ({model_name})，改以本機規則合併")
+        json_result, model_name = merge_partial_results(partials), "local-merge"
+    elif get_meta_info(json_result):
+        metas.append(pop_meta_info(json_result))
+
+    if isinstance(json_result, (dict, list)):
+        json_result = set_meta_info(json_result, {
+            "model": model_name,
+            "input_tokens": sum(m.get("input_tokens", 0) for m in metas),
+            "output_tokens": sum(m.get("output_tokens", 0) for m in metas),
+            "total_tokens": sum(m.get("total_tokens", 0) for m in metas),
+            "latency_ms": round((time.perf_counter() - started) * 1000),
+            "map_reduce": {"chunks": total, "succeeded": len(partials), "estimated_tokens": estimated_tokens},
+        })
+    return json_result, model_name
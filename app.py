@@ -1,17 +1,23 @@
 import streamlit as st
-import pandas as pd
-from docx import Document
-from docx.shared import Pt
-from docx.oxml.ns import qn
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT, WD_LINE_SPACING
-from docxtpl import DocxTemplate  # 核心：用於模板填充
+# 重量級套件 (google.generativeai、gspread、pandas、python-docx、docxtpl) 一律在用到的函數內才匯入，
+# 讓只開啟頁面、未分析或未同步 Sheet 的工作階段不必支付其載入時間；背景工作 (job_queue) 與檔案產生 (exporters)
+# 也在第一次分析或下載時才匯入。新增匯入請維持此原則，並以 benchmarks/bench_startup.py 確認啟動時間未退步
+import copy
+import functools
 from io import BytesIO
-import google.generativeai as genai
 import json
 import os
+import sys
+import time
 from datetime import datetime
-import gspread
-from google.oauth2.service_account import Credentials
+
+from tracing import TRACE_FILE, TRACE_SAMPLE_WINDOW, get_stage_stats
+from usage_ledger import load_usage_data
+from model_router import MODEL_PRIORITY_LIST, HEDGE_DELAY_SECONDS, _model_quota, is_circuit_open, get_rate_limit_snapshot
+from analysis import (
+    MULTI_OUTPUT_TASKS, multi_output_task, split_multi_output, pop_meta_info,
+    get_llm_backend, get_analysis_cache_stats, get_json_repair_stats, get_memory_stats,
+)
 
 # ==========================================
 # 0. 頁面基本設定
@@ -23,37 +29,6 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# ==========================================
-# 1. 📊 本地用量記帳系統
-# ==========================================
-USAGE_LOG_FILE = "usage_log.json"
-
-def load_usage_data():
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    default_data = {"date": today_str, "stats": {}}
-    if not os.path.exists(USAGE_LOG_FILE):
-        return default_data
-    try:
-        with open(USAGE_LOG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if data.get("date") != today_str:
-                return default_data 
-            return data
-    except:
-        return default_data
-
-def save_usage_data(data):
-    with open(USAGE_LOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-def update_usage_count(model_name, input_tokens, output_tokens):
-    data = load_usage_data()
-    if model_name not in data["stats"]:
-        data["stats"][model_name] = {"count": 0, "total_tokens": 0}
-    data["stats"][model_name]["count"] += 1
-    data["stats"][model_name]["total_tokens"] += (input_tokens + output_tokens)
-    save_usage_data(data)
-
 # ==========================================
 # 2. 🎨 UI 美化
 # ==========================================
@@ -139,395 +114,49 @@ def inject_custom_css():
     """, unsafe_allow_html=True)
 
 # ==========================================
-# 3. 系統提示詞
-# ==========================================
-SYSTEM_INSTRUCTION = """
-你是一位專業的行政秘書。請分析使用者提供的檔案（文件、錄音或圖片），並根據使用者的要求產出對應的 JSON 資料。
-請嚴格遵守以下規則：
-
-1. **Memo (指定格式)**：
-   若任務是 Memo，請回傳 JSON 包含以下欄位。
-   **重要：針對 'method', 'official', 'note' 等勾選欄位，請輸出「包含所有選項的完整字串」，並將判斷應勾選的項目符號改為「實心方塊 ■」，未選項目維持「空心方塊 □」。**
-   {
-       "time": "時間 (請完整填寫，如：113年12月25日 14:00)",
-       "location": "地點",
-       "method": "方式 (例如：'□電話 □活動 ■會議 □公文批示 □其他')",
-       "official": "長官 (例如：'■部長 □次長 □主任秘書 □立法委員 □其他：')",
-       "meeting_name": "會議名稱",
-       "chair": "主席",
-       "attendees": "出席人員",
-       "related_dept": "相關部會",
-       "guest_dept": "列席單位",
-       "conclusions": ["結論1 (請以條列式呈現)", "結論2"],
-       "action_items": ["辦理事項1 (請以條列式呈現)", "辦理事項2"],
-       "note": "附言 (例如：'□請回電話 □請惠處 ■請參酌 □其他')",
-       "filename_prefix": "建議檔名 (不含副檔名)"
-   }
-
-2. **簡易開會通知單 (指定格式)**：
-   若任務是開會通知，請回傳 JSON 包含以下欄位：
-   {
-       "date": "發文日期 (例如: 113年12月25日)",
-       "dept": "發文單位 (例如: 政策規劃組)",
-       "reason": "開會事由",
-       "full_time": "開會完整時間 (例如: 113年12月30日(星期二) 下午 4:00 - 5:00)",
-       "location": "地點",
-       "host": "主持人",
-       "attendees": "出席人員 (若無資訊填寫 '詳如簽到表')",
-       "note": "簡述/討論議題說明",
-       "agenda_table": [ ["時間1", "主題1", "備註1"], ["時間2", "主題2", "備註2"] ],
-       "filename_prefix": "建議檔名"
-   }
-
-3. **談參 (指定歸納邏輯)**：
-   若任務是談參，請回傳 JSON 包含以下三個主要區塊：
-   {
-       "title": "談參主題",
-       "background": ["背景說明點1", "背景說明點2"], 
-       "discussion_points": [
-           {"subtitle": "小標題 (5-10字)", "content": "詳細說明 (50-100字)"},
-           {"subtitle": "小標題 (5-10字)", "content": "詳細說明 (50-100字)"}
-       ],
-       "unit_opinion": "單位意見與立場說明 (請整合為一段完整的發言內容)",
-       "filename_prefix": "建議檔名"
-   }
-   **邏輯規則：**
-   - **背景說明**：請歸納 1-2 點背景資訊。
-   - **討論重點**：請提供 5-10 點。每點必須包含一個「5-10字的小標題」以及對應的內容。
-   - **單位意見**：請基於單位立場，提出具體的發言建議或立場聲明。
-
-4. **數據提取 (Excel)**：
-   請回傳一個 List，包含多個 Dictionary，每個 Dictionary 代表一行數據。
-
-5. **語言與翻譯強制規則**：
-   - **所有輸出內容必須為「繁體中文 (Traditional Chinese, Taiwan)」**。
-   - 若原始資料包含外文，請務必先將其**翻譯並潤飾**為通順的繁體中文。
-"""
-
-# ==========================================
-# 4. Gemini API 分析函數
-# ==========================================
-def analyze_content_with_gemini(file_list, task_type, api_key, user_instruction=""):
-    if not api_key:
-        return {"error": "請先在側邊欄輸入 API Key"}
-    if not file_list:
-        return {"error": "請至少上傳一個檔案"}
-
-    genai.configure(api_key=api_key)
-    generation_config = {
-        "temperature": 0.2, 
-        "response_mime_type": "application/json"
-    }
-
-    model_priority_list = [
-        "gemini-2.5-flash",      
-        "gemini-3.0-flash",      
-        "gemini-2.5-flash-lite"  
-    ]
-    
-    content_parts = []
-    base_prompt = f"你是一位專業行政秘書。請分析接下來提供的多份文件，並製作：{task_type}。請注意：若不同文件內容有衝突，請以「日期較新」或「使用者補充指令」為主。"
-    content_parts.append(base_prompt)
-
-    file_inventory = []
-
-    for uploaded_file in file_list:
-        file_name = uploaded_file.name
-        file_inventory.append(file_name)
-        file_bytes = uploaded_file.getvalue()
-        mime_type = uploaded_file.type
-        
-        if file_name.lower().endswith('.m4a'):
-             mime_type = 'audio/mp4'
-
-        content_parts.append(f"\n=== 檔案開始：{file_name} ===\n")
-
-        if mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            try:
-                doc = Document(BytesIO(file_bytes))
-                full_text = []
-                for para in doc.paragraphs:
-                    if para.text.strip():
-                        full_text.append(para.text)
-                for table in doc.tables:
-                    for row in table.rows:
-                        row_text = [cell.text for cell in row.cells]
-                        full_text.append(" | ".join(row_text))
-                
-                extracted_text = "\n".join(full_text)
-                content_parts.append(extracted_text)
-            except Exception as e:
-                return {"error": f"檔案 {file_name} 讀取失敗: {str(e)}"}
-        else:
-            content_parts.append({
-                "mime_type": mime_type,
-                "data": file_bytes
-            })
-        
-        content_parts.append(f"\n=== 檔案結束：{file_name} ===\n")
-
-    final_instruction_block = f"""
-    \n
-    ---
-    **資料清單**：{', '.join(file_inventory)}
-    
-    【重要：使用者特別補充指令】
-    請在分析上述檔案時，優先遵守以下指示：
-    {user_instruction if user_instruction else "無特別指令，請依照標準格式產出。"}
-    
-    **注意**：
-    1. 若上述「使用者指令」與檔案內容有出入，請以「使用者指令」為準。
-    2. 請務必輸出純 JSON 格式。
-    ---
-    """
-    content_parts.append(final_instruction_block)
-
-    status_container = st.status("🤖 AI 行政秘書正在多模態分析中...", expanded=True)
-    last_error = ""
-
-    for model_name in model_priority_list:
-        try:
-            status_container.write(f"正在呼叫模型：**{model_name}** ...")
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config,
-                system_instruction=SYSTEM_INSTRUCTION
-            )
-            response = model.generate_content(content_parts)
-            
-            if not response.text:
-                raise ValueError("API 回傳空值")
-
-            json_result = json.loads(response.text)
-            
-            if hasattr(response, 'usage_metadata'):
-                usage = response.usage_metadata
-                input_t = usage.prompt_token_count
-                output_t = usage.candidates_token_count
-                update_usage_count(model_name, input_t, output_t)
-                json_result['_meta_info'] = {
-                    "model": model_name,
-                    "input_tokens": input_t,
-                    "output_tokens": output_t,
-                    "total_tokens": usage.total_token_count
-                }
-
-            status_container.update(label=f"✅ 分析完成！使用模型：{model_name}", state="complete", expanded=False)
-            return json_result
-
-        except Exception as e:
-            error_msg = str(e)
-            last_error = error_msg
-            status_container.write(f"⚠️ {model_name} 發生錯誤: {error_msg}，切換備援...")
-            continue
-
-    status_container.update(label="❌ 所有模型皆失敗", state="error")
-    return {"error": f"所有模型嘗試皆失敗。最後錯誤: {last_error}"}
-
-# ==========================================
-# 5. 檔案生成函數
+# 6. Streamlit UI 主程式
 # ==========================================
-def set_chinese_font(run, font_name='標楷體', size_pt=12):
-    run.font.name = 'Times New Roman'
-    run.font.size = Pt(size_pt)
-    r = run._element
-    r.rPr.rFonts.set(qn('w:eastAsia'), font_name)
-
-# --- Memo (模板模式 + 舊版備援) ---
-def create_memo_docx_legacy(data):
-    doc = Document()
-    style = doc.styles['Normal']
-    style.font.name = 'Times New Roman'
-    style.element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-    style.font.size = Pt(12)
-    doc.add_paragraph("⚠️ (備援模式) 未偵測到 Template_Memo.docx，僅列出純文字內容。")
-    doc.add_paragraph(f"時間：{data.get('time', '')}")
-    doc.add_paragraph(f"內容：\n{data.get('conclusions', '')}")
-    bio = BytesIO()
-    doc.save(bio)
-    bio.seek(0)
-    return bio, "Legacy_Memo.docx"
-
-def create_memo_docx(data):
-    default_template_path = "Template_Memo.docx"
-    if not os.path.exists(default_template_path):
-        return create_memo_docx_legacy(data)
-    try:
-        doc = DocxTemplate(default_template_path)
-        context = {
-            'time': data.get('time', ''),
-            'location': data.get('location', ''),
-            'method': data.get('method', ''),     
-            'official': data.get('official', ''), 
-            'meeting_name': data.get('meeting_name', ''),
-            'chair': data.get('chair', ''),
-            'attendees': data.get('attendees', ''),
-            'related_dept': data.get('related_dept', ''),
-            'guest_dept': data.get('guest_dept', ''),
-            'conclusions': data.get('conclusions', []), 
-            'action_items': data.get('action_items', []),
-            'note': data.get('note', ''),
-            'filename_prefix': data.get('filename_prefix', 'Memo')
-        }
-        doc.render(context)
-        bio = BytesIO()
-        doc.save(bio)
-        bio.seek(0)
-        return bio, f"{context['filename_prefix']}.docx"
-    except Exception as e:
-        st.error(f"❌ Memo 模板生成失敗: {str(e)}")
-        return create_memo_docx_legacy(data)
-
-# --- 開會通知單 (模板模式 + 舊版備援) ---
-def create_notice_docx_legacy(data):
-    doc = Document()
-    doc.add_paragraph("⚠️ 錯誤：找不到模板檔案，且已切換至備援模式。")
-    bio = BytesIO()
-    doc.save(bio)
-    bio.seek(0)
-    return bio, "Legacy_Notice.docx"
-
-def create_notice_docx(data, custom_template=None):
-    default_template_path = "Template_Notice.docx" 
-    doc = None
-    if custom_template:
-        doc = DocxTemplate(custom_template)
-    elif os.path.exists(default_template_path):
-        doc = DocxTemplate(default_template_path)
+def _finish_analysis_job(job):
+    st.session_state.pop('analysis_job_id', None)
+    if "job" in st.query_params:
+        del st.query_params["job"]
+    if job is None:
+        st.session_state['analysis_error'] = "找不到分析工作 (可能已逾期或伺服器已重新啟動)，請重新分析"
+    elif job["status"] == "error":
+        st.session_state['analysis_error'] = job["error"]
     else:
-        return create_notice_docx_legacy(data)
-    try:
-        agenda_list = []
-        if 'agenda_table' in data and isinstance(data['agenda_table'], list):
-            for item in data['agenda_table']:
-                col1 = str(item[0]) if len(item) > 0 else ""
-                col2 = str(item[1]) if len(item) > 1 else ""
-                col3 = str(item[2]) if len(item) > 2 else ""
-                agenda_list.append({'col1': col1, 'col2': col2, 'col3': col3})
-
-        context = {
-            'date': data.get('date', ''),
-            'dept': data.get('dept', ''),
-            'reason': data.get('reason', ''),
-            'full_time': data.get('full_time', ''),
-            'location': data.get('location', ''),
-            'host': data.get('host', ''),
-            'attendees': data.get('attendees', ''),
-            'summary': data.get('note', ''),
-            'agenda_table': agenda_list, 
-            'filename_prefix': data.get('filename_prefix', 'MeetingNotice')
-        }
-        doc.render(context)
-        bio = BytesIO()
-        doc.save(bio)
-        bio.seek(0)
-        return bio, f"{context['filename_prefix']}.docx"
-    except Exception as e:
-        st.error(f"❌ 模板生成失敗: {str(e)}")
-        return create_notice_docx_legacy(data)
-
-# --- 談參 (維持 Code 模式) ---
-def create_talking_points_docx(data):
-    doc = Document()
-    style = doc.styles['Normal']
-    style.font.name = 'Times New Roman'
-    style.element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
-    style.font.size = Pt(12)
-    
-    p_title = doc.add_paragraph()
-    r_title = p_title.add_run(data.get('title', '談參資料'))
-    r_title.bold = True
-    set_chinese_font(r_title, size_pt=18)
-    p_title.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    doc.add_paragraph("-" * 30).alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-
-    if data.get('background'):
-        p_h1 = doc.add_paragraph()
-        r_h1 = p_h1.add_run("一、背景說明")
-        r_h1.bold = True
-        set_chinese_font(r_h1, size_pt=14)
-        for item in data['background']:
-            p = doc.add_paragraph(style='List Bullet')
-            set_chinese_font(p.add_run(item))
-
-    if data.get('discussion_points'):
-        p_h2 = doc.add_paragraph()
-        r_h2 = p_h2.add_run("二、討論重點")
-        r_h2.bold = True
-        set_chinese_font(r_h2, size_pt=14)
-        for item in data['discussion_points']:
-            p = doc.add_paragraph(style='List Number')
-            if 'subtitle' in item:
-                r_sub = p.add_run(f"【{item['subtitle']}】")
-                r_sub.bold = True
-                set_chinese_font(r_sub)
-            if 'content' in item:
-                r_con = p.add_run(f"：{item['content']}")
-                set_chinese_font(r_con)
-
-    if data.get('unit_opinion'):
-        p_h3 = doc.add_paragraph()
-        r_h3 = p_h3.add_run("三、單位意見")
-        r_h3.bold = True
-        set_chinese_font(r_h3, size_pt=14)
-        p_op = doc.add_paragraph()
-        p_op.paragraph_format.first_line_indent = Pt(24)
-        set_chinese_font(p_op.add_run(data['unit_opinion']))
-
-    bio = BytesIO()
-    doc.save(bio)
-    bio.seek(0)
-    return bio, f"{data.get('filename_prefix', 'TalkingPoints')}.docx"
-
-# --- Excel & Sheets ---
-def create_excel(data_list):
-    df = pd.DataFrame(data_list)
-    bio = BytesIO()
-    with pd.ExcelWriter(bio, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Data_Extraction')
-    bio.seek(0)
-    return bio, "Data_Extraction.xlsx"
-
-def create_google_sheet(data, task_type, creds_dict, user_email=None):
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-    try:
-        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-        client = gspread.authorize(creds)
-        title = f"{data.get('filename_prefix', 'Export')}_{datetime.now().strftime('%m%d_%H%M')}"
-        sh = client.create(title)
-        ws = sh.sheet1
-        rows_to_write = []
-        
-        if task_type == "數據提取 (Excel)":
-             if isinstance(data, list) and len(data) > 0:
-                 header = list(data[0].keys())
-                 rows_to_write.append(header)
-                 for item in data: rows_to_write.append(list(item.values()))
-             else:
-                 ws.update_acell('A1', '無數據')
-        else:
-            for k, v in data.items():
-                if isinstance(v, list):
-                    if not v: continue
-                    if all(isinstance(x, str) for x in v):
-                         rows_to_write.append([k, "\n".join(v)])
-                    elif all(isinstance(x, dict) for x in v):
-                         rows_to_write.append([k, "(詳如下表)"])
-                         for sub_item in v:
-                             rows_to_write.append(["", sub_item.get('subtitle',''), sub_item.get('content','')])
-                else:
-                    rows_to_write.append([k, str(v)])
-        
-        if rows_to_write: ws.update(rows_to_write)
-        if user_email: sh.share(user_email, perm_type='user', role='writer')
-        else: sh.share(None, perm_type='anyone', role='writer')
-        return sh.url, "✅ 成功建立 Google Sheet！"
-    except Exception as e:
-        return None, f"❌ 錯誤: {str(e)}"
+        # 複製一份再取出 _meta_info，工作紀錄保留完整結果供其他分頁重連取回
+        result = copy.copy(job["result"])
+        st.session_state['result_data'] = result
+        st.session_state['result_task'] = job["task"]
+        st.session_state['meta_info'] = pop_meta_info(result)
+    st.rerun(scope="app")
+
+JOB_POLL_SECONDS = 1.0
+
+# 只重跑此區塊輪詢工作狀態，不阻塞也不重跑整頁
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_analysis_job(job_id):
+    from job_queue import get_analysis_job, get_job_queue_position
+    job = get_analysis_job(job_id)
+    if job is None or job["status"] in ("done", "error"):
+        _finish_analysis_job(job)
+        return
+    elapsed = time.time() - (job["started"] or job["created"])
+    label = job["label"]
+    if job["status"] == "queued":
+        label = f"⏳ 排隊等待中 (前面還有 {get_job_queue_position(job_id)} 件)..."
+    with st.status(f"{label} ({elapsed:.0f} 秒)", expanded=True):
+        st.caption(f"工作代號 {job_id}｜{job['task']}｜{', '.join(job['files'])}｜重新整理頁面不會中斷分析")
+        for line in job["log"]:
+            st.write(line)
+        if job["preview"]:
+            st.markdown(job["preview"])
+
+# 尚未匯入的子系統代表還沒有統計可顯示，側邊欄不為此提早載入
+def _loaded_module(name):
+    return sys.modules.get(name)
 
-# ==========================================
-# 6. Streamlit UI 主程式
-# ==========================================
 def main():
     inject_custom_css()
 
@@ -543,17 +172,18 @@ def main():
         # -----------------------------------------------------
         st.markdown("### 📊 今日用量統計")
         usage_data = load_usage_data()
-        target_models = ["gemini-2.5-flash", "gemini-3.0-flash", "gemini-2.5-flash-lite"]
+        rate_limits = get_rate_limit_snapshot()
         
-        for m in target_models:
+        for m in MODEL_PRIORITY_LIST:
             count = usage_data["stats"].get(m, {}).get("count", 0)
+            daily_cap = _model_quota(m)["rpd"]
             
-            # 定義顏色邏輯
-            if count >= 15:
+            # 定義顏色邏輯 (依每日上限的使用比例)
+            if count >= daily_cap * 0.9:
                 bg_color = "#D32F2F"   # 深紅
                 text_color = "#FFFFFF" # 白字
                 sub_text_color = "#EEEEEE" # 次要文字也反白
-            elif count >= 10:
+            elif count >= daily_cap * 0.6:
                 bg_color = "#FBC02D"   # 黃色
                 text_color = "#1F323D" # 深色字
                 sub_text_color = "#1F323D"
@@ -562,14 +192,43 @@ def main():
                 text_color = "#1F323D"
                 sub_text_color = "#1F323D"
 
+            circuit_tag = " 🔌" if is_circuit_open(m) else ""
+            limit = rate_limits[m]
+            if limit["blocked_seconds"] > 0:
+                circuit_tag += " 🚦"
             st.markdown(f"""
             <div class="usage-metric-box" style="margin-bottom: 8px; background-color: {bg_color};">
-                <div class="usage-metric-title" style="color: {text_color};">{m}</div>
+                <div class="usage-metric-title" style="color: {text_color};">{m}{circuit_tag}</div>
                 <div class="usage-metric-value" style="color: {text_color};">
-                    {count} <span style="font-size:0.5em;color: {sub_text_color};">次</span>
+                    {count} <span style="font-size:0.5em;color: {sub_text_color};">/ {daily_cap} 次</span>
                 </div>
+                <div style="font-size:0.75em;color: {sub_text_color};">本分鐘尚餘 {limit['rpm_left']} 次・{limit['tpm_left']:,} tokens</div>
             </div>
             """, unsafe_allow_html=True)
+        cache_stats = get_analysis_cache_stats()
+        lookups = cache_stats["hits"] + cache_stats["misses"]
+        hit_rate = f"{cache_stats['hits'] / lookups:.0%}" if lookups else "—"
+        st.caption(f"🗄️ 分析快取：命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} (命中率 {hit_rate})")
+        repair_stats = get_json_repair_stats()
+        if repair_stats["repaired"] or repair_stats["failed"]:
+            st.caption(f"🩹 JSON 修復：省下 {repair_stats['repaired']} 次重新生成 (續寫 {repair_stats['continuations']} 次)｜無法修復 {repair_stats['failed']} 次")
+        memory_stats = get_memory_stats()
+        if memory_stats["requests"]:
+            st.caption(f"🧮 峰值 RSS：{memory_stats['peak_rss_mb']:,.0f} MB｜單次分析最多增加 {memory_stats['max_delta_mb']:,.0f} MB ({memory_stats['requests']} 次)")
+        exporters = _loaded_module("exporters")
+        for entry in (list(exporters.get_template_registry()["entries"].values()) if exporters else []):
+            avg_ms = entry["render_ms_total"] / entry["renders"] if entry["renders"] else 0.0
+            st.caption(f"🧩 {entry['label']}：載入 {entry['load_ms']:.0f} ms，套印 {entry['renders']} 次 (平均 {avg_ms:.0f} ms)")
+        with st.expander("⏱️ 效能面板 (各階段耗時)", expanded=False):
+            stage_stats = get_stage_stats()
+            if stage_stats:
+                lines = ["| 階段 | 次數 | p50 (ms) | p95 (ms) |", "|---|---:|---:|---:|"]
+                for row in stage_stats:
+                    lines.append(f"| {row['stage']} | {row['count']} | {row['p50_ms']:,.0f} | {row['p95_ms']:,.0f} |")
+                st.markdown("\n".join(lines))
+                st.caption(f"統計最近 {TRACE_SAMPLE_WINDOW} 筆；完整 span 記錄於 {TRACE_FILE} (OTLP/JSON)")
+            else:
+                st.caption("尚無資料，完成一次分析或下載後顯示")
         # -----------------------------------------------------
 
         st.markdown("---")
@@ -577,19 +236,37 @@ def main():
         with st.expander("☁️ Google Sheets 設定", expanded=False):
             uploaded_key = st.file_uploader("上傳 JSON Key", type=['json'], key="sheet_key")
             user_email = st.text_input("您的 Google Email (選填)")
+            sheet_target_url = st.text_input("附加至既有試算表網址 (選填)", help="留空則每次建立新的試算表；服務帳戶需具備該試算表的編輯權限")
+            sheet_target_ws = st.text_input("工作表名稱 (選填)", help="不存在時自動新增；留空則使用第一個工作表")
             
         api_key = st.text_input("🔑 API Key", type="password", help="請輸入您的 Google Gemini API Key")
+        llm_backend = get_llm_backend()
+        if not llm_backend.billable:
+            st.caption(f"🧪 目前使用離線模擬後端 ({llm_backend.name})：不需 API Key，結果為假資料，不計入用量")
+
+        hedge_delay = None
+        if st.checkbox("⚡ 併發備援 (Hedged)", help="主要模型逾時未回應時，同時啟動下一個模型，先完成者採用"):
+            hedge_delay = st.number_input("啟動備援前等待秒數", min_value=1.0, max_value=120.0, value=HEDGE_DELAY_SECONDS, step=1.0)
+        preprocess_media_files = st.checkbox("🗜️ 上傳前壓縮圖片與錄音", value=True, help="照片縮小並重新編碼、WAV 轉為單聲道 16 kHz 並裁掉長靜音，減少上傳時間與 token")
+        stream_output = st.checkbox("📡 串流顯示分析結果", value=True, help="邊產生邊顯示，長篇談參與會議紀錄不必等到全部完成")
         
         st.subheader("📝 任務選擇")
         task_mode = st.radio(
             "請選擇輸出類型：",
-            ("Memo (指定格式)", "簡易開會通知單 (指定格式)", "談參", "數據提取 (Excel)", "會議紀錄"),
+            ("Memo (指定格式)", "簡易開會通知單 (指定格式)", "談參", "數據提取 (Excel)", "會議紀錄", "多重輸出 (一次產生多份)"),
             index=0
         )
+        selected_outputs = [task_mode]
+        if task_mode == "多重輸出 (一次產生多份)":
+            selected_outputs = st.multiselect(
+                "要一起產生的文件：", list(MULTI_OUTPUT_TASKS), default=list(MULTI_OUTPUT_TASKS)[:3],
+                help="只上傳與分析一次，由同一份結果產生所有選取的文件，僅消耗一次額度"
+            )
+            task_mode = multi_output_task(selected_outputs) if selected_outputs else task_mode
         
         # 內建模板偵測與覆寫 UI
         custom_template_file = None
-        if task_mode == "簡易開會通知單 (指定格式)":
+        if "簡易開會通知單 (指定格式)" in selected_outputs:
             st.markdown("---")
             st.markdown("##### 📄 模板狀態")
             if tpl_notice_exist:
@@ -600,7 +277,7 @@ def main():
                 st.warning("⚠️ 未偵測到內建模板")
                 custom_template_file = st.file_uploader("請上傳模板 (.docx)", type=['docx'])
         
-        if task_mode == "Memo (指定格式)":
+        if "Memo (指定格式)" in selected_outputs:
             st.markdown("---")
             st.markdown("##### 📄 模板狀態")
             if tpl_memo_exist:
@@ -609,9 +286,15 @@ def main():
                 st.warning("⚠️ 未偵測到內建模板 (Template_Memo.docx)")
                 st.caption("請將模板檔案放入資料夾，否則將使用純文字模式")
 
+        export_format = "xlsx"
+        if "數據提取 (Excel)" in selected_outputs:
+            st.markdown("---")
+            from exporters import available_export_formats
+            export_format = st.selectbox("📑 輸出格式", available_export_formats(), help="CSV / Parquet 檔案較小、產生較快，適合大量資料")
+
         # 條件式補充指令
         user_instruction = ""
-        if task_mode in ["談參", "數據提取 (Excel)", "Memo (指定格式)", "會議紀錄", "簡易開會通知單 (指定格式)"]:
+        if selected_outputs:
             st.markdown("---")
             st.markdown(f"##### ✍️ 特別指示 (選填)")
             hint_text = "例如：請特別著重於... (此指令權重最高)"
@@ -644,23 +327,31 @@ def main():
         
         with col_action:
             if st.button("🚀 開始智慧分析"):
-                if not api_key:
+                if not api_key and llm_backend.billable:
                     st.toast("⚠️ 請先在側邊欄輸入 API Key", icon="🔑")
+                elif not selected_outputs:
+                    st.toast("⚠️ 請至少選擇一種要產生的文件", icon="🧾")
                 else:
-                    result = analyze_content_with_gemini(uploaded_files, task_mode, api_key, user_instruction)
-                    if "error" in result:
-                        st.error(result["error"])
-                    else:
-                        st.session_state['result_data'] = result
-                        if '_meta_info' in result:
-                             st.session_state['meta_info'] = result.pop('_meta_info')
-                        else:
-                             st.session_state['meta_info'] = None
-                        st.rerun()
+                    from job_queue import submit_analysis_job
+                    job_id = submit_analysis_job(uploaded_files, task_mode, api_key, user_instruction, hedge_delay, stream=stream_output, preprocess=preprocess_media_files)
+                    st.session_state['analysis_job_id'] = job_id
+                    st.query_params["job"] = job_id
+                    st.rerun()
+
+    # 進行中的背景工作 (含重新整理或重連後由網址帶回的工作)
+    job_id = st.session_state.get('analysis_job_id') or st.query_params.get("job")
+    if job_id:
+        st.session_state['analysis_job_id'] = job_id
+        render_analysis_job(job_id)
+    if st.session_state.get('analysis_error'):
+        st.error(st.session_state.pop('analysis_error'))
 
     if 'result_data' in st.session_state and st.session_state['result_data']:
         result_data = st.session_state['result_data']
         meta_info = st.session_state.get('meta_info')
+        # 以分析當時的任務呈現 (側邊欄之後切換任務不影響已完成的結果)
+        result_task = st.session_state.get('result_task', task_mode)
+        result_parts = split_multi_output(result_data, result_task)
         
         st.divider()
         st.subheader("📊 分析結果")
@@ -669,25 +360,60 @@ def main():
             m_col1.metric("使用模型", meta_info['model'])
             m_col2.metric("輸入 Token", f"{meta_info['input_tokens']:,}")
             m_col3.metric("輸出 Token", f"{meta_info['output_tokens']:,}")
+            if meta_info.get('ttft_ms') is not None:
+                st.caption(f"⏱️ 首個 token {meta_info['ttft_ms']:,} ms｜總耗時 {meta_info['latency_ms']:,} ms")
+            if meta_info.get('map_reduce'):
+                mr = meta_info['map_reduce']
+                st.caption(f"🧩 內容過長，已分 {mr['chunks']} 段分析後合併 (預估輸入 {mr['estimated_tokens']:,} tokens)")
+            if meta_info.get('extraction', {}).get('files'):
+                ex = meta_info['extraction']
+                token_note = f"、約 {ex['tokens_saved']:,} tokens" if ex.get('tokens_saved') is not None else ""
+                st.caption(f"📝 {ex['files']} 個檔案於本機轉為文字，少傳 {ex['bytes_saved'] / 1024:,.0f} KB{token_note}")
+            if meta_info.get('preprocess', {}).get('files'):
+                pre = meta_info['preprocess']
+                st.caption(f"🗜️ {pre['files']} 個圖片或錄音已先壓縮，少傳 {pre['bytes_saved'] / 1024 / 1024:,.1f} MB (前處理耗時 {pre['seconds']:.1f} 秒，模型耗時 {meta_info.get('latency_ms', 0):,} ms)")
+            if meta_info.get('context_cache', {}).get('name'):
+                cc = meta_info['context_cache']
+                uncached = meta_info['input_tokens'] - meta_info.get('cached_tokens', 0)
+                created = f"，建立快取 {cc['create_ms']:,} ms" if cc['created'] else ""
+                st.caption(f"🧠 context cache 提供 {meta_info.get('cached_tokens', 0):,} tokens，實際重送 {uncached:,} tokens (模型耗時 {meta_info['latency_ms']:,} ms{created})")
+            if meta_info.get('multi_output'):
+                mo = meta_info['multi_output']
+                st.caption(f"🧾 一次分析產出 {len(mo['produced'])} 份文件" + (f"；模型未產出：{'、'.join(mo['missing'])}" if mo['missing'] else ""))
+            if meta_info.get('json_repair', {}).get('repaired'):
+                jr = meta_info['json_repair']
+                st.caption("🩹 模型回應不完整，已於本機修復" + (f"並續寫 {jr['continuations']} 次" if jr['continuations'] else "") + "，未整份重新生成")
+            if meta_info.get('memory'):
+                mem = meta_info['memory']
+                st.caption(f"🧮 分析期間行程峰值 RSS {mem['peak_mb']:,.0f} MB (較開始時 +{mem['delta_mb']:,.0f} MB)")
+            if meta_info.get('cache_hit'):
+                st.caption("⚡ 本次結果來自分析快取，未重新呼叫模型，亦未計入今日用量。")
 
         tab1, tab2, tab3 = st.tabs(["📥 下載產出", "🔍 原始資料 (JSON)", "📋 數據表格"])
 
         with tab1:
+            from exporters import get_output_file, build_output_bundle, get_artifact_cache, create_google_sheet
             st.success("文件已生成！請點擊下方按鈕下載。")
-            if task_mode == "Memo (指定格式)":
-                file_bio, file_name = create_memo_docx(result_data)
-                st.download_button("📥 下載 Memo Word 檔", file_bio, file_name, "application/vnd.openxmlformats-officedocument.wordprocessingml.document", use_container_width=True)
-            elif task_mode == "簡易開會通知單 (指定格式)":
-                file_bio, file_name = create_notice_docx(result_data, custom_template_file)
-                st.download_button("📥 下載 開會通知單 Word 檔", file_bio, file_name, "application/vnd.openxmlformats-officedocument.wordprocessingml.document", use_container_width=True)
-            elif task_mode == "談參":
-                file_bio, file_name = create_talking_points_docx(result_data)
-                st.download_button("📥 下載 談參 Word 檔", file_bio, file_name, "application/vnd.openxmlformats-officedocument.wordprocessingml.document", use_container_width=True)
-            elif task_mode == "數據提取 (Excel)":
-                file_bio, file_name = create_excel(result_data)
-                st.download_button("📥 下載 Excel 數據表", file_bio, file_name, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
-            else:
-                st.download_button("📥 下載文字檔 (.txt)", str(result_data), "result.txt", use_container_width=True)
+            for part_task, part_data in result_parts:
+                part_template = custom_template_file if part_task == "簡易開會通知單 (指定格式)" else None
+                file_bytes, file_name, file_mime, button_label = get_output_file(part_data, part_task, part_template, export_format)
+                st.download_button(button_label, file_bytes, file_name, file_mime, use_container_width=True, key=f"download_{part_task}", on_click="ignore")
+            # ZIP 於點擊時才產生 (伺服器端逐份寫入暫存檔)，不在每次 rerun 預先打包
+            bundle_prefix = next((d.get('filename_prefix') for _, d in result_parts if isinstance(d, dict) and d.get('filename_prefix')), "Export")
+            st.download_button(
+                "📦 全部下載 (ZIP，含原始資料與 manifest)",
+                functools.partial(build_output_bundle, result_parts, result_data, result_task, custom_template_file, export_format, meta_info),
+                f"{bundle_prefix}_{datetime.now().strftime('%m%d_%H%M')}.zip", "application/zip",
+                use_container_width=True, key="download_bundle", on_click="ignore",
+            )
+            artifact_cache = get_artifact_cache()
+            lookups = artifact_cache["hits"] + artifact_cache["misses"]
+            st.caption(
+                f"🧾 文件產生 {artifact_cache['renders']} 次｜下載檔快取命中率 "
+                f"{artifact_cache['hits'] / lookups:.0%}｜快取 {len(artifact_cache['items'])} 份 "
+                f"({artifact_cache['size'] / 1024:.0f} KB)"
+                + (f"｜大型檔案 {len(artifact_cache['files'])} 份存於磁碟 ({artifact_cache['disk_size'] / 1024 / 1024:.0f} MB)" if artifact_cache['files'] else "")
+            )
 
             st.markdown("---")
             if st.button("📤 同步生成 Google Sheet", use_container_width=True):
@@ -698,7 +424,16 @@ def main():
                         stringio = BytesIO(uploaded_key.getvalue())
                         creds_dict = json.load(stringio)
                         with st.spinner("正在建立 Google Sheet..."):
-                            sheet_url, msg = create_google_sheet(result_data, task_mode, creds_dict, user_email)
+                            # 多重輸出：第一份建立 (或附加至指定) 試算表，其餘以文件類型為工作表名稱附加在同一份
+                            sheet_url, msg = sheet_target_url or None, ""
+                            multi = len(result_parts) > 1
+                            for part_task, part_data in result_parts:
+                                worksheet = sheet_target_ws or (part_task if multi and sheet_url else None)
+                                part_url, msg = create_google_sheet(part_data, part_task, creds_dict, user_email, sheet_url, worksheet)
+                                if part_url is None:
+                                    sheet_url = None
+                                    break
+                                sheet_url = part_url
                         if sheet_url:
                             st.success(msg)
                             st.markdown(f"🔗 [點擊開啟 Google Sheet]({sheet_url})")
@@ -711,17 +446,26 @@ def main():
             st.json(result_data)
 
         with tab3:
-            if task_mode == "簡易開會通知單 (指定格式)" and 'agenda_table' in result_data:
-                st.dataframe(pd.DataFrame(result_data['agenda_table'], columns=['時間', '主題', '備註']), use_container_width=True)
-            elif task_mode == "談參" and 'discussion_points' in result_data:
-                st.dataframe(pd.DataFrame(result_data['discussion_points']), use_container_width=True)
-            elif task_mode == "數據提取 (Excel)" and isinstance(result_data, list):
-                st.dataframe(result_data, use_container_width=True)
-            elif task_mode == "Memo (指定格式)" and 'action_items' in result_data:
-                st.caption("辦理事項清單")
-                st.dataframe(pd.DataFrame(result_data['action_items'], columns=['待辦事項']), use_container_width=True)
-            else:
+            import pandas as pd
+            previewed = False
+            for part_task, part_data in result_parts:
+                if len(result_parts) > 1:
+                    st.markdown(f"##### {part_task}")
+                if part_task == "簡易開會通知單 (指定格式)" and 'agenda_table' in part_data:
+                    st.dataframe(pd.DataFrame(part_data['agenda_table'], columns=['時間', '主題', '備註']), use_container_width=True)
+                elif part_task == "談參" and 'discussion_points' in part_data:
+                    st.dataframe(pd.DataFrame(part_data['discussion_points']), use_container_width=True)
+                elif part_task == "數據提取 (Excel)" and isinstance(part_data, list):
+                    st.dataframe(part_data, use_container_width=True)
+                elif part_task == "Memo (指定格式)" and 'action_items' in part_data:
+                    st.caption("辦理事項清單")
+                    st.dataframe(pd.DataFrame(part_data['action_items'], columns=['待辦事項']), use_container_width=True)
+                else:
+                    continue
+                previewed = True
+            if not previewed:
                 st.info("此模式無預覽表格")
 
 if __name__ == "__main__":
     main()
+
@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import analysis
+import exporters
+
+# ==========================================
+# 批次處理：無介面模式，與 app.py 共用 analysis.py 的分析與 exporters.py 的文件產生函數
+#   python batch.py 會議資料夾/ --task 談參 --out 產出/ --workers 4 --rpm 10
+#   python batch.py 會議資料夾/ --task memo,notice,talking-points --out 產出/   (多重輸出：一次分析產出多份)
+#   python batch.py 會議資料夾/ --task 談參 --out 產出/ --bundle               (另打包為 產出/bundle.zip)
+# ==========================================
+TASK_ALIASES = {
+    "memo": "Memo (指定格式)",
+    "notice": "簡易開會通知單 (指定格式)",
+    "talking-points": "談參",
+    "excel": "數據提取 (Excel)",
+    "minutes": "會議紀錄",
+}
+TASK_CHOICES = list(TASK_ALIASES.values())
+SUPPORTED_EXTENSIONS = tuple(analysis.LOCAL_MIME_TYPES.keys())
+RESULTS_MANIFEST = "results.json"
+DEFAULT_BUNDLE_NAME = "bundle.zip"
+
+
+def resolve_task(value):
+    # 別名或完整名稱；以逗號分隔多個文件類型時為多重輸出。不合法時拋出 ValueError
+    tasks = [TASK_ALIASES.get(t.strip(), t.strip()) for t in str(value).split(",") if t.strip()]
+    if not tasks:
+        raise ValueError("請指定任務類型")
+    for task in tasks:
+        if task not in TASK_CHOICES:
+            raise ValueError(f"未知的任務類型：{task}")
+    if len(tasks) == 1:
+        return tasks[0]
+    unsupported = [t for t in tasks if t not in analysis.MULTI_OUTPUT_TASKS]
+    if unsupported:
+        raise ValueError(f"多重輸出不支援：{'、'.join(unsupported)}")
+    return analysis.multi_output_task(tasks)
+
+
+def input_fingerprint(files, user_instruction, task_mode=None, custom_template=None, export_format="xlsx", preprocess=True):
+    # 輸入檔內容、補充指令與影響產出的選項 (任務、模板內容、輸出格式、前處理) 的雜湊；
+    # 續跑時與結果清單比對，任一項改過就重新處理，不沿用舊產出
+    h = hashlib.sha256()
+    for field in (user_instruction or "", task_mode or "", export_format, "preprocess" if preprocess else "raw"):
+        h.update(field.encode("utf-8"))
+        h.update(b"\x00")
+    template = [analysis.LocalFile(custom_template)] if custom_template else []
+    for name, digest in analysis.compute_file_digests(template + [analysis.LocalFile(p) for p in files]):
+        h.update(name.encode("utf-8"))
+        h.update(digest.encode("ascii"))
+    return h.hexdigest()
+
+
+class ConsoleStatus:
+    # 取代 st.status，將分析進度輸出到主控台
+    def __init__(self, item_id):
+        self.item_id = item_id
+
+    def write(self, msg):
+        print(f"[{self.item_id}] {msg}", flush=True)
+
+    def update(self, label=None, **kwargs):
+        if label:
+            self.write(label)
+
+
+class QuietStatus:
+    # 取代 st.status；不輸出任何進度 (壓測與測試共用)
+    def write(self, msg):
+        pass
+
+    def update(self, label=None, **kwargs):
+        pass
+
+
+def collect_items(input_path):
+    # 資料夾：每個檔案為一筆；每個子資料夾內的所有檔案合併為一筆 (多檔分析)
+    # 清單檔 (.json)：[{"id": ..., "files": [...], "task": ..., "instruction": ...}]，路徑相對於清單檔
+    if os.path.isdir(input_path):
+        items = []
+        for entry in sorted(os.scandir(input_path), key=lambda e: e.name):
+            if entry.is_dir():
+                files = sorted(
+                    os.path.join(entry.path, name) for name in os.listdir(entry.path)
+                    if name.lower().endswith(SUPPORTED_EXTENSIONS)
+                )
+                if files:
+                    items.append({"id": entry.name, "files": files})
+            elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                items.append({"id": os.path.splitext(entry.name)[0], "files": [entry.path]})
+        return items
+
+    with open(input_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    items = []
+    for index, entry in enumerate(manifest):
+        item = dict(entry)
+        item.setdefault("id", f"item_{index:04d}")
+        item["files"] = [os.path.join(base_dir, p) for p in entry["files"]]
+        if "task" in item:
+            try:
+                item["task"] = resolve_task(item["task"])
+            except ValueError as e:
+                raise ValueError(f"清單第 {index + 1} 筆 ({item['id']})：{e}")
+        items.append(item)
+    return items
+
+
+def load_results(out_dir):
+    path = os.path.join(out_dir, RESULTS_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("items", {})
+
+
+def save_results(out_dir, results):
+    path = os.path.join(out_dir, RESULTS_MANIFEST)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"updated": time.strftime("%Y-%m-%d %H:%M:%S"), "items": results}, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def is_done(record, out_dir, task_mode=None, fingerprint=None):
+    if not record or record.get("status") != "done":
+        return False
+    # 任務或輸入 (檔案內容、補充指令) 與上次不同時不視為完成
+    if task_mode is not None and record.get("task") != task_mode:
+        return False
+    if fingerprint is not None and record.get("input_hash") != fingerprint:
+        return False
+    return all(os.path.exists(os.path.join(out_dir, name)) for name in record.get("outputs", []))
+
+
+def add_to_bundle(bundle, record, out_dir):
+    # 從輸出資料夾逐塊串流寫入 ZIP，整批再多份也只佔用一個區塊的記憶體
+    for name in record.get("outputs", []):
+        with open(os.path.join(out_dir, name), "rb") as f:
+            bundle.add(name, f, item=record["id"], task=record.get("task"))
+
+
+def process_item(item, task_mode, user_instruction, api_key, out_dir, custom_template=None, export_format="xlsx", preprocess=True):
+    # 在子行程中執行
+    started = time.time()
+    item_id = item["id"]
+    record = {"id": item_id, "files": item["files"], "task": task_mode, "outputs": []}
+    try:
+        record["input_hash"] = input_fingerprint(item["files"], user_instruction, task_mode, custom_template, export_format, preprocess)
+        file_list = [analysis.LocalFile(p) for p in item["files"]]
+        result = analysis.analyze_content_with_gemini(
+            file_list, task_mode, api_key, user_instruction,
+            status_container=ConsoleStatus(item_id), preprocess=preprocess
+        )
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        meta_info = analysis.pop_meta_info(result)
+
+        json_name = f"{item_id}.json"
+        with open(os.path.join(out_dir, json_name), "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+        outputs = [json_name]
+        for part_task, part_data in analysis.split_multi_output(result, task_mode):
+            part_template = custom_template if part_task == "簡易開會通知單 (指定格式)" else None
+            file_bio, file_name, _, _ = exporters.generate_output_file(part_data, part_task, part_template, export_format)
+            output_name = f"{item_id}_{file_name}"
+            file_bio.seek(0)
+            with open(os.path.join(out_dir, output_name), "wb") as f:
+                shutil.copyfileobj(file_bio, f)
+            file_bio.close()
+            outputs.append(output_name)
+
+        record.update(status="done", outputs=outputs, meta=meta_info)
+    except Exception as e:
+        record.update(status="failed", error=str(e))
+    record["elapsed_seconds"] = round(time.time() - started, 2)
+    return record
+
+
+def run_batch(items, task_mode, user_instruction, api_key, out_dir, workers=2, rpm=10, custom_template=None, export_format="xlsx", preprocess=True, bundle_path=None):
+    os.makedirs(out_dir, exist_ok=True)
+    results = load_results(out_dir)
+    # bundle_path：每筆完成即把產出追加進同一個 ZIP，結束時寫入 manifest；先寫暫存檔，完整後才換上
+    bundle_file = open(f"{bundle_path}.tmp", "wb") if bundle_path else None
+    bundle = exporters.OutputBundle(bundle_file) if bundle_file else None
+    todo = []
+    for item in items:
+        record = results.get(item["id"])
+        item_task = item.get("task", task_mode)
+        fingerprint = input_fingerprint(
+            item["files"], item.get("instruction", user_instruction), item_task, custom_template, export_format, preprocess
+        ) if record else None
+        if is_done(record, out_dir, item_task, fingerprint):
+            print(f"[{item['id']}] 已完成，略過", flush=True)
+            if bundle:
+                add_to_bundle(bundle, results[item["id"]], out_dir)
+        else:
+            todo.append(item)
+
+    # 以 rpm 控制送件間隔，並限制同時在途件數，避免一次塞滿佇列
+    min_interval = 60.0 / rpm if rpm else 0.0
+    last_submit = 0.0
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while todo or pending:
+            while todo and len(pending) < workers:
+                wait_seconds = last_submit + min_interval - time.time()
+                if wait_seconds > 0:
+                    time.sleep(wait_seconds)
+                item = todo.pop(0)
+                last_submit = time.time()
+                future = executor.submit(
+                    process_item, item, item.get("task", task_mode), item.get("instruction", user_instruction),
+                    api_key, out_dir, custom_template, export_format, preprocess
+                )
+                pending[future] = item
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {"id": item["id"], "files": item["files"], "status": "failed", "error": str(e), "outputs": []}
+                results[item["id"]] = record
+                save_results(out_dir, results)
+                if bundle and record["status"] == "done":
+                    add_to_bundle(bundle, record, out_dir)
+                mark = "✅" if record["status"] == "done" else "❌"
+                memory = (record.get("meta") or {}).get("memory")
+                rss = f"，峰值 RSS {memory['peak_mb']:,.0f} MB" if memory else ""
+                print(f"[{item['id']}] {mark} {record['status']} ({record.get('elapsed_seconds', 0)}s{rss})", flush=True)
+
+    if bundle:
+        item_ids = [item["id"] for item in items]
+        bundle.close(
+            task=task_mode, items=len(item_ids),
+            failed={i: results[i].get("error") for i in item_ids if results.get(i, {}).get("status") != "done"},
+        )
+        bundle_file.close()
+        os.replace(f"{bundle_path}.tmp", bundle_path)
+        print(f"📦 已打包 {len(bundle.entries)} 個檔案：{bundle_path}", flush=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="行政秘書批次處理 (無介面模式)")
+    parser.add_argument("input", help="輸入資料夾或清單檔 (.json)")
+    parser.add_argument("--task", required=True, help=f"任務類型：{' / '.join(TASK_CHOICES)}，或 {', '.join(TASK_ALIASES)}；以逗號分隔多個文件類型時為多重輸出")
+    parser.add_argument("--out", required=True, help="輸出資料夾 (含 results.json 結果清單)")
+    parser.add_argument("--instruction", default="", help="補充指令")
+    parser.add_argument("--template", default=None, help="開會通知單自訂模板 (.docx)")
+    parser.add_argument("--format", default="xlsx", choices=list(exporters.EXPORT_FORMATS), help="數據提取的輸出格式")
+    parser.add_argument("--no-preprocess", action="store_true", help="不壓縮圖片與錄音，以原檔送出")
+    parser.add_argument("--bundle", nargs="?", const="", default=None, metavar="ZIP", help=f"另將所有產出打包為單一 ZIP (含 manifest.json)；未指定路徑時存為 <out>/{DEFAULT_BUNDLE_NAME}")
+    parser.add_argument("--workers", type=int, default=2, help="同時處理的行程數")
+    parser.add_argument("--rpm", type=float, default=10, help="每分鐘最多送出的分析件數 (0 為不限)")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY", ""), help="Gemini API Key (預設讀取 GEMINI_API_KEY)")
+    args = parser.parse_args(argv)
+
+    try:
+        task_mode = resolve_task(args.task)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.format not in exporters.available_export_formats():
+        parser.error(f"輸出格式 {args.format} 需要額外安裝 pyarrow")
+    if not args.api_key and analysis.get_llm_backend().billable:
+        parser.error("請以 --api-key 或環境變數 GEMINI_API_KEY 提供 API Key")
+
+    bundle_path = None
+    if args.bundle is not None:
+        bundle_path = args.bundle or os.path.join(args.out, DEFAULT_BUNDLE_NAME)
+
+    try:
+        items = collect_items(args.input)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"共 {len(items)} 筆待處理，輸出至 {args.out}", flush=True)
+    results = run_batch(items, task_mode, args.instruction, args.api_key, args.out, args.workers, args.rpm, args.template, args.format, not args.no_preprocess, bundle_path)
+    failed = [r for r in results.values() if r.get("status") != "done"]
+    print(f"完成 {len(results) - len(failed)} 筆，失敗 {len(failed)} 筆", flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import argparse
+import fnmatch
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+from common import REPO_ROOT, load_baseline, save_baseline, median, compare_to_baseline
+
+# ==========================================
+# 熱路徑基準：文件產生 (Memo / 開會通知單 / 談參 / Excel) 與 docx 文字擷取
+#   python benchmarks/bench_hotpaths.py                    與基準比較，退步時回傳非零
+#   python benchmarks/bench_hotpaths.py --only 'notice*'   只跑符合的項目
+#   python benchmarks/bench_hotpaths.py --update-baseline
+# 全程離線：使用專案內附的 Template_Memo.docx / Template_Notice.docx，資料皆為固定亂數種子合成
+# ==========================================
+BASELINE_NAME = "hotpaths"
+SEED = 20240501
+
+sys.path.insert(0, REPO_ROOT)
+
+
+def _text(rng, min_len, max_len):
+    # 合成中文字串 (常用字區段)，長度落在 [min_len, max_len]
+    return "".join(chr(rng.randint(0x4E00, 0x62FF)) for _ in range(rng.randint(min_len, max_len)))
+
+
+def make_memo(rng, items):
+    return {
+        "time": "113年12月25日 14:00",
+        "location": "第一會議室",
+        "method": "□電話 □活動 ■會議 □公文批示 □其他",
+        "official": "■部長 □次長 □主任秘書 □立法委員 □其他：",
+        "meeting_name": _text(rng, 8, 16),
+        "chair": _text(rng, 2, 4),
+        "attendees": "、".join(_text(rng, 2, 4) for _ in range(12)),
+        "related_dept": _text(rng, 4, 8),
+        "guest_dept": _text(rng, 4, 8),
+        "conclusions": [_text(rng, 30, 80) for _ in range(items)],
+        "action_items": [_text(rng, 20, 60) for _ in range(items)],
+        "note": "□請回電話 □請惠處 ■請參酌 □其他",
+        "filename_prefix": "Bench_Memo",
+    }
+
+
+def make_notice(rng, rows):
+    return {
+        "date": "113年12月25日",
+        "dept": "政策規劃組",
+        "reason": _text(rng, 10, 30),
+        "full_time": "113年12月30日(星期二) 下午 4:00 - 5:00",
+        "location": "第一會議室",
+        "host": _text(rng, 2, 4),
+        "attendees": "詳如簽到表",
+        "note": _text(rng, 50, 150),
+        "agenda_table": [[f"{9 + i // 60:02d}:{i % 60:02d}", _text(rng, 6, 20), _text(rng, 0, 10)] for i in range(rows)],
+        "filename_prefix": "Bench_Notice",
+    }
+
+
+def make_talking_points(rng, points):
+    return {
+        "title": _text(rng, 8, 16),
+        "background": [_text(rng, 40, 100) for _ in range(2)],
+        "discussion_points": [{"subtitle": _text(rng, 5, 10), "content": _text(rng, 50, 100)} for _ in range(points)],
+        "unit_opinion": _text(rng, 150, 300),
+        "filename_prefix": "Bench_TalkingPoints",
+    }
+
+
+def make_rows(rng, rows):
+    return [
+        {"項目": _text(rng, 4, 12), "數量": rng.randint(0, 10000), "金額": round(rng.uniform(0, 1e6), 2),
+         "單位": _text(rng, 2, 6), "備註": _text(rng, 0, 30)}
+        for _ in range(rows)
+    ]
+
+
+def make_docx(rng, target_bytes, paragraphs):
+    # 文字段落 + 表格，再以一張無法壓縮的雜訊圖片把檔案撐到目標大小 (模擬含大量圖片的實際公文)
+    from docx import Document
+    from PIL import Image
+    doc = Document()
+    for _ in range(paragraphs):
+        doc.add_paragraph(_text(rng, 40, 200))
+    table = doc.add_table(rows=20, cols=4)
+    for row in table.rows:
+        for cell in row.cells:
+            cell.text = _text(rng, 2, 10)
+    bio = BytesIO()
+    doc.save(bio)
+    pad = target_bytes - bio.tell()
+    if pad > 0:
+        side = max(int(pad ** 0.5), 1)
+        noise = Image.frombytes("L", (side, side), rng.randbytes(side * side))
+        image_bio = BytesIO()
+        noise.save(image_bio, format="PNG", compress_level=0)
+        image_bio.seek(0)
+        doc.add_picture(image_bio)
+        bio = BytesIO()
+        doc.save(bio)
+    return bio.getvalue()
+
+
+def build_cases(analysis, exporters):
+    rng = random.Random(SEED)
+    return [
+        ("memo_5_items", exporters.create_memo_docx, (make_memo(rng, 5),)),
+        ("memo_500_items", exporters.create_memo_docx, (make_memo(rng, 500),)),
+        ("notice_10_rows", exporters.create_notice_docx, (make_notice(rng, 10),)),
+        ("notice_5000_rows", exporters.create_notice_docx, (make_notice(rng, 5000),)),
+        ("talking_points_5_points", exporters.create_talking_points_docx, (make_talking_points(rng, 5),)),
+        ("talking_points_500_points", exporters.create_talking_points_docx, (make_talking_points(rng, 500),)),
+        # 相同資料改走 python-docx 引擎，對照直接輸出 OOXML 的差距
+        ("talking_points_5_points_python_docx", exporters.create_talking_points_docx_python_docx, (make_talking_points(random.Random(SEED + 1), 5),)),
+        ("talking_points_500_points_python_docx", exporters.create_talking_points_docx_python_docx, (make_talking_points(random.Random(SEED + 2), 500),)),
+        ("excel_10_rows", exporters.create_excel, (make_rows(rng, 10),)),
+        ("excel_5000_rows", exporters.create_excel, (make_rows(rng, 5000),)),
+        ("extract_docx_1mb", analysis.extract_docx_text, (make_docx(rng, 1024 * 1024, 200),)),
+        ("extract_docx_50mb", analysis.extract_docx_text, (make_docx(rng, 50 * 1024 * 1024, 2000),)),
+    ]
+
+
+def measure(fn, args, runs):
+    fn(*args)   # 暖身：排除模板編譯等一次性成本
+    timings = []
+    for _ in range(runs):
+        gc.collect()
+        started = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - started)
+
+    # 記憶體另跑一次 (tracemalloc 本身會拖慢執行，不與計時混用)
+    # net_alloc_blocks 為執行前後快照的差異 (結束時仍存活的新配置區塊數)，會隨直譯器內部快取與 GC 時機浮動，
+    # 只列出供對照，不寫入基準、不列入退步判定；記憶體的判定以峰值為準
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    del result
+    return {"seconds": median(timings), "peak_mb": peak / (1024 * 1024), "net_alloc_blocks": blocks}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="文件產生與擷取熱路徑基準")
+    parser.add_argument("--runs", type=int, default=5, help="每項計時的重複次數 (取中位數)")
+    parser.add_argument("--only", default="*", help="只跑名稱符合此樣式的項目 (fnmatch)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="執行時間允許高於基準的比例")
+    parser.add_argument("--min-delta", type=float, default=0.02, help="執行時間差距小於此秒數時不視為退步")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10, help="峰值記憶體允許高於基準的比例")
+    parser.add_argument("--update-baseline", action="store_true", help="以本次結果覆寫基準 (與既有基準合併)")
+    args = parser.parse_args(argv)
+
+    os.chdir(REPO_ROOT)   # 文件產生以相對路徑讀取模板
+    import analysis
+    import exporters
+
+    print("產生合成資料…", flush=True)
+    cases = [case for case in build_cases(analysis, exporters) if fnmatch.fnmatch(case[0], args.only)]
+    time_metrics, memory_metrics = {}, {}
+    print(f"{'項目':<28} {'時間 (s)':>10} {'峰值 (MB)':>10} {'存活區塊':>10}")
+    for name, fn, fn_args in cases:
+        result = measure(fn, fn_args, args.runs)
+        time_metrics[f"{name}.seconds"] = result["seconds"]
+        memory_metrics[f"{name}.peak_mb"] = result["peak_mb"]
+        print(f"{name:<30} {result['seconds']:>10.4f} {result['peak_mb']:>10.2f} {result['net_alloc_blocks']:>10}", flush=True)
+
+    baseline = load_baseline(BASELINE_NAME)
+    if args.update_baseline:
+        baseline.update(time_metrics)
+        baseline.update(memory_metrics)
+        print(f"已更新基準：{save_baseline(BASELINE_NAME, baseline)}")
+        return 0
+
+    if not baseline:
+        print("⚠️ 尚無基準，請先以 --update-baseline 建立")
+        return 0
+    print("執行時間：")
+    regressions = compare_to_baseline(time_metrics, baseline, args.tolerance, args.min_delta)
+    print("記憶體：")
+    regressions += compare_to_baseline(memory_metrics, baseline, args.memory_tolerance)
+    if regressions:
+        print(f"❌ 效能退步：{', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import argparse
+import json
+import subprocess
+import sys
+
+from common import REPO_ROOT, load_baseline, save_baseline, median, compare_to_baseline
+
+# ==========================================
+# 冷啟動基準：每次都在全新的 Python 行程中量測
+#   python benchmarks/bench_startup.py                 與基準比較，退步時回傳非零
+#   python benchmarks/bench_startup.py --update-baseline
+# ==========================================
+BASELINE_NAME = "startup"
+# 開啟頁面時不應載入的套件 (應延遲到分析、產出或同步 Sheet 時才匯入)
+LAZY_MODULES = ["google.generativeai", "gspread", "google.oauth2", "pandas", "docx", "docxtpl", "job_queue", "exporters"]
+
+IMPORT_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import app
+elapsed = time.perf_counter() - t
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+RENDER_PROBE = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+t = time.perf_counter()
+at = AppTest.from_file("app.py", default_timeout=120)
+at.run()
+elapsed = time.perf_counter() - t
+print(json.dumps({"seconds": elapsed, "exceptions": len(at.exception), "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def run_probe(code):
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="app.py 冷啟動與首次渲染基準")
+    parser.add_argument("--runs", type=int, default=5, help="每項量測的重複次數 (取中位數)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允許高於基準的比例")
+    parser.add_argument("--update-baseline", action="store_true", help="以本次結果覆寫基準")
+    args = parser.parse_args(argv)
+
+    imports = [run_probe(IMPORT_PROBE) for _ in range(args.runs)]
+    renders = [run_probe(RENDER_PROBE) for _ in range(args.runs)]
+    metrics = {
+        "import_app_seconds": median([r["seconds"] for r in imports]),
+        "first_render_seconds": median([r["seconds"] for r in renders]),
+    }
+    eager = sorted(set(imports[0]["loaded"]) | set(renders[0]["loaded"]))
+    render_errors = renders[0]["exceptions"]
+
+    print(f"import app：{metrics['import_app_seconds']:.3f} s (中位數，{args.runs} 次)")
+    print(f"首次渲染：{metrics['first_render_seconds']:.3f} s (中位數，{args.runs} 次)")
+
+    if args.update_baseline:
+        print(f"已更新基準：{save_baseline(BASELINE_NAME, metrics)}")
+        return 0
+
+    failed = False
+    if eager:
+        print(f"❌ 啟動時即載入了應延遲匯入的套件：{', '.join(eager)}")
+        failed = True
+    if render_errors:
+        print(f"❌ 首次渲染發生 {render_errors} 個例外")
+        failed = True
+    regressions = compare_to_baseline(metrics, load_baseline(BASELINE_NAME), args.tolerance)
+    if regressions:
+        print(f"❌ 效能退步：{', '.join(regressions)}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import json
+import os
+import statistics
+
+# ==========================================
+# 效能基準共用工具：基準值讀寫與退步判定
+# ==========================================
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def load_baseline(name):
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(name, metrics):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(metrics, f, ensure_ascii=False, indent=4, sort_keys=True)
+        f.write("\n")
+    return path
+
+
+def median(values):
+    return statistics.median(values) if values else 0.0
+
+
+def compare_to_baseline(metrics, baseline, tolerance, min_delta=0.0):
+    # 回傳退步清單；數值超過 基準 x (1 + tolerance) 且差距大於 min_delta 視為退步，基準中沒有的項目略過
+    # (min_delta 避免毫秒級的小項目因計時雜訊誤判)
+    regressions = []
+    for key, value in sorted(metrics.items()):
+        base = baseline.get(key)
+        if not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or base <= 0:
+            continue
+        limit = max(base * (1 + tolerance), base + min_delta)
+        status = "REGRESSION" if value > limit else "ok"
+        print(f"  {key:<48} {value:>12.4f}  (基準 {base:.4f}, 上限 {limit:.4f})  {status}")
+        if value > limit:
+            regressions.append(key)
+    return regressions
@@ -0,0 +1,122 @@
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from common import REPO_ROOT
+
+# ==========================================
+# 離線壓測：以 stub 後端模擬模型，量測吞吐、備援行為與端到端延遲 (分析 + 文件產生)
+#   python benchmarks/loadtest_backend.py --requests 200 --concurrency 16 --task talking-points
+#   python benchmarks/loadtest_backend.py --rate-limit-rate 0.2 --failing-models gemini-2.5-flash
+# 不連網、不需 API Key，也不寫入用量帳本與分析快取
+# ==========================================
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def run_one(batch, index, task_mode, hedge_delay, stream, render):
+    analysis, exporters = batch.analysis, batch.exporters
+    file_list = [analysis.MemoryFile(f"request_{index:05d}.txt", "text/plain", f"第 {index} 號會議紀錄草稿。".encode("utf-8") * 200)]
+    started = time.perf_counter()
+    result = analysis.analyze_content_with_gemini(
+        file_list, task_mode, "", hedge_delay=hedge_delay, status_container=batch.QuietStatus(), stream=stream
+    )
+    analyzed = time.perf_counter()
+    if "error" in result:
+        return {"ok": False, "error": result["error"], "seconds": analyzed - started}
+    meta = analysis.pop_meta_info(result)
+    render_seconds = 0.0
+    if render:
+        # 與 app 相同：多重輸出拆成各份文件分別產生
+        for part_task, part_data in analysis.split_multi_output(result, task_mode):
+            file_bio, _, _, _ = exporters.generate_output_file(part_data, part_task)
+            file_bio.close()
+        render_seconds = time.perf_counter() - analyzed
+    return {
+        "ok": True,
+        "model": meta["model"] if meta else "—",
+        "seconds": time.perf_counter() - started,
+        "render_seconds": render_seconds,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="stub 後端離線壓測")
+    parser.add_argument("--requests", type=int, default=100, help="總請求數")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時進行的請求數")
+    parser.add_argument("--task", default="talking-points", help="任務類型：與 batch.py --task 相同，別名或完整名稱；逗號分隔為多重輸出")
+    parser.add_argument("--latency", type=float, default=None, help="模擬平均延遲秒數 (STUB_LATENCY_SECONDS)")
+    parser.add_argument("--jitter", type=float, default=None, help="延遲隨機浮動秒數 (STUB_LATENCY_JITTER)")
+    parser.add_argument("--error-rate", type=float, default=None, help="一般錯誤機率 (STUB_ERROR_RATE)")
+    parser.add_argument("--rate-limit-rate", type=float, default=None, help="429 機率 (STUB_RATE_LIMIT_RATE)")
+    parser.add_argument("--truncate-rate", type=float, default=None, help="回應中途截斷的機率 (STUB_TRUNCATE_RATE)")
+    parser.add_argument("--failing-models", default=None, help="一律失敗的模型，逗號分隔 (STUB_FAILING_MODELS)")
+    parser.add_argument("--hedge", type=float, default=None, help="啟用併發備援並設定等待秒數")
+    parser.add_argument("--stream", action="store_true", help="以串流模式呼叫")
+    parser.add_argument("--no-render", action="store_true", help="只量測分析，不產生文件")
+    parser.add_argument("--quotas", action="store_true", help="套用 MODEL_QUOTAS 配額限流 (預設不限，只量測後端本身)")
+    args = parser.parse_args(argv)
+
+    # 後端設定於匯入 batch / analysis 時讀取
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    for flag, env_name in (("latency", "STUB_LATENCY_SECONDS"), ("jitter", "STUB_LATENCY_JITTER"),
+                           ("error_rate", "STUB_ERROR_RATE"), ("rate_limit_rate", "STUB_RATE_LIMIT_RATE"),
+                           ("truncate_rate", "STUB_TRUNCATE_RATE"), ("failing_models", "STUB_FAILING_MODELS")):
+        if getattr(args, flag) is not None:
+            os.environ[env_name] = str(getattr(args, flag))
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    import batch
+    import model_router
+
+    analysis = batch.analysis
+    try:
+        task_mode = batch.resolve_task(args.task)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not args.quotas:
+        for model_name in model_router.MODEL_PRIORITY_LIST:
+            model_router.MODEL_QUOTAS[model_name] = {"rpm": 10 ** 6, "tpm": 10 ** 12, "rpd": 10 ** 9}
+    print(f"後端 {analysis.get_llm_backend().name}｜{args.requests} 筆 x 併發 {args.concurrency}｜任務 {task_mode}", flush=True)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda i: run_one(batch, i, task_mode, args.hedge, args.stream, not args.no_render), range(args.requests)
+        ))
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["seconds"] for r in ok]
+    print(f"完成 {len(ok)} / {len(results)} 筆，耗時 {elapsed:.2f} s，吞吐 {len(ok) / elapsed:.2f} req/s")
+    print(f"端到端延遲：p50 {percentile(latencies, 50):.3f} s｜p95 {percentile(latencies, 95):.3f} s｜最大 {max(latencies, default=0):.3f} s")
+    if not args.no_render:
+        renders = [r["render_seconds"] for r in ok]
+        print(f"文件產生：p50 {percentile(renders, 50) * 1000:.1f} ms｜p95 {percentile(renders, 95) * 1000:.1f} ms")
+    models = Counter(r["model"] for r in ok)
+    primary = model_router.MODEL_PRIORITY_LIST[0]
+    print("採用模型：" + "、".join(f"{m} {n}" for m, n in models.most_common()))
+    print(f"備援比例：{1 - models.get(primary, 0) / len(ok):.1%}" if ok else "備援比例：—")
+    repair = analysis.get_json_repair_stats()
+    if repair["repaired"] or repair["failed"]:
+        print(f"JSON 修復：省下 {repair['repaired']} 次重新生成 (續寫 {repair['continuations']} 次)｜無法修復 {repair['failed']} 次")
+    memory = analysis.get_memory_stats()
+    if memory["requests"]:
+        print(f"峰值 RSS：{memory['peak_rss_mb']:,.0f} MB｜單次分析期間最多增加 {memory['max_delta_mb']:,.0f} MB")
+    errors = Counter(r["error"] for r in results if not r["ok"])
+    for error, count in errors.most_common(5):
+        print(f"❌ {count} 筆：{error}")
+    open_circuits = [m for m in model_router.MODEL_PRIORITY_LIST if model_router.is_circuit_open(m)]
+    if open_circuits:
+        print(f"🔌 結束時仍斷路：{', '.join(open_circuits)}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
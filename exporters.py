@@ -0,0 +1,855 @@
+import copy
+import functools
+from collections import OrderedDict
+from io import BytesIO
+import json
+import os
+import hashlib
+import time
+import re
+import io
+import csv
+import tempfile
+import shutil
+import importlib.util
+import random
+import threading
+from datetime import datetime
+
+import streamlit as st
+
+from tracing import trace_span
+
+# ==========================================
+# 5. 檔案生成函數
+# ==========================================
+def set_chinese_font(run, font_name='標楷體', size_pt=12):
+    from docx.shared import Pt
+    from docx.oxml.ns import qn
+    run.font.name = 'Times New Roman'
+    run.font.size = Pt(size_pt)
+    r = run._element
+    r.rPr.rFonts.set(qn('w:eastAsia'), font_name)
+
+# --- 模板快取：每個行程只解壓、解析模板一次，每次套印只複製預先解析好的文件 ---
+TEMPLATE_REGISTRY_MAX_ENTRIES = 16   # 含使用者上傳的自訂模板 (依內容雜湊快取)
+
+@st.cache_resource
+def get_template_registry():
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def _build_template_entry(label, raw, sha, mtime=None):
+    from docxtpl import DocxTemplate  # 核心：用於模板填充
+    from jinja2 import Environment
+    started = time.perf_counter()
+    base_docx = DocxTemplate(BytesIO(raw))
+    base_docx.init_docx()
+    patch_cache = {}
+    compiled_cache = {}
+    jinja_env = Environment()
+    plain_from_string = jinja_env.from_string
+
+    # docxtpl 每次套印都會重新清理 XML 並重新編譯 Jinja 模板；同一模板的結果固定，快取重用
+    def cached_from_string(source, *args, **kwargs):
+        template = compiled_cache.get(source)
+        if template is None:
+            template = compiled_cache[source] = plain_from_string(source, *args, **kwargs)
+        return template
+    jinja_env.from_string = cached_from_string
+
+    return {
+        "label": label,
+        "sha": sha,
+        "mtime": mtime,
+        "raw": raw,
+        "base_docx": base_docx.docx,
+        "patch_cache": patch_cache,
+        "jinja_env": jinja_env,
+        "load_ms": (time.perf_counter() - started) * 1000,
+        "renders": 0,
+        "render_ms_total": 0.0,
+    }
+
+# template 可為檔案路徑，或具 getvalue()/read() 的上傳檔案物件 (依內容雜湊快取)
+def get_compiled_template(template):
+    registry = get_template_registry()
+    if isinstance(template, str):
+        stat_info = os.stat(template)
+        key = f"path:{os.path.abspath(template)}"
+        mtime = (stat_info.st_mtime_ns, stat_info.st_size)
+        with registry["lock"]:
+            entry = registry["entries"].get(key)
+            if entry and entry["mtime"] == mtime:
+                registry["entries"].move_to_end(key)
+                return entry
+        with open(template, "rb") as f:
+            raw = f.read()
+        label = os.path.basename(template)
+    else:
+        raw = template.getvalue() if hasattr(template, "getvalue") else template.read()
+        key = mtime = None
+        label = getattr(template, "name", "custom_template.docx")
+
+    sha = hashlib.sha256(raw).hexdigest()
+    key = key or f"sha:{sha}"
+    with registry["lock"]:
+        entry = registry["entries"].get(key)
+        if entry and entry["sha"] == sha:
+            entry["mtime"] = mtime
+            registry["entries"].move_to_end(key)
+            return entry
+    entry = _build_template_entry(label, raw, sha, mtime)
+    with registry["lock"]:
+        registry["entries"][key] = entry
+        while len(registry["entries"]) > TEMPLATE_REGISTRY_MAX_ENTRIES:
+            registry["entries"].popitem(last=False)
+    return entry
+
+def render_compiled_template(entry, context):
+    from docxtpl import DocxTemplate
+    started = time.perf_counter()
+    doc = DocxTemplate(BytesIO(entry["raw"]))
+    doc.docx = copy.deepcopy(entry["base_docx"])
+    plain_patch_xml = doc.patch_xml
+    patch_cache = entry["patch_cache"]
+
+    def cached_patch_xml(src_xml):
+        patched = patch_cache.get(src_xml)
+        if patched is None:
+            patched = patch_cache[src_xml] = plain_patch_xml(src_xml)
+        return patched
+    doc.patch_xml = cached_patch_xml
+
+    with trace_span("template.render", template=entry["label"]):
+        doc.render(context, entry["jinja_env"])
+    bio = BytesIO()
+    with trace_span("docx.save", template=entry["label"]):
+        doc.save(bio)
+    bio.seek(0)
+    entry["renders"] += 1
+    entry["render_ms_total"] += (time.perf_counter() - started) * 1000
+    return bio
+
+# --- Memo (模板模式 + 舊版備援) ---
+def create_memo_docx_legacy(data):
+    from docx import Document
+    from docx.shared import Pt
+    from docx.oxml.ns import qn
+    doc = Document()
+    style = doc.styles['Normal']
+    style.font.name = 'Times New Roman'
+    style.element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
+    style.font.size = Pt(12)
+    doc.add_paragraph("⚠️ (備援模式) 未偵測到 Template_Memo.docx，僅列出純文字內容。")
+    doc.add_paragraph(f"時間：{data.get('time', '')}")
+    doc.add_paragraph(f"內容：\n{data.get('conclusions', '')}")
+    bio = BytesIO()
+    doc.save(bio)
+    bio.seek(0)
+    return bio, "Legacy_Memo.docx"
+
+def create_memo_docx(data):
+    default_template_path = "Template_Memo.docx"
+    if not os.path.exists(default_template_path):
+        return create_memo_docx_legacy(data)
+    try:
+        template = get_compiled_template(default_template_path)
+        context = {
+            'time': data.get('time', ''),
+            'location': data.get('location', ''),
+            'method': data.get('method', ''),     
+            'official': data.get('official', ''), 
+            'meeting_name': data.get('meeting_name', ''),
+            'chair': data.get('chair', ''),
+            'attendees': data.get('attendees', ''),
+            'related_dept': data.get('related_dept', ''),
+            'guest_dept': data.get('guest_dept', ''),
+            'conclusions': data.get('conclusions', []), 
+            'action_items': data.get('action_items', []),
+            'note': data.get('note', ''),
+            'filename_prefix': data.get('filename_prefix', 'Memo')
+        }
+        bio = render_compiled_template(template, context)
+        return bio, f"{context['filename_prefix']}.docx"
+    except Exception as e:
+        st.error(f"❌ Memo 模板生成失敗: {str(e)}")
+        return create_memo_docx_legacy(data)
+
+# --- 開會通知單 (模板模式 + 舊版備援) ---
+def create_notice_docx_legacy(data):
+    from docx import Document
+    doc = Document()
+    doc.add_paragraph("⚠️ 錯誤：找不到模板檔案，且已切換至備援模式。")
+    bio = BytesIO()
+    doc.save(bio)
+    bio.seek(0)
+    return bio, "Legacy_Notice.docx"
+
+def create_notice_docx(data, custom_template=None):
+    default_template_path = "Template_Notice.docx" 
+    template = None
+    if custom_template:
+        template = get_compiled_template(custom_template)
+    elif os.path.exists(default_template_path):
+        template = get_compiled_template(default_template_path)
+    else:
+        return create_notice_docx_legacy(data)
+    try:
+        agenda_list = []
+        if 'agenda_table' in data and isinstance(data['agenda_table'], list):
+            for item in data['agenda_table']:
+                col1 = str(item[0]) if len(item) > 0 else ""
+                col2 = str(item[1]) if len(item) > 1 else ""
+                col3 = str(item[2]) if len(item) > 2 else ""
+                agenda_list.append({'col1': col1, 'col2': col2, 'col3': col3})
+
+        context = {
+            'date': data.get('date', ''),
+            'dept': data.get('dept', ''),
+            'reason': data.get('reason', ''),
+            'full_time': data.get('full_time', ''),
+            'location': data.get('location', ''),
+            'host': data.get('host', ''),
+            'attendees': data.get('attendees', ''),
+            'summary': data.get('note', ''),
+            'agenda_table': agenda_list, 
+            'filename_prefix': data.get('filename_prefix', 'MeetingNotice')
+        }
+        bio = render_compiled_template(template, context)
+        return bio, f"{context['filename_prefix']}.docx"
+    except Exception as e:
+        st.error(f"❌ 模板生成失敗: {str(e)}")
+        return create_notice_docx_legacy(data)
+
+# --- 談參 (維持 Code 模式) ---
+# 預設以 ooxml 引擎直接輸出 document.xml；python-docx 引擎逐段逐 run 建立物件，保留作為對照與備援
+TALKING_POINTS_ENGINE = os.environ.get("TALKING_POINTS_ENGINE", "ooxml")   # ooxml / python-docx
+
+def create_talking_points_docx(data):
+    if TALKING_POINTS_ENGINE == "ooxml":
+        try:
+            return create_talking_points_docx_ooxml(data)
+        except Exception as e:
+            # 任何資料或套件問題都改走 python-docx，不讓快速路徑擋住下載
+            st.warning(f"⚠️ 談參快速套印失敗，改用 python-docx：{e}")
+    return create_talking_points_docx_python_docx(data)
+
+def _discussion_point_runs(item):
+    # 回傳 (粗體小標, 內容)；模型偶爾把討論重點輸出成純字串，視為沒有小標的內容
+    if not isinstance(item, dict):
+        return None, str(item) if item not in (None, "") else None
+    subtitle = f"【{item['subtitle']}】" if item.get('subtitle') else None
+    content = f"：{item['content']}" if item.get('content') else None
+    return subtitle, content
+
+def create_talking_points_docx_python_docx(data):
+    from docx import Document
+    from docx.shared import Pt
+    from docx.oxml.ns import qn
+    from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+    doc = Document()
+    style = doc.styles['Normal']
+    style.font.name = 'Times New Roman'
+    style.element.rPr.rFonts.set(qn('w:eastAsia'), '標楷體')
+    style.font.size = Pt(12)
+    
+    p_title = doc.add_paragraph()
+    r_title = p_title.add_run(data.get('title', '談參資料'))
+    r_title.bold = True
+    set_chinese_font(r_title, size_pt=18)
+    p_title.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    doc.add_paragraph("-" * 30).alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+
+    if data.get('background'):
+        p_h1 = doc.add_paragraph()
+        r_h1 = p_h1.add_run("一、背景說明")
+        r_h1.bold = True
+        set_chinese_font(r_h1, size_pt=14)
+        for item in data['background']:
+            p = doc.add_paragraph(style='List Bullet')
+            set_chinese_font(p.add_run(item))
+
+    if data.get('discussion_points'):
+        p_h2 = doc.add_paragraph()
+        r_h2 = p_h2.add_run("二、討論重點")
+        r_h2.bold = True
+        set_chinese_font(r_h2, size_pt=14)
+        for item in data['discussion_points']:
+            p = doc.add_paragraph(style='List Number')
+            subtitle, content = _discussion_point_runs(item)
+            if subtitle:
+                r_sub = p.add_run(subtitle)
+                r_sub.bold = True
+                set_chinese_font(r_sub)
+            if content:
+                r_con = p.add_run(content)
+                set_chinese_font(r_con)
+
+    if data.get('unit_opinion'):
+        p_h3 = doc.add_paragraph()
+        r_h3 = p_h3.add_run("三、單位意見")
+        r_h3.bold = True
+        set_chinese_font(r_h3, size_pt=14)
+        p_op = doc.add_paragraph()
+        p_op.paragraph_format.first_line_indent = Pt(24)
+        set_chinese_font(p_op.add_run(data['unit_opinion']))
+
+    bio = BytesIO()
+    with trace_span("docx.save", template="談參"):
+        doc.save(bio)
+    bio.seek(0)
+    return bio, f"{data.get('filename_prefix', 'TalkingPoints')}.docx"
+
+# 以 python-docx 內建的空白文件為底 (與 python-docx 引擎相同的樣式、編號與版面)：
+# 字型只在 styles.xml 的 Normal 樣式定義一次，段落不再逐 run 設定；
+# document.xml 以外的組件預先壓縮成 zip，每次套印只複製這份 zip 再附加 document.xml
+TALKING_POINTS_NORMAL_RPR = '<w:rPr><w:rFonts w:ascii="Times New Roman" w:hAnsi="Times New Roman" w:eastAsia="標楷體"/><w:sz w:val="24"/></w:rPr>'
+_TP_TITLE = '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:rPr><w:b/><w:sz w:val="36"/></w:rPr>{}</w:r></w:p>'
+_TP_RULE = '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:t>' + "-" * 30 + '</w:t></w:r></w:p>'
+_TP_HEADING = '<w:p><w:r><w:rPr><w:b/><w:sz w:val="28"/></w:rPr>{}</w:r></w:p>'
+_TP_BULLET = '<w:p><w:pPr><w:pStyle w:val="ListBullet"/></w:pPr><w:r>{}</w:r></w:p>'
+_TP_NUMBERED = '<w:p><w:pPr><w:pStyle w:val="ListNumber"/></w:pPr>{}</w:p>'
+_TP_BOLD_RUN = '<w:r><w:rPr><w:b/></w:rPr>{}</w:r>'
+_TP_RUN = '<w:r>{}</w:r>'
+_TP_INDENTED = '<w:p><w:pPr><w:ind w:firstLine="480"/></w:pPr><w:r>{}</w:r></w:p>'
+_XML_INVALID_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+@st.cache_resource
+def get_talking_points_skeleton():
+    import zipfile
+    spec = importlib.util.find_spec("docx")
+    path = os.path.join(spec.submodule_search_locations[0], "templates", "default.docx")
+    package = BytesIO()
+    document_xml = None
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(package, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            data = src.read(info.filename)
+            if info.filename == "word/document.xml":
+                document_xml = data.decode("utf-8")
+                continue
+            if info.filename == "word/styles.xml":
+                data, patched = re.subn(
+                    r'(<w:style [^>]*w:styleId="Normal"[^>]*>.*?)(</w:style>)',
+                    lambda m: m.group(1) + TALKING_POINTS_NORMAL_RPR + m.group(2),
+                    data.decode("utf-8"), count=1, flags=re.S,
+                )
+                if not patched:
+                    raise ValueError("內建空白文件缺少 Normal 樣式")
+                data = data.encode("utf-8")
+            dst.writestr(info.filename, data)
+    if document_xml is None:
+        raise KeyError("word/document.xml")
+    head, sect_tag, tail = document_xml.partition("<w:sectPr")
+    return {"package": package.getvalue(), "head": head, "tail": sect_tag + tail}
+
+def _ooxml_text(value):
+    # 對應 python-docx 的 run.text：換行轉為 <w:br/>、Tab 轉為 <w:tab/>；XML 不允許的控制字元直接移除
+    text = _XML_INVALID_CHARS.sub("", str(value))
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    text = re.sub(r"\r\n?|\n", '</w:t><w:br/><w:t xml:space="preserve">', text).replace("\t", '</w:t><w:tab/><w:t xml:space="preserve">')
+    return f'<w:t xml:space="preserve">{text}</w:t>'
+
+def create_talking_points_docx_ooxml(data):
+    import zipfile
+    skeleton = get_talking_points_skeleton()
+    body = [_TP_TITLE.format(_ooxml_text(data.get('title', '談參資料'))), _TP_RULE]
+    if data.get('background'):
+        body.append(_TP_HEADING.format(_ooxml_text("一、背景說明")))
+        body.extend(_TP_BULLET.format(_ooxml_text(item)) for item in data['background'])
+    if data.get('discussion_points'):
+        body.append(_TP_HEADING.format(_ooxml_text("二、討論重點")))
+        for item in data['discussion_points']:
+            runs = ""
+            subtitle, content = _discussion_point_runs(item)
+            if subtitle:
+                runs += _TP_BOLD_RUN.format(_ooxml_text(subtitle))
+            if content:
+                runs += _TP_RUN.format(_ooxml_text(content))
+            body.append(_TP_NUMBERED.format(runs))
+    if data.get('unit_opinion'):
+        body.append(_TP_HEADING.format(_ooxml_text("三、單位意見")))
+        body.append(_TP_INDENTED.format(_ooxml_text(data['unit_opinion'])))
+
+    bio = BytesIO()
+    with trace_span("docx.save", template="談參", engine="ooxml"):
+        bio.write(skeleton["package"])
+        with zipfile.ZipFile(bio, "a", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("word/document.xml", "".join((skeleton["head"], *body, skeleton["tail"])))
+    bio.seek(0)
+    return bio, f"{data.get('filename_prefix', 'TalkingPoints')}.docx"
+
+# --- Excel & Sheets ---
+# 數據提取結果直接由 list[dict] 逐列寫出 (不經 pandas)：xlsx 使用 xlsxwriter 的 constant_memory 模式，
+# 輸出先寫入 SpooledTemporaryFile，超過 EXPORT_SPOOL_BYTES 即自動改存暫存檔而非佔用記憶體
+EXPORT_SAMPLE_ROWS = 200                  # 推斷欄位型別與欄寬的取樣列數
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+EXPORT_MAX_COLUMN_WIDTH = 60
+EXCEL_MAX_DATA_ROWS = 1048575             # 單一工作表上限 (扣除標題列)，超過則續寫下一張工作表
+PARQUET_BATCH_ROWS = 5000
+EXPORT_VALUE_COLUMN = "內容"              # 資料全為非物件的值時使用的欄名
+EXPORT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "📥 下載 Excel 數據表"),
+    "csv": ("text/csv", "📥 下載 CSV 數據表"),
+    "parquet": ("application/vnd.apache.parquet", "📥 下載 Parquet 數據檔"),
+}
+
+def available_export_formats():
+    formats = ["xlsx", "csv"]
+    if importlib.util.find_spec("pyarrow") is not None:
+        formats.append("parquet")
+    return formats
+
+def _display_width(text):
+    return sum(2 if ord(ch) >= 0x2E80 else 1 for ch in text)
+
+# 非物件的列 (如模型回傳字串清單) 一律放進第一欄，各輸出格式的處理方式相同
+def _export_row(row, first_key):
+    if isinstance(row, dict):
+        return row
+    return {first_key: row} if first_key is not None else {}
+
+def _first_key(columns):
+    return columns[0]["key"] if columns else None
+
+def _infer_columns(data_list):
+    # 欄位取所有列的鍵聯集 (保留出現順序)；型別與欄寬只看前 EXPORT_SAMPLE_ROWS 列
+    columns = {}
+    has_values = False
+    for row in data_list:
+        if isinstance(row, dict):
+            for key in row:
+                columns.setdefault(key, None)
+        else:
+            has_values = True
+    if has_values and not columns:
+        columns[EXPORT_VALUE_COLUMN] = None
+    first_key = next(iter(columns), None)
+    sample = [_export_row(row, first_key) for row in data_list[:EXPORT_SAMPLE_ROWS]]
+    specs = []
+    for name in columns:
+        values = [row.get(name) for row in sample if row.get(name) not in (None, "")]
+        if values and all(isinstance(v, bool) for v in values):
+            kind = "bool"
+        elif values and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            kind = "number"
+        else:
+            kind = "text"
+        width = max([_display_width(str(name))] + [_display_width(_export_text(v)) for v in values])
+        specs.append({"name": str(name), "key": name, "kind": kind, "width": min(width + 2, EXPORT_MAX_COLUMN_WIDTH)})
+    return specs
+
+def _export_text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return "" if value is None else str(value)
+
+def _write_xlsx(out, data_list, columns):
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(out, {"constant_memory": True, "strings_to_numbers": False})
+    header_format = workbook.add_format({"bold": True, "bg_color": "#D9E5BF", "border": 1})
+    first_key = _first_key(columns)
+    worksheet = None
+    row_index = 0
+    sheet_count = 0
+    for row in data_list:
+        if worksheet is None or row_index > EXCEL_MAX_DATA_ROWS:
+            sheet_count += 1
+            worksheet = workbook.add_worksheet("Data_Extraction" if sheet_count == 1 else f"Data_Extraction_{sheet_count}")
+            for col_index, spec in enumerate(columns):
+                worksheet.set_column(col_index, col_index, spec["width"])
+                worksheet.write_string(0, col_index, spec["name"], header_format)
+            worksheet.freeze_panes(1, 0)
+            row_index = 1
+        row = _export_row(row, first_key)
+        for col_index, spec in enumerate(columns):
+            value = row.get(spec["key"])
+            if value is None or value == "":
+                continue
+            if spec["kind"] == "number" and isinstance(value, (int, float)) and not isinstance(value, bool):
+                worksheet.write_number(row_index, col_index, value)
+            elif spec["kind"] == "bool" and isinstance(value, bool):
+                worksheet.write_boolean(row_index, col_index, value)
+            else:
+                worksheet.write_string(row_index, col_index, _export_text(value))
+        row_index += 1
+    if worksheet is None:
+        worksheet = workbook.add_worksheet("Data_Extraction")
+        worksheet.write_string(0, 0, "無數據")
+    workbook.close()
+
+def _write_csv(out, data_list, columns):
+    text_out = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")  # BOM 讓 Excel 正確辨識中文
+    writer = csv.writer(text_out)
+    writer.writerow([spec["name"] for spec in columns])
+    first_key = _first_key(columns)
+    for row in data_list:
+        row = _export_row(row, first_key)
+        writer.writerow([_export_text(row.get(spec["key"])) for spec in columns])
+    text_out.flush()
+    text_out.detach()
+
+def _write_parquet(out, data_list, columns):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    arrow_types = {"number": pa.float64(), "bool": pa.bool_(), "text": pa.string()}
+    schema = pa.schema([(spec["name"], arrow_types[spec["kind"]]) for spec in columns])
+
+    def convert(value, kind):
+        if value is None or value == "":
+            return None
+        if kind == "number":
+            return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+        if kind == "bool":
+            return value if isinstance(value, bool) else None
+        return _export_text(value)
+
+    first_key = _first_key(columns)
+    with pq.ParquetWriter(out, schema) as writer:
+        for start in range(0, len(data_list), PARQUET_BATCH_ROWS):
+            batch = [_export_row(row, first_key) for row in data_list[start:start + PARQUET_BATCH_ROWS]]
+            arrays = [pa.array([convert(row.get(spec["key"]), spec["kind"]) for row in batch], type=arrow_types[spec["kind"]]) for spec in columns]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+def create_excel(data_list, export_format="xlsx"):
+    if not isinstance(data_list, list):
+        data_list = [data_list] if isinstance(data_list, dict) else []
+    columns = _infer_columns(data_list)
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    if export_format not in ("csv", "parquet"):
+        export_format = "xlsx"
+    with trace_span("export.write", format=export_format, rows=len(data_list), columns=len(columns)):
+        if export_format == "csv":
+            _write_csv(out, data_list, columns)
+        elif export_format == "parquet":
+            _write_parquet(out, data_list, columns)
+        else:
+            _write_xlsx(out, data_list, columns)
+    out.seek(0)
+    return out, f"Data_Extraction.{export_format}"
+
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+SHEETS_MAX_RETRIES = 5            # 配額 (429) 或暫時性錯誤 (5xx) 的重試次數
+SHEETS_BACKOFF_SECONDS = 1.0      # 指數退避的起始秒數
+
+@st.cache_resource
+def get_sheets_client_pool():
+    return {"lock": threading.Lock(), "clients": {}}
+
+# 同一組服務帳戶憑證共用同一個已授權的 client，不必每次點擊都重新認證
+def get_sheets_client(creds_dict):
+    import gspread
+    from google.oauth2.service_account import Credentials
+    fingerprint = hashlib.sha256(
+        f"{creds_dict.get('client_email', '')}:{creds_dict.get('private_key_id', '')}".encode("utf-8")
+    ).hexdigest()
+    pool = get_sheets_client_pool()
+    with pool["lock"]:
+        client = pool["clients"].get(fingerprint)
+        if client is None:
+            creds = Credentials.from_service_account_info(creds_dict, scopes=SHEETS_SCOPES)
+            client = pool["clients"][fingerprint] = gspread.authorize(creds)
+    return client
+
+def _with_sheets_retry(fn, *args, **kwargs):
+    import gspread
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            code = getattr(e, "code", None)
+            if attempt >= SHEETS_MAX_RETRIES or not (code == 429 or (isinstance(code, int) and code >= 500)):
+                raise
+            time.sleep(SHEETS_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, 0.5))
+
+# 數據提取的列與下載檔相同方式整理 (_infer_columns / _export_row)；existing_header 為既有工作表的標題列，
+# 有值時依其欄位順序排列且不重複標題，本次多出的欄位接在最後。回傳 (資料列, 需寫回的標題列或 None)
+def _sheet_rows(data, task_type, existing_header=None):
+    rows_to_write = []
+    if task_type == "數據提取 (Excel)":
+         data_list = data if isinstance(data, list) else ([data] if isinstance(data, dict) else [])
+         if not data_list:
+             return [['無數據']], None
+         columns = _infer_columns(data_list)
+         first_key = _first_key(columns)
+         keys = {spec["name"]: spec["key"] for spec in columns}
+         header = list(existing_header or [])
+         header += [name for name in keys if name not in header]
+         if not existing_header:
+             rows_to_write.append(header)
+         for item in data_list:
+             item = _export_row(item, first_key)
+             rows_to_write.append([item.get(keys[name]) if name in keys else "" for name in header])
+         return rows_to_write, (header if existing_header and len(header) > len(existing_header) else None)
+    else:
+        for k, v in data.items():
+            if isinstance(v, list):
+                if not v: continue
+                if all(isinstance(x, str) for x in v):
+                     rows_to_write.append([k, "\n".join(v)])
+                elif all(isinstance(x, dict) for x in v):
+                     rows_to_write.append([k, "(詳如下表)"])
+                     for sub_item in v:
+                         rows_to_write.append(["", sub_item.get('subtitle',''), sub_item.get('content','')])
+            else:
+                rows_to_write.append([k, str(v)])
+    return rows_to_write, None
+
+def _cell_value(value):
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": _export_text(value)}}
+
+def _sheet_batch_requests(sheet_id, rows, format_header, new_sheet=None, header=None):
+    requests = []
+    if new_sheet:
+        requests.append({"addSheet": {"properties": {"sheetId": sheet_id, "title": new_sheet}}})
+    if header:   # 既有工作表補上本次多出的欄位
+        requests.append({"updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+            "rows": [{"values": [_cell_value(v) for v in header]}],
+            "fields": "userEnteredValue",
+        }})
+    if rows:   # 結果全為空清單時沒有資料列，仍套用格式
+        requests.append({"appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [_cell_value(v) for v in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }})
+    if format_header:
+        requests.append({"repeatCell": {
+            "range": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": 1},
+            "cell": {"userEnteredFormat": {"textFormat": {"bold": True}, "backgroundColor": {"red": 0.85, "green": 0.9, "blue": 0.75}}},
+            "fields": "userEnteredFormat(textFormat,backgroundColor)",
+        }})
+        requests.append({"updateSheetProperties": {
+            "properties": {"sheetId": sheet_id, "gridProperties": {"frozenRowCount": 1}},
+            "fields": "gridProperties.frozenRowCount",
+        }})
+    requests.append({"updateDimensionProperties": {
+        "range": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": max((len(r) for r in rows), default=1)},
+        "properties": {"pixelSize": 220},
+        "fields": "pixelSize",
+    }})
+    requests.append({"repeatCell": {
+        "range": {"sheetId": sheet_id},
+        "cell": {"userEnteredFormat": {"wrapStrategy": "WRAP", "verticalAlignment": "TOP"}},
+        "fields": "userEnteredFormat(wrapStrategy,verticalAlignment)",
+    }})
+    return requests
+
+# target_url 有值時附加到既有試算表 (target_worksheet 不存在則新增)；否則建立新試算表
+# client 可傳入替身物件 (需提供 gspread Client 的 create / open_by_url 介面) 以便離線測試
+def create_google_sheet(data, task_type, creds_dict, user_email=None, target_url=None, target_worksheet=None, client=None):
+    try:
+        client = client or get_sheets_client(creds_dict)
+        if target_url:
+            sh = _with_sheets_retry(client.open_by_url, target_url)
+            worksheets = {ws.title: ws for ws in _with_sheets_retry(sh.worksheets)}
+            title = target_worksheet or next(iter(worksheets))
+            new_sheet = None
+            if title in worksheets:
+                sheet_id = worksheets[title].id
+            else:
+                sheet_id = max(ws.id for ws in worksheets.values()) + 1
+                new_sheet = title
+            existing_header = None
+            if not new_sheet and task_type == "數據提取 (Excel)":
+                existing_header = _with_sheets_retry(worksheets[title].row_values, 1)
+            rows, header = _sheet_rows(data, task_type, existing_header)
+            if task_type != "數據提取 (Excel)":
+                rows.insert(0, ["匯出時間", datetime.now().strftime('%Y-%m-%d %H:%M')])
+            # 資料、新增工作表、標題與格式一次送出 (單一 batchUpdate)
+            format_header = bool(new_sheet) or existing_header == []   # 空白的既有工作表本次寫入標題
+            _with_sheets_retry(sh.batch_update, {"requests": _sheet_batch_requests(sheet_id, rows, format_header, new_sheet, header)})
+            return sh.url, f"✅ 已附加 {len(rows)} 列至「{title}」！"
+
+        title = f"{data.get('filename_prefix', 'Export') if isinstance(data, dict) else 'Export'}_{datetime.now().strftime('%m%d_%H%M')}"
+        sh = _with_sheets_retry(client.create, title)
+        sheet_id = _with_sheets_retry(lambda: sh.sheet1.id)   # sheet1 每次存取都會呼叫 API
+        rows, _ = _sheet_rows(data, task_type)
+        _with_sheets_retry(sh.batch_update, {"requests": _sheet_batch_requests(sheet_id, rows, True)})
+        if user_email: _with_sheets_retry(sh.share, user_email, perm_type='user', role='writer')
+        else: _with_sheets_retry(sh.share, None, perm_type='anyone', role='writer')
+        return sh.url, "✅ 成功建立 Google Sheet！"
+    except Exception as e:
+        return None, f"❌ 錯誤: {str(e)}"
+
+# --- 依任務產出下載檔 (UI 與批次模式共用) ---
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+def generate_output_file(result_data, task_mode, custom_template=None, export_format="xlsx"):
+    with trace_span("render", task=task_mode, custom_template=custom_template is not None):
+        if task_mode == "Memo (指定格式)":
+            file_bio, file_name = create_memo_docx(result_data)
+            return file_bio, file_name, DOCX_MIME, "📥 下載 Memo Word 檔"
+        elif task_mode == "簡易開會通知單 (指定格式)":
+            file_bio, file_name = create_notice_docx(result_data, custom_template)
+            return file_bio, file_name, DOCX_MIME, "📥 下載 開會通知單 Word 檔"
+        elif task_mode == "談參":
+            file_bio, file_name = create_talking_points_docx(result_data)
+            return file_bio, file_name, DOCX_MIME, "📥 下載 談參 Word 檔"
+        elif task_mode == "數據提取 (Excel)":
+            file_bio, file_name = create_excel(result_data, export_format)
+            file_mime, button_label = EXPORT_FORMATS[file_name.rsplit(".", 1)[-1]]
+            return file_bio, file_name, file_mime, button_label
+        else:
+            return BytesIO(str(result_data).encode("utf-8")), "result.txt", "text/plain", "📥 下載文字檔 (.txt)"
+
+# --- 下載檔快取：結果未變時，rerun 直接提供已產生的檔案，不重新套印 ---
+# 超過記憶體快取四分之一的大型檔案 (如大型數據提取) 改存暫存目錄，下載鈕拿到的是開檔函數而非 bytes
+ARTIFACT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+ARTIFACT_DISK_MAX_BYTES = int(os.environ.get("ARTIFACT_DISK_MB", "1024")) * 1024 * 1024
+
+@st.cache_resource
+def get_artifact_cache():
+    return {
+        "lock": threading.Lock(), "items": OrderedDict(), "size": 0, "renders": 0, "hits": 0, "misses": 0,
+        "dir": tempfile.mkdtemp(prefix="document-creator-artifacts-"), "files": OrderedDict(), "disk_size": 0,
+    }
+
+def _open_artifact(path, result_data, task_mode, custom_template, export_format):
+    # 下載鈕點擊時才開檔；檔案已被淘汰 (或暫存目錄被清除) 時重新產生一次
+    try:
+        return open(path, "rb")
+    except OSError:
+        file_bio, _, _, _ = generate_output_file(result_data, task_mode, custom_template, export_format)
+        file_bio.seek(0)
+        return file_bio
+
+def _template_fingerprint(task_mode, custom_template):
+    if custom_template is not None:
+        raw = custom_template.getvalue() if hasattr(custom_template, "getvalue") else str(custom_template).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+    default_path = {"Memo (指定格式)": "Template_Memo.docx", "簡易開會通知單 (指定格式)": "Template_Notice.docx"}.get(task_mode)
+    if default_path and os.path.exists(default_path):
+        return get_compiled_template(default_path)["sha"]
+    return ""
+
+def get_output_file(result_data, task_mode, custom_template=None, export_format="xlsx"):
+    cache = get_artifact_cache()
+    h = hashlib.sha256()
+    h.update(json.dumps(result_data, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    h.update(task_mode.encode("utf-8"))
+    h.update(_template_fingerprint(task_mode, custom_template).encode("utf-8"))
+    h.update(export_format.encode("utf-8"))
+    key = h.hexdigest()
+    open_args = (result_data, task_mode, custom_template, export_format)
+    with cache["lock"]:
+        item = cache["items"].get(key)
+        if item is not None:
+            cache["items"].move_to_end(key)
+            cache["hits"] += 1
+            return item
+        entry = cache["files"].get(key)
+        if entry is not None and os.path.exists(entry["path"]):
+            cache["files"].move_to_end(key)
+            cache["hits"] += 1
+            return (functools.partial(_open_artifact, entry["path"], *open_args), *entry["info"])
+        cache["misses"] += 1
+
+    file_bio, file_name, file_mime, button_label = generate_output_file(result_data, task_mode, custom_template, export_format)
+    size = file_bio.seek(0, io.SEEK_END)
+    file_bio.seek(0)
+    if size <= ARTIFACT_CACHE_MAX_BYTES // 4:
+        item = (file_bio.read(), file_name, file_mime, button_label)
+        file_bio.close()
+        with cache["lock"]:
+            cache["renders"] += 1
+            if key not in cache["items"]:
+                cache["items"][key] = item
+                cache["size"] += size
+            while cache["size"] > ARTIFACT_CACHE_MAX_BYTES and len(cache["items"]) > 1:
+                _, evicted = cache["items"].popitem(last=False)
+                cache["size"] -= len(evicted[0])
+        return item
+
+    # 大型檔案：從 (已溢寫到磁碟的) 暫存檔逐塊複製到快取目錄，不整份讀進記憶體
+    path = os.path.join(cache["dir"], key)
+    with open(f"{path}.tmp", "wb") as f:
+        shutil.copyfileobj(file_bio, f, BUNDLE_CHUNK_BYTES)
+    file_bio.close()
+    os.replace(f"{path}.tmp", path)
+    with cache["lock"]:
+        cache["renders"] += 1
+        if key not in cache["files"]:
+            cache["files"][key] = {"path": path, "bytes": size, "info": (file_name, file_mime, button_label)}
+            cache["disk_size"] += size
+        while cache["disk_size"] > ARTIFACT_DISK_MAX_BYTES and len(cache["files"]) > 1:
+            _, evicted = cache["files"].popitem(last=False)
+            cache["disk_size"] -= evicted["bytes"]
+            try:
+                os.remove(evicted["path"])
+            except OSError:
+                pass
+    return (functools.partial(_open_artifact, path, *open_args), file_name, file_mime, button_label)
+
+# --- 打包下載：多份產出逐份串流寫入同一個 ZIP (UI「全部下載」與批次 --bundle 共用) ---
+# 每份檔案寫完即可釋放，記憶體只需容納目前這一份與 manifest 清單；目的檔可為磁碟檔或 SpooledTemporaryFile
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_STORED_EXTENSIONS = (".docx", ".xlsx", ".parquet")   # 本身已是壓縮格式，直接存入不再壓縮一次
+BUNDLE_CHUNK_BYTES = 1024 * 1024
+
+class OutputBundle:
+    def __init__(self, fileobj):
+        import zipfile
+        self.zf = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.entries = []
+        self.names = set()
+
+    def _unique_name(self, name):
+        stem, ext = os.path.splitext(name)
+        candidate, index = name, 2
+        while candidate in self.names or candidate == BUNDLE_MANIFEST:
+            candidate = f"{stem}_{index}{ext}"
+            index += 1
+        self.names.add(candidate)
+        return candidate
+
+    def add(self, name, source, **info):
+        # source 可為 bytes 或檔案物件 (逐塊讀取，不整份載入)；info 寫入 manifest 該筆紀錄
+        import zipfile
+        name = self._unique_name(name)
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        zinfo.compress_type = zipfile.ZIP_STORED if name.lower().endswith(BUNDLE_STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+        digest = hashlib.sha256()
+        size = 0
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        with self.zf.open(zinfo, "w", force_zip64=True) as dst:
+            while True:
+                chunk = source.read(BUNDLE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        self.entries.append({"name": name, "bytes": size, "sha256": digest.hexdigest(), **info})
+        return name
+
+    def close(self, **summary):
+        manifest = {"created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), **summary, "files": self.entries}
+        self.zf.writestr(BUNDLE_MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=4, default=str))
+        self.zf.close()
+
+def build_output_bundle(result_parts, result_data, task_mode, custom_template=None, export_format="xlsx", meta_info=None):
+    # 依序產生每份文件並立即寫入 ZIP；已在下載檔快取中的文件直接取用，不重新套印
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    bundle = OutputBundle(spool)
+    for part_task, part_data in result_parts:
+        part_template = custom_template if part_task == "簡易開會通知單 (指定格式)" else None
+        file_data, file_name, _, _ = get_output_file(part_data, part_task, part_template, export_format)
+        if callable(file_data):   # 大型檔案：直接從快取目錄串流進 ZIP
+            with file_data() as f:
+                bundle.add(file_name, f, task=part_task)
+        else:
+            bundle.add(file_name, file_data, task=part_task)
+        del file_data
+    bundle.add("result.json", json.dumps(result_data, ensure_ascii=False, indent=4, default=str).encode("utf-8"), task=task_mode)
+    summary = {"task": task_mode}
+    if meta_info:
+        summary.update(model=meta_info.get("model"), total_tokens=meta_info.get("total_tokens"))
+    bundle.close(**summary)
+    spool.seek(0)
+    return spool
@@ -0,0 +1,127 @@
+import json
+import os
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from usage_ledger import SESSION_CONTEXT, current_session_id
+from analysis import analyze_content_with_gemini, compute_file_digests, spool_uploads
+
+# ==========================================
+# 4-2. 🧵 背景分析工作
+# ==========================================
+# 分析在伺服器端的工作池執行，不綁住 Streamlit 腳本執行緒：重新整理或調整元件不會中斷已付費的呼叫，
+# 工作代號存於 session_state 與網址 (?job=)，斷線重連後仍可取回結果
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "4"))
+JOB_RETENTION_SECONDS = 3600   # 完成的工作保留多久供重連取回
+JOB_LOG_MAX_LINES = 50
+
+@st.cache_resource
+def get_job_manager():
+    return {
+        "lock": threading.Lock(),
+        "executor": ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="analysis"),
+        "jobs": {},
+    }
+
+class JobPreview:
+    # 取代串流預覽用的 st.empty()，把最新的預覽文字存進工作紀錄
+    def __init__(self, job):
+        self.job = job
+
+    def markdown(self, text):
+        self.job["preview"] = text
+
+    def empty(self):
+        self.job["preview"] = None
+
+class JobStatus:
+    # 取代 st.status，在工作執行緒中把進度寫入工作紀錄，由頁面輪詢呈現
+    def __init__(self, job):
+        self.job = job
+
+    def write(self, msg):
+        log = self.job["log"]
+        log.append(str(msg))
+        if len(log) > JOB_LOG_MAX_LINES:
+            del log[:len(log) - JOB_LOG_MAX_LINES]
+
+    def update(self, label=None, state=None, expanded=None):
+        if label:
+            self.job["label"] = label
+
+    def empty(self):
+        return JobPreview(self.job)
+
+def _run_analysis_job(job, file_list, api_key, user_instruction, hedge_delay, stream, preprocess):
+    SESSION_CONTEXT.session_id = job["session_id"]
+    job.update(status="running", started=time.time(), label="🤖 AI 行政秘書正在多模態分析中...")
+    try:
+        result = analyze_content_with_gemini(
+            file_list, job["task"], api_key, user_instruction, hedge_delay, status_container=JobStatus(job), stream=stream, preprocess=preprocess
+        )
+        if isinstance(result, dict) and "error" in result:
+            job.update(status="error", error=result["error"])
+        else:
+            job.update(status="done", result=result)
+    except Exception as e:
+        job.update(status="error", error=f"分析過程發生錯誤: {e}")
+    finally:
+        SESSION_CONTEXT.session_id = None
+        job["finished"] = time.time()
+
+def _prune_jobs(jobs):
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for job_id in [k for k, job in jobs.items() if job["finished"] and job["finished"] < cutoff]:
+        del jobs[job_id]
+
+def submit_analysis_job(file_list, task_type, api_key, user_instruction="", hedge_delay=None, stream=False, preprocess=True):
+    # 只合併同一工作階段、同一把 API Key 的重複送出：不同使用者的同一份資料各自計費、各自看得到進度
+    session_id = current_session_id()
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+    fingerprint = hashlib.sha256(json.dumps(
+        [session_id, key_hash, task_type, user_instruction or "", preprocess, [d for _, d in compute_file_digests(file_list)]], ensure_ascii=False
+    ).encode("utf-8")).hexdigest()
+    # 排隊與分析期間只保留記憶體預算內的檔案，其餘寫入暫存檔 (在鎖外複製，不阻擋其他使用者送件)
+    files = spool_uploads(file_list)
+    manager = get_job_manager()
+    with manager["lock"]:
+        _prune_jobs(manager["jobs"])
+        # 同一份資料與指令的工作仍在進行時 (如重複點擊)，直接沿用，不重複呼叫模型
+        for job in manager["jobs"].values():
+            if job["fingerprint"] == fingerprint and job["status"] in ("queued", "running"):
+                return job["id"]
+        job_id = os.urandom(8).hex()
+        job = {
+            "id": job_id,
+            "fingerprint": fingerprint,
+            "task": task_type,
+            "files": [f.name for f in files],
+            "session_id": session_id,
+            "status": "queued",
+            "label": "⏳ 排隊等待中...",
+            "log": [],
+            "preview": None,
+            "result": None,
+            "error": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+        }
+        manager["jobs"][job_id] = job
+    manager["executor"].submit(_run_analysis_job, job, files, api_key, user_instruction, hedge_delay, stream, preprocess)
+    return job_id
+
+def get_analysis_job(job_id):
+    return get_job_manager()["jobs"].get(job_id) if job_id else None
+
+def get_job_queue_position(job_id):
+    manager = get_job_manager()
+    with manager["lock"]:
+        job = manager["jobs"].get(job_id)
+        if not job or job["status"] != "queued":
+            return 0
+        return sum(1 for other in manager["jobs"].values() if other["status"] == "queued" and other["created"] < job["created"])
@@ -0,0 +1,235 @@
+import json
+import os
+import time
+import sqlite3
+import re
+import threading
+from datetime import datetime
+
+import streamlit as st
+
+from usage_ledger import get_usage_db
+
+# ==========================================
+# 3-3. ⚡ 併發備援 (Hedged) 與模型斷路器
+# ==========================================
+HEDGE_DELAY_SECONDS = 8.0         # 併發模式下，前一個模型多久未回應即同時啟動下一個模型
+MODEL_CALL_TIMEOUT_SECONDS = 300  # 單次模型呼叫逾時，逾時視為失敗並計入斷路器
+CIRCUIT_FAILURE_THRESHOLD = 3     # 連續失敗達此次數即斷路
+CIRCUIT_COOLDOWN_SECONDS = 300    # 斷路後的冷卻時間，期滿後 (半開) 只放行一次試探呼叫，其餘呼叫等試探結果
+
+class CircuitOpenError(Exception):
+    pass
+
+@st.cache_resource
+def get_circuit_breakers():
+    return {"lock": threading.Lock(), "models": {}}
+
+def _circuit_blocked(state, now):
+    # 斷路冷卻中，或半開狀態下已有試探呼叫在途 (試探超過單次呼叫逾時仍未回報時視為遺失，重新放行)
+    if not state or state["failures"] < CIRCUIT_FAILURE_THRESHOLD:
+        return False
+    if now - state["opened_at"] < CIRCUIT_COOLDOWN_SECONDS:
+        return True
+    return now - state.get("probe_started", 0.0) < MODEL_CALL_TIMEOUT_SECONDS
+
+def is_circuit_open(model_name):
+    breakers = get_circuit_breakers()
+    with breakers["lock"]:
+        return _circuit_blocked(breakers["models"].get(model_name), time.time())
+
+def begin_model_call(model_name):
+    # 送出請求前呼叫：斷路中拋出 CircuitOpenError；半開時第一個呼叫者成為試探呼叫，回傳 True
+    breakers = get_circuit_breakers()
+    with breakers["lock"]:
+        now = time.time()
+        state = breakers["models"].get(model_name)
+        if _circuit_blocked(state, now):
+            raise CircuitOpenError(f"{model_name} 斷路中，等待試探結果")
+        if not state or state["failures"] < CIRCUIT_FAILURE_THRESHOLD:
+            return False
+        state["probe_started"] = now
+        return True
+
+def end_circuit_probe(model_name):
+    # 試探呼叫被取消 (未得出成敗)：讓出試探名額
+    breakers = get_circuit_breakers()
+    with breakers["lock"]:
+        state = breakers["models"].get(model_name)
+        if state:
+            state["probe_started"] = 0.0
+
+def record_model_success(model_name):
+    breakers = get_circuit_breakers()
+    with breakers["lock"]:
+        breakers["models"][model_name] = {"failures": 0, "opened_at": 0.0, "probe_started": 0.0}
+
+def record_model_failure(model_name):
+    breakers = get_circuit_breakers()
+    with breakers["lock"]:
+        state = breakers["models"].setdefault(model_name, {"failures": 0, "opened_at": 0.0, "probe_started": 0.0})
+        state["failures"] += 1
+        if state["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+            # 達門檻或試探失敗：重新斷路並開始新一輪冷卻
+            state["opened_at"] = time.time()
+            state["probe_started"] = 0.0
+
+# ==========================================
+# 3-7. 🚦 模型配額路由 (Token bucket)
+# ==========================================
+# 每個模型各有 RPM / TPM 兩個權杖桶與每日上限；桶內餘額由用量帳本 (含其他行程，如批次模式) 與 429 回應校正。
+# 派送前先預估本次 token 數，依 MODEL_PRIORITY_LIST 挑第一個仍有額度的模型；全部滿載時短暫排隊等候
+MODEL_PRIORITY_LIST = [
+    "gemini-2.5-flash",
+    "gemini-3.0-flash",
+    "gemini-2.5-flash-lite"
+]
+
+MODEL_QUOTAS = {
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250_000, "rpd": 250},
+    "gemini-3.0-flash": {"rpm": 10, "tpm": 250_000, "rpd": 250},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250_000, "rpd": 1000},
+}
+MODEL_QUOTAS.update(json.loads(os.environ.get("MODEL_QUOTAS_JSON", "{}")))   # 例：{"gemini-2.5-flash": {"rpm": 1000, "tpm": 1000000, "rpd": 10000}}
+DEFAULT_MODEL_QUOTA = {"rpm": 10, "tpm": 250_000, "rpd": 250}
+RATE_LIMIT_COOLDOWN_SECONDS = 60   # 收到 429 且未附重試時間時的暫停秒數
+ROUTER_MAX_WAIT_SECONDS = 20       # 所有模型皆滿載時最多排隊等候的秒數
+LEDGER_SYNC_SECONDS = 30           # 每隔多久以用量帳本校正一次
+
+@st.cache_resource
+def get_rate_limiter():
+    return {"lock": threading.Lock(), "models": {}, "synced_at": 0.0}
+
+def _model_quota(model_name):
+    return {**DEFAULT_MODEL_QUOTA, **MODEL_QUOTAS.get(model_name, {})}
+
+def _bucket(limiter, model_name, now):
+    quota = _model_quota(model_name)
+    day = datetime.now().strftime("%Y-%m-%d")
+    state = limiter["models"].get(model_name)
+    if state is None or state["day"] != day:
+        state = limiter["models"][model_name] = {
+            "rpm": float(quota["rpm"]), "tpm": float(quota["tpm"]), "updated": now,
+            "day": day, "daily": 0, "blocked_until": state["blocked_until"] if state else 0.0,
+        }
+    elapsed = now - state["updated"]
+    state["rpm"] = min(quota["rpm"], state["rpm"] + elapsed * quota["rpm"] / 60)
+    state["tpm"] = min(quota["tpm"], state["tpm"] + elapsed * quota["tpm"] / 60)
+    state["updated"] = now
+    return state, quota
+
+# 最近 60 秒各模型的呼叫數與 tokens；以 idx_usage_calls_ts 取範圍，不掃描整張帳本
+RECENT_USAGE_QUERY = "SELECT model, COUNT(*), SUM(input_tokens + output_tokens) FROM usage_calls WHERE ts >= ? GROUP BY model"
+
+def _sync_limiter_from_ledger(limiter, now):
+    # 帳本記錄所有行程的成功呼叫：今日次數取較大者，最近 60 秒的用量從桶中扣除 (只扣本行程未計入的部分)
+    if now - limiter["synced_at"] < LEDGER_SYNC_SECONDS:
+        return
+    limiter["synced_at"] = now
+    try:
+        conn = get_usage_db()
+        day = datetime.now().strftime("%Y-%m-%d")
+        daily = dict(conn.execute("SELECT model, count FROM usage_daily WHERE day = ?", (day,)).fetchall())
+        recent = {
+            model: (calls, tokens or 0) for model, calls, tokens in conn.execute(RECENT_USAGE_QUERY, (time.time() - 60,)).fetchall()
+        }
+    except sqlite3.Error:
+        return
+    for model_name in set(daily) | set(recent) | set(MODEL_PRIORITY_LIST):
+        state, quota = _bucket(limiter, model_name, now)
+        state["daily"] = max(state["daily"], daily.get(model_name, 0))
+        calls, tokens = recent.get(model_name, (0, 0))
+        state["rpm"] = min(state["rpm"], max(quota["rpm"] - calls, 0))
+        state["tpm"] = min(state["tpm"], max(quota["tpm"] - tokens, 0))
+
+def _budget_wait_seconds(state, quota, tokens, now):
+    # 0 表示可立即送出；None 表示今日額度已用完
+    if state["daily"] >= quota["rpd"]:
+        return None
+    need_tokens = min(tokens, quota["tpm"])   # 超過單分鐘上限的大請求，等桶滿即放行
+    waits = [max(state["blocked_until"] - now, 0)]
+    if state["rpm"] < 1:
+        waits.append((1 - state["rpm"]) * 60 / quota["rpm"])
+    if state["tpm"] < need_tokens:
+        waits.append((need_tokens - state["tpm"]) * 60 / quota["tpm"])
+    return max(waits)
+
+def acquire_model(candidates, tokens, status_container=None, max_wait=ROUTER_MAX_WAIT_SECONDS):
+    # 從 candidates (依優先順序) 取出第一個有額度的模型並預扣額度；等候逾時或全數用罄時回傳 None
+    limiter = get_rate_limiter()
+    deadline = time.time() + max_wait
+    announced = False
+    while candidates:
+        with limiter["lock"]:
+            now = time.time()
+            _sync_limiter_from_ledger(limiter, now)
+            waits = {}
+            for model_name in candidates:
+                state, quota = _bucket(limiter, model_name, now)
+                wait_seconds = _budget_wait_seconds(state, quota, tokens, now)
+                if wait_seconds == 0:
+                    state["rpm"] -= 1
+                    state["tpm"] -= min(tokens, quota["tpm"])
+                    state["daily"] += 1
+                    candidates.remove(model_name)
+                    return model_name
+                waits[model_name] = wait_seconds
+        exhausted = [m for m, w in waits.items() if w is None]
+        for model_name in exhausted:
+            candidates.remove(model_name)
+            if status_container is not None:
+                status_container.write(f"🚦 {model_name} 今日額度已用完，略過")
+        pending = [w for w in waits.values() if w is not None]
+        if not pending or min(pending) > deadline - time.time():
+            return None
+        sleep_for = min(pending)
+        if status_container is not None and not announced:
+            status_container.write(f"🚦 所有模型皆達每分鐘上限，排隊等候約 {min(pending):.0f} 秒...")
+            announced = True
+        time.sleep(min(sleep_for, 1.0))
+    return None
+
+def release_model(model_name):
+    # 呼叫失敗或遭取消時退還預扣的每日次數；已送出的 RPM / TPM 不退 (伺服器端仍會計入)
+    limiter = get_rate_limiter()
+    with limiter["lock"]:
+        state, _ = _bucket(limiter, model_name, time.time())
+        state["daily"] = max(state["daily"] - 1, 0)
+
+def _retry_after_seconds(error):
+    match = re.search(r"(?:retry_delay\s*\{\s*seconds:\s*|retry in\s*|Retry-After:\s*)(\d+(?:\.\d+)?)", str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+def is_rate_limit_error(error):
+    return getattr(error, "code", None) == 429 or type(error).__name__ == "ResourceExhausted" or str(error).startswith("429")
+
+def record_rate_limited(model_name, error=None):
+    limiter = get_rate_limiter()
+    with limiter["lock"]:
+        now = time.time()
+        state, _ = _bucket(limiter, model_name, now)
+        state["blocked_until"] = now + (_retry_after_seconds(error) or RATE_LIMIT_COOLDOWN_SECONDS)
+        state["rpm"] = 0.0
+
+def get_rate_limit_snapshot():
+    limiter = get_rate_limiter()
+    snapshot = {}
+    with limiter["lock"]:
+        now = time.time()
+        _sync_limiter_from_ledger(limiter, now)
+        for model_name in MODEL_PRIORITY_LIST:
+            state, quota = _bucket(limiter, model_name, now)
+            snapshot[model_name] = {
+                "rpm_left": int(state["rpm"]), "tpm_left": int(state["tpm"]),
+                "daily_left": max(quota["rpd"] - state["daily"], 0),
+                "blocked_seconds": max(state["blocked_until"] - now, 0),
+            }
+    return snapshot
+
+
+# 全伺服器同時進行的模型呼叫數上限 (含分段與併發備援)
+MODEL_CALL_CONCURRENCY = int(os.environ.get("MODEL_CALL_CONCURRENCY", "6"))
+
+@st.cache_resource
+def get_model_call_slots():
+    return threading.BoundedSemaphore(MODEL_CALL_CONCURRENCY)
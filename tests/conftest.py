@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# ==========================================
+# 測試共用設定：以 stub 後端匯入分析模組，追蹤檔寫到暫存目錄，不連網也不需 API Key
+# ==========================================
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("STUB_LATENCY_SECONDS", "0")
+os.environ.setdefault("STUB_LATENCY_JITTER", "0")
+os.environ.setdefault("TRACE_FILE", os.path.join(tempfile.gettempdir(), "document-creator-test-traces.jsonl"))
@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+# ==========================================
+# 本機替身：Gemini File API 上傳端點 (比照 files.create 的回應格式)
+# ==========================================
+
+
+class FakeFileApi:
+    # with FakeFileApi() as api: analysis.FILE_API_UPLOAD_URL = api.url ...
+    # expires_in：上傳後幾秒到期 (寫入回應的 expirationTime)；uploads 記錄每次收到的上傳
+    def __init__(self, expires_in=48 * 3600):
+        self.expires_in = expires_in
+        self.uploads = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                index = len(fake.uploads)
+                fake.uploads.append({"path": self.path, "bytes": len(body), "mime_type": self.headers.get("Content-Type")})
+                expires = datetime.fromtimestamp(time.time() + fake.expires_in, tz=timezone.utc)
+                payload = json.dumps({"file": {
+                    "name": f"files/fake-{index:04d}",
+                    "uri": f"{fake.url}/files/fake-{index:04d}",
+                    "mimeType": self.headers.get("Content-Type"),
+                    "expirationTime": expires.isoformat().replace("+00:00", "Z"),
+                    "state": "ACTIVE",
+                }}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/upload/v1beta/files"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+        return False
+
+
+# ==========================================
+# 本機替身：Google Sheets (gspread Client / Spreadsheet / Worksheet 的最小介面)
+# batch_update 會依 addSheet / appendCells 請求更新記憶體中的儲存格，並記錄每次呼叫
+# ==========================================
+class FakeResponse:
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._payload = {"error": {"code": code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._payload
+
+
+class FakeWorksheet:
+    def __init__(self, client, sheet_id, title):
+        self.client = client
+        self.id = sheet_id
+        self.title = title
+        self.rows = []
+
+    def row_values(self, row):
+        self.client._maybe_fail()
+        return list(self.rows[row - 1]) if len(self.rows) >= row else []
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, title, index):
+        self.client = client
+        self.title = title
+        self.url = f"https://docs.google.com/spreadsheets/d/fake-{index:04d}"
+        self.sheets = [FakeWorksheet(client, 0, "工作表1")]
+        self.batch_calls = []
+        self.shared = []
+
+    @property
+    def sheet1(self):
+        # 與 gspread 相同：每次存取都會向 API 取得試算表資訊
+        self.client._maybe_fail()
+        return self.sheets[0]
+
+    def worksheets(self):
+        self.client._maybe_fail()
+        return list(self.sheets)
+
+    def batch_update(self, body):
+        self.client._maybe_fail()
+        self.batch_calls.append(body)
+        by_id = {ws.id: ws for ws in self.sheets}
+        for request in body["requests"]:
+            if "addSheet" in request:
+                props = request["addSheet"]["properties"]
+                by_id[props["sheetId"]] = FakeWorksheet(self.client, props["sheetId"], props["title"])
+                self.sheets.append(by_id[props["sheetId"]])
+            elif "updateCells" in request:
+                start = request["updateCells"]["start"]
+                target = by_id[start["sheetId"]]
+                for offset, row in enumerate(request["updateCells"]["rows"]):
+                    values = [next(iter(cell["userEnteredValue"].values())) for cell in row["values"]]
+                    if start["rowIndex"] + offset < len(target.rows):
+                        target.rows[start["rowIndex"] + offset] = values
+                    else:
+                        target.rows.append(values)
+            elif "appendCells" in request:
+                target = by_id[request["appendCells"]["sheetId"]]
+                for row in request["appendCells"]["rows"]:
+                    target.rows.append([next(iter(cell["userEnteredValue"].values())) for cell in row["values"]])
+        return {"replies": []}
+
+    def share(self, email, perm_type, role):
+        self.client._maybe_fail()
+        self.shared.append((email, perm_type, role))
+
+
+class FakeSheetsClient:
+    # fail_with：前幾次呼叫依序拋出的錯誤碼 (如 [429, 503])，用來驗證退避重試；None 表示該次呼叫成功
+    def __init__(self, fail_with=()):
+        self.spreadsheets = {}
+        self.fail_with = list(fail_with)
+        self.calls = 0
+
+    def _maybe_fail(self):
+        import gspread
+        self.calls += 1
+        if self.fail_with:
+            code = self.fail_with.pop(0)
+            if code is None:
+                return
+            raise gspread.exceptions.APIError(FakeResponse(code, f"fake error {code}"))
+
+    def create(self, title):
+        self._maybe_fail()
+        sh = FakeSpreadsheet(self, title, len(self.spreadsheets))
+        self.spreadsheets[sh.url] = sh
+        return sh
+
+    def open_by_url(self, url):
+        self._maybe_fail()
+        return self.spreadsheets[url]
+
+
+# ==========================================
+# 本機替身：LLM 後端 (依序回傳預先寫好的回應文字，比照 analysis 各 Backend 的介面)
+# requests 記錄每次呼叫收到的 content_parts 與 generation_config
+# ==========================================
+class ScriptedBackend:
+    name = "scripted"
+    billable = False
+    supports_file_api = False
+    supports_context_cache = False
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+
+    def configure(self, api_key):
+        pass
+
+    def generate(self, model_name, content_parts, generation_config, stream=False, task_type=None, cached_content=None):
+        from analysis import LLMReply
+        self.requests.append({"parts": list(content_parts), "config": dict(generation_config)})
+        text = self.replies.pop(0)
+        return LLMReply(iter([text]), lambda: (100, len(text), 100 + len(text), 0))
+
+
+# ==========================================
+# 本機替身：Streamlit UploadedFile (BytesIO 子類，帶 name / type / size)
+# ==========================================
+class FakeUploadedFile(BytesIO):
+    def __init__(self, name, mime_type, data):
+        super().__init__(data)
+        self.name = name
+        self.type = mime_type
+        self.size = len(data)
@@ -0,0 +1,28 @@
+import pytest
+
+import analysis
+from batch import QuietStatus
+
+
+@pytest.fixture
+def billable_stub(monkeypatch, tmp_path):
+    # stub 後端預設不寫入分析快取；暫時視為計費後端以走完整的快取流程
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(analysis.StubBackend, "billable", True)
+
+
+@pytest.mark.parametrize("task_type", ["數據提取 (Excel)", "Memo (指定格式)"])
+def test_cache_hit_keeps_meta_info(billable_stub, task_type):
+    notes = analysis.MemoryFile("notes.txt", "text/plain", "品項與數量：紙箱 20 個".encode("utf-8"))
+    first = analysis.analyze_content_with_gemini([notes], task_type, "key", status_container=QuietStatus())
+    assert not analysis.get_meta_info(first).get("cache_hit")
+
+    again = analysis.analyze_content_with_gemini([notes], task_type, "key", status_container=QuietStatus())
+    meta = analysis.get_meta_info(again)
+    assert meta["cache_hit"] is True and meta["model"] == analysis.get_meta_info(first)["model"]
+    assert meta["input_tokens"] == analysis.get_meta_info(first)["input_tokens"]
+    assert type(again) is type(first)
+    if isinstance(again, dict):
+        assert {k: v for k, v in again.items() if k != "_meta_info"} == {k: v for k, v in first.items() if k != "_meta_info"}
+    else:
+        assert list(again) == list(first)
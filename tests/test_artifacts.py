@@ -0,0 +1,93 @@
+import zipfile
+from io import BytesIO
+
+import analysis
+import exporters
+
+
+def _rows(n):
+    return [{"項目": f"第 {i} 筆", "說明": "預算" * 20, "數量": i} for i in range(n)]
+
+
+def test_large_export_is_served_from_disk(monkeypatch):
+    monkeypatch.setattr(exporters, "ARTIFACT_CACHE_MAX_BYTES", 64 * 1024)   # 超過 16 KB 即改存磁碟
+    rows = _rows(5_000)
+    data, file_name, _, _ = exporters.get_output_file(rows, "數據提取 (Excel)", export_format="csv")
+    assert callable(data) and file_name.endswith(".csv")
+    with data() as f:
+        content = f.read()
+    assert content.decode("utf-8-sig").count("\n") >= 5_000
+
+    renders = exporters.get_artifact_cache()["renders"]
+    again, _, _, _ = exporters.get_output_file(rows, "數據提取 (Excel)", export_format="csv")
+    assert callable(again) and exporters.get_artifact_cache()["renders"] == renders   # 命中磁碟快取，不重新產生
+    with again() as f:
+        assert f.read() == content
+
+
+def test_small_export_stays_in_memory():
+    data, _, _, _ = exporters.get_output_file(_rows(3), "數據提取 (Excel)", export_format="csv")
+    assert isinstance(data, bytes)
+
+
+def test_bundle_streams_disk_backed_exports(monkeypatch):
+    monkeypatch.setattr(exporters, "ARTIFACT_CACHE_MAX_BYTES", 64 * 1024)
+    rows = _rows(5_000)
+    bundle = exporters.build_output_bundle([("數據提取 (Excel)", rows)], rows, "數據提取 (Excel)", export_format="csv")
+    with zipfile.ZipFile(bundle) as zf:
+        assert zf.getinfo("Data_Extraction.csv").file_size > 16 * 1024
+        assert "manifest.json" in zf.namelist()
+
+
+def test_rerun_reuses_generated_file():
+    exporters.get_artifact_cache.clear()
+    data = {"title": "預算協調會談參", "background": ["年度預算尚未定案"], "discussion_points": [], "unit_opinion": "原則同意"}
+    first = exporters.get_output_file(data, "談參")
+    cache = exporters.get_artifact_cache()
+    assert (cache["renders"], cache["hits"], cache["misses"]) == (1, 0, 1)
+    assert exporters.get_output_file(dict(data), "談參") is first
+    assert (cache["renders"], cache["hits"]) == (1, 1)
+
+    changed = exporters.get_output_file(dict(data, unit_opinion="暫緩辦理"), "談參")
+    assert changed is not first and cache["renders"] == 2
+
+
+def test_custom_template_content_is_part_of_the_key(monkeypatch):
+    exporters.get_artifact_cache.clear()
+    monkeypatch.setattr(exporters, "generate_output_file", lambda data, task, template, fmt: (BytesIO(template.getvalue()), "notice.docx", "application/octet-stream", "下載"))
+    data = {"date": "115/10/17", "reason": "預算協調"}
+    v1 = exporters.get_output_file(data, "簡易開會通知單 (指定格式)", analysis.MemoryFile("t.docx", "application/octet-stream", b"v1"))
+    v2 = exporters.get_output_file(data, "簡易開會通知單 (指定格式)", analysis.MemoryFile("t.docx", "application/octet-stream", b"v2"))
+    assert (v1[0], v2[0]) == (b"v1", b"v2")
+
+
+def test_memory_cache_evicts_oldest_beyond_budget(monkeypatch):
+    exporters.get_artifact_cache.clear()
+    monkeypatch.setattr(exporters, "ARTIFACT_CACHE_MAX_BYTES", 4 * 1024)
+    monkeypatch.setattr(exporters, "generate_output_file", lambda data, task, template, fmt: (BytesIO(b"x" * 1000), f"{data['n']}.txt", "text/plain", "下載"))
+    for n in range(6):
+        exporters.get_output_file({"n": n}, "談參")
+    cache = exporters.get_artifact_cache()
+    assert cache["size"] <= 4 * 1024 and len(cache["items"]) == 4
+    names = [item[1] for item in cache["items"].values()]
+    assert names == ["2.txt", "3.txt", "4.txt", "5.txt"]
+
+
+def _exported_rows(data_list, export_format):
+    out, _ = exporters.create_excel(data_list, export_format)
+    if export_format == "csv":
+        return [line.split(",") for line in out.read().decode("utf-8-sig").splitlines()]
+    if export_format == "parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(out)
+        return [table.column_names] + [["" if v is None else str(v) for v in row.values()] for row in table.to_pylist()]
+    import openpyxl
+    sheet = openpyxl.load_workbook(out).active
+    return [["" if v is None else str(v) for v in row] for row in sheet.iter_rows(values_only=True)]
+
+
+def test_non_dict_rows_go_to_the_first_column_in_every_format():
+    mixed = [{"項目": "伺服器", "備註": "三台"}, "補充說明"]
+    for export_format in exporters.available_export_formats():
+        assert _exported_rows(mixed, export_format) == [["項目", "備註"], ["伺服器", "三台"], ["補充說明", ""]], export_format
+        assert _exported_rows(["甲", "乙"], export_format) == [[exporters.EXPORT_VALUE_COLUMN], ["甲"], ["乙"]], export_format
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import batch
+
+
+def test_resolve_task_aliases_and_multi_output():
+    assert batch.resolve_task("memo") == "Memo (指定格式)"
+    assert batch.resolve_task("談參") == "談參"
+    assert batch.resolve_task("memo, talking-points") == batch.analysis.multi_output_task(["Memo (指定格式)", "談參"])
+    with pytest.raises(ValueError):
+        batch.resolve_task("memoo")
+    with pytest.raises(ValueError):
+        batch.resolve_task("memo,minutes")   # 會議紀錄不支援多重輸出
+
+
+def test_manifest_tasks_are_validated_on_load(tmp_path):
+    manifest = tmp_path / "items.json"
+    manifest.write_text(json.dumps([{"id": "a", "files": ["a.txt"], "task": "notice"}]), encoding="utf-8")
+    assert batch.collect_items(str(manifest))[0]["task"] == "簡易開會通知單 (指定格式)"
+    manifest.write_text(json.dumps([{"id": "a", "files": ["a.txt"], "task": "notise"}]), encoding="utf-8")
+    with pytest.raises(ValueError, match="notise"):
+        batch.collect_items(str(manifest))
+
+
+def test_resume_reruns_items_whose_task_or_inputs_changed(tmp_path):
+    source = tmp_path / "a.txt"
+    source.write_text("第一次會議紀錄", encoding="utf-8")
+    out_dir = str(tmp_path / "out")
+    item = {"id": "a", "files": [str(source)]}
+    results = batch.run_batch([item], "談參", "", "", out_dir, workers=1, rpm=0)
+    record = results["a"]
+    assert record["status"] == "done"
+
+    fingerprint = batch.input_fingerprint(item["files"], "", "談參")
+    assert batch.is_done(record, out_dir, "談參", fingerprint)
+    assert not batch.is_done(record, out_dir, "Memo (指定格式)", fingerprint)
+    assert not batch.is_done(record, out_dir, "談參", batch.input_fingerprint(item["files"], "改用英文", "談參"))
+    source.write_text("第一次會議紀錄 (修訂)", encoding="utf-8")
+    assert not batch.is_done(record, out_dir, "談參", batch.input_fingerprint(item["files"], "", "談參"))
+
+
+def test_resume_reruns_items_when_output_options_change(tmp_path):
+    source = tmp_path / "a.txt"
+    source.write_text("品項：紙箱 20 個", encoding="utf-8")
+    template = tmp_path / "notice.docx"
+    template.write_bytes(b"template v1")
+    files = [str(source)]
+    task = "數據提取 (Excel)"
+    base = batch.input_fingerprint(files, "", task, str(template), "xlsx", True)
+    assert base == batch.input_fingerprint(files, "", task, str(template), "xlsx", True)
+    assert base != batch.input_fingerprint(files, "", task, str(template), "csv", True)
+    assert base != batch.input_fingerprint(files, "", task, str(template), "xlsx", False)
+    assert base != batch.input_fingerprint(files, "", task, None, "xlsx", True)
+    template.write_bytes(b"template v2")
+    assert base != batch.input_fingerprint(files, "", task, str(template), "xlsx", True)
+
+    out_dir = str(tmp_path / "out")
+    item = {"id": "a", "files": files}
+    first = batch.run_batch([item], task, "", "", out_dir, workers=1, rpm=0)["a"]
+    again = batch.run_batch([item], task, "", "", out_dir, workers=1, rpm=0, export_format="csv")["a"]
+    assert first["outputs"][1].endswith(".xlsx") and again["outputs"][1].endswith(".csv")
@@ -0,0 +1,105 @@
+import pytest
+
+import analysis
+
+MODEL = "gemini-2.5-flash"
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(analysis, "CONTEXT_CACHE_MIN_TOKENS", 1000)
+    analysis.get_context_cache_state.clear()
+    yield
+    analysis.get_context_cache_state.clear()
+
+
+def _context(backend, *token_counts):
+    groups = [{"parts": [f"第 {i} 份檔案"], "tokens": tokens} for i, tokens in enumerate(token_counts)]
+    parts = [p for g in groups for p in g["parts"]] + ["任務與指令"]
+    return analysis.plan_context_prefix(groups, "key", backend), parts
+
+
+def test_cache_is_created_once_then_reused():
+    backend = analysis.StubBackend()
+    context, parts = _context(backend, 3000)
+    first = analysis.resolve_context_cache(backend, MODEL, context, parts)
+    assert first["created"] and first["end"] == 1 and first["name"]
+
+    again = analysis.resolve_context_cache(backend, MODEL, context, parts)
+    assert not again["created"] and again["name"] == first["name"]
+    assert analysis.get_context_cache_state()["hits"] == 1
+
+
+def test_small_prefix_is_not_cached():
+    backend = analysis.StubBackend()
+    context, parts = _context(backend, 500)
+    assert analysis.resolve_context_cache(backend, MODEL, context, parts) is None
+
+
+def test_new_files_reuse_the_prefix_until_they_are_worth_their_own_cache():
+    backend = analysis.StubBackend()
+    context, parts = _context(backend, 3000)
+    base = analysis.resolve_context_cache(backend, MODEL, context, parts)
+
+    context, parts = _context(backend, 3000, 200)   # 新增的小檔案照常送出
+    reused = analysis.resolve_context_cache(backend, MODEL, context, parts)
+    assert (reused["name"], reused["end"], reused["created"]) == (base["name"], 1, False)
+
+    context, parts = _context(backend, 3000, 2000)  # 新增部分本身也達門檻，為完整前綴另建快取
+    grown = analysis.resolve_context_cache(backend, MODEL, context, parts)
+    assert grown["created"] and grown["end"] == 2 and grown["name"] != base["name"]
+
+
+def test_other_api_keys_do_not_share_caches():
+    backend = analysis.StubBackend()
+    context, parts = _context(backend, 3000)
+    analysis.resolve_context_cache(backend, MODEL, context, parts)
+    other = analysis.plan_context_prefix([{"parts": parts[:1], "tokens": 3000}], "another-key", backend)
+    assert analysis.resolve_context_cache(backend, MODEL, other, parts)["created"]
+
+
+def test_failed_create_pauses_caching_for_the_model(monkeypatch):
+    backend = analysis.StubBackend()
+    monkeypatch.setattr(backend, "create_context_cache", lambda *args: (_ for _ in ()).throw(RuntimeError("不支援")))
+    context, parts = _context(backend, 3000)
+    failed = analysis.resolve_context_cache(backend, MODEL, context, parts)
+    assert failed["name"] is None and "不支援" in failed["error"]
+    assert analysis.resolve_context_cache(backend, MODEL, context, parts) is None
+
+
+def test_gemini_backend_builds_the_model_from_the_cached_content(monkeypatch):
+    import google.generativeai as genai
+    from google.generativeai import caching
+
+    class FakeCache:
+        name = "cachedContents/abc"
+        model = f"models/{MODEL}"
+        expire_time = None
+        usage_metadata = type("Usage", (), {"total_token_count": 3000})()
+
+    class FakeResponse:
+        text = "{}"
+        usage_metadata = type("Usage", (), {"prompt_token_count": 1, "candidates_token_count": 1, "total_token_count": 2, "cached_content_token_count": 1})()
+
+    built = []
+
+    class FakeModel:
+        @classmethod
+        def from_cached_content(cls, cached_content, generation_config=None):
+            built.append(cached_content)
+            return cls()
+
+        def generate_content(self, parts, stream=False, request_options=None):
+            return FakeResponse()
+
+    monkeypatch.setattr(caching.CachedContent, "create", classmethod(lambda cls, **kwargs: FakeCache()))
+    monkeypatch.setattr(genai, "GenerativeModel", FakeModel)
+    backend = analysis.GeminiBackend()
+    created = backend.create_context_cache(MODEL, ["第 0 份檔案"], 900)
+
+    reply = backend.generate(MODEL, ["任務"], {}, cached_content=created["name"])
+    assert "".join(reply.chunks) == "{}"
+    assert isinstance(built[0], FakeCache)   # 沿用建立時取得的物件，不再以名稱查詢
+    backend.generate(MODEL, ["任務"], {}, cached_content="cachedContents/after-restart")
+    assert built[1] == "cachedContents/after-restart"
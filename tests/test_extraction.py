@@ -0,0 +1,30 @@
+from io import BytesIO
+
+import docx
+
+import analysis
+from batch import QuietStatus
+
+
+def _extraction_meta(upload):
+    result = analysis.analyze_content_with_gemini([upload], "Memo (指定格式)", "", status_container=QuietStatus(), preprocess=False)
+    return analysis.get_meta_info(result)["extraction"]
+
+
+def test_txt_savings_count_both_sides_as_text():
+    text = "\n".join(f"第 {i} 項：預算審查   \n\n\n\n" for i in range(2_000))
+    notes = analysis.MemoryFile("notes.txt", "text/plain", text.encode("utf-8"))
+    extraction = _extraction_meta(notes)
+    assert extraction["files"] == 1
+    assert 0 <= extraction["tokens_saved"] < analysis.estimate_text_tokens(text)
+
+
+def test_docx_reports_no_token_savings():
+    document = docx.Document()
+    for i in range(200):
+        document.add_paragraph(f"第 {i} 項：會議決議事項")
+    out = BytesIO()
+    document.save(out)
+    upload = analysis.MemoryFile("minutes.docx", analysis.LOCAL_MIME_TYPES[".docx"], out.getvalue())
+    extraction = _extraction_meta(upload)
+    assert extraction["files"] == 1 and extraction["tokens_saved"] is None
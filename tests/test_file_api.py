@@ -0,0 +1,65 @@
+import hashlib
+import time
+
+import pytest
+
+import analysis
+from fakes import FakeFileApi
+
+PAYLOAD = b"\x00\x01fake-audio" * 1000
+DIGEST = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+@pytest.fixture
+def file_api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)   # 代號登錄檔為相對路徑
+    with FakeFileApi() as api:
+        monkeypatch.setattr(analysis, "FILE_API_UPLOAD_URL", api.url)
+        yield api
+
+
+def test_upload_once_then_reuse_handle(file_api):
+    first, reused = analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+    assert not reused
+    assert first == {"file_data": {"mime_type": "audio/mp4", "file_uri": f"{file_api.url}/files/fake-0000"}}
+    assert file_api.uploads[0]["bytes"] == len(PAYLOAD)
+    assert "key=key-a" in file_api.uploads[0]["path"]
+
+    # 備援模型、重試與之後的工作階段都沿用同一代號，不再上傳
+    for _ in range(3):
+        part, reused = analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+        assert reused and part == first
+    assert len(file_api.uploads) == 1
+
+
+def test_handles_are_scoped_per_api_key(file_api):
+    analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+    _, reused = analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-b")
+    assert not reused
+    assert len(file_api.uploads) == 2
+
+
+def test_expired_handle_is_uploaded_again(file_api, monkeypatch):
+    first, _ = analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+    # 距到期不足 FILE_HANDLE_SAFETY_SECONDS 即視為失效
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 48 * 3600 - analysis.FILE_HANDLE_SAFETY_SECONDS + 60)
+    second, reused = analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+    assert not reused
+    assert second != first
+    assert len(file_api.uploads) == 2
+
+
+def test_short_lived_handle_is_not_reused(file_api):
+    file_api.expires_in = analysis.FILE_HANDLE_SAFETY_SECONDS - 1
+    analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+    _, reused = analysis.get_file_part(PAYLOAD, DIGEST, "audio/mp4", "meeting.m4a", "key-a")
+    assert not reused
+    assert len(file_api.uploads) == 2
+
+
+def test_memoryview_payload_is_uploaded_without_copy(file_api):
+    # 大型檔案以 mmap 對應時傳入的是 memoryview
+    _, reused = analysis.get_file_part(memoryview(PAYLOAD), DIGEST, "audio/wav", "meeting.wav", "key-a")
+    assert not reused
+    assert file_api.uploads[0]["bytes"] == len(PAYLOAD)
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+import analysis
+import job_queue
+import model_router
+import usage_ledger
+
+TASK = "會議紀錄"
+
+
+@pytest.fixture(autouse=True)
+def fresh_jobs(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_router, "_sync_limiter_from_ledger", lambda limiter, now: None)
+    monkeypatch.setattr(analysis, "STUB_LATENCY_SECONDS", 0.3)
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+    job_queue.get_job_manager.clear()
+    usage_ledger.SESSION_CONTEXT.session_id = "session-a"
+    yield
+    usage_ledger.SESSION_CONTEXT.session_id = None
+    job_queue.get_job_manager.clear()
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+
+
+def _notes(text="會議紀錄草稿"):
+    return analysis.MemoryFile("notes.txt", "text/plain", text.encode("utf-8"))
+
+
+def _wait(job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = job_queue.get_analysis_job(job_id)
+        if job["status"] in ("done", "error"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"工作 {job_id} 逾時未完成")
+
+
+def test_job_runs_in_background_and_keeps_the_result():
+    job_id = job_queue.submit_analysis_job([_notes()], TASK, "key")
+    job = _wait(job_id)
+    assert job["status"] == "done" and job["session_id"] == "session-a"
+    assert analysis.get_meta_info(job["result"])["model"] in model_router.MODEL_PRIORITY_LIST
+    assert job["log"] and job["files"] == ["notes.txt"]
+
+
+def test_duplicate_submit_in_the_same_session_reuses_the_running_job():
+    first = job_queue.submit_analysis_job([_notes()], TASK, "key")
+    assert job_queue.submit_analysis_job([_notes()], TASK, "key") == first
+    _wait(first)
+    # 已完成的工作不再合併，重新送出即重新分析
+    assert job_queue.submit_analysis_job([_notes()], TASK, "key") != first
+
+
+def test_other_sessions_and_keys_get_their_own_jobs():
+    first = job_queue.submit_analysis_job([_notes()], TASK, "key")
+    other_key = job_queue.submit_analysis_job([_notes()], TASK, "another-key")
+    usage_ledger.SESSION_CONTEXT.session_id = "session-b"
+    other_session = job_queue.submit_analysis_job([_notes()], TASK, "key")
+    assert len({first, other_key, other_session}) == 3
+    assert job_queue.get_analysis_job(other_session)["session_id"] == "session-b"
+    for job_id in (first, other_key, other_session):
+        assert _wait(job_id)["status"] == "done"
+
+
+def test_queue_position_counts_earlier_queued_jobs(monkeypatch):
+    monkeypatch.setattr(job_queue, "ANALYSIS_WORKERS", 1)
+    job_queue.get_job_manager.clear()
+    running = job_queue.submit_analysis_job([_notes("第 0 份")], TASK, "key")
+    while job_queue.get_analysis_job(running)["status"] == "queued":
+        time.sleep(0.01)
+    job_ids = [running] + [job_queue.submit_analysis_job([_notes(f"第 {i} 份")], TASK, "key") for i in (1, 2)]
+    assert [job_queue.get_job_queue_position(job_id) for job_id in job_ids] == [0, 0, 1]
+    assert _wait(job_ids[-1])["status"] == "done"
+    assert job_queue.get_job_queue_position(job_ids[-1]) == 0
+
+
+def test_failed_analysis_is_reported_on_the_job(monkeypatch):
+    monkeypatch.setattr(analysis, "STUB_FAILING_MODELS", list(model_router.MODEL_PRIORITY_LIST))
+    job = _wait(job_queue.submit_analysis_job([_notes()], TASK, "key"))
+    assert job["status"] == "error" and job["error"]
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import analysis
+import model_router
+from fakes import ScriptedBackend
+
+TASK = "談參"
+PRIMARY = model_router.MODEL_PRIORITY_LIST[0]
+TRUNCATED = '{"title": "標題", "background": ["背景一"], "discussion_points": [{"subtitle": "重點一", "content": "內'
+
+
+@pytest.fixture(autouse=True)
+def fresh_router(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_router, "_sync_limiter_from_ledger", lambda limiter, now: None)
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+    yield
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+
+
+def test_repair_strips_fences_trailing_text_and_commas():
+    assert analysis.repair_json_text('```json\n{"a": 1}\n```') == ({"a": 1}, False)
+    assert analysis.repair_json_text('以下為結果：{"a": [1, 2]} 以上。') == ({"a": [1, 2]}, False)
+    assert analysis.repair_json_text('{"a": [1, 2,], "b": 3,}') == ({"a": [1, 2], "b": 3}, False)
+    assert analysis.repair_json_text("無法產生結果") == (None, False)
+
+
+def test_truncated_text_is_reported_with_what_was_complete():
+    partial, truncated = analysis.repair_json_text(TRUNCATED)
+    assert truncated
+    assert partial["title"] == "標題" and partial["background"] == ["背景一"]
+
+
+def test_continuation_asks_only_for_missing_and_cut_fields():
+    partial, _ = analysis.repair_json_text(TRUNCATED)
+    prompt, schema, merge = analysis._continuation_request(TASK, partial)
+    missing = ["unit_opinion", "filename_prefix", "discussion_points"]
+    assert list(schema["properties"]) == missing
+    assert "背景一" in prompt and all(key in prompt for key in missing)
+
+    merged = merge({"discussion_points": [{"subtitle": "重點一", "content": "內容"}], "unit_opinion": "同意", "title": "改寫"})
+    assert merged["title"] == "標題"   # 已完成的欄位不被續寫覆蓋
+    assert merged["discussion_points"][0]["content"] == "內容" and merged["unit_opinion"] == "同意"
+
+
+def test_list_continuation_resumes_after_the_last_complete_row():
+    prompt, _, merge = analysis._continuation_request("數據提取 (Excel)", [{"a": 1}, {"a": 2}, {"a": 3}])
+    assert "2 筆" in prompt and '{"a": 2}' in prompt
+    assert merge([{"a": 3}, {"a": 4}]) == [{"a": 1}, {"a": 2}, {"a": 3}, {"a": 4}]
+    assert analysis._continuation_request("數據提取 (Excel)", [{"a": 1}]) is None
+    assert analysis._continuation_request(TASK, {}) is None
+
+
+def test_truncated_reply_is_completed_by_the_same_model(monkeypatch):
+    continuation = {"unit_opinion": "同意", "filename_prefix": "談參", "discussion_points": [{"subtitle": "重點一", "content": "內容"}]}
+    backend = ScriptedBackend([TRUNCATED, json.dumps(continuation, ensure_ascii=False)])
+    monkeypatch.setattr(analysis, "get_llm_backend", lambda: backend)
+    model_router.acquire_model([PRIMARY], 100)
+
+    result = analysis._call_model(PRIMARY, ["會議紀錄"], {"response_schema": analysis.get_response_schema(TASK)}, TASK, "test")
+
+    assert result["title"] == "標題" and result["discussion_points"] == continuation["discussion_points"]
+    assert analysis.get_meta_info(result)["json_repair"]["continuations"] == 1
+    second = backend.requests[1]
+    assert second["parts"][:-1] == ["會議紀錄"] and "請只輸出缺少的欄位" in second["parts"][-1]
+    assert list(second["config"]["response_schema"]["properties"]) == list(continuation)
+
+
+def test_unusable_reply_is_counted_as_failed(monkeypatch):
+    backend = ScriptedBackend(["無法產生結果"])
+    monkeypatch.setattr(analysis, "get_llm_backend", lambda: backend)
+    failed = analysis.get_json_repair_stats()["failed"]
+    model_router.acquire_model([PRIMARY], 100)
+    with pytest.raises(ValueError):
+        analysis._call_model(PRIMARY, ["會議紀錄"], {}, TASK, "test")
+    assert analysis.get_json_repair_stats()["failed"] == failed + 1
@@ -0,0 +1,49 @@
+import copy
+
+import analysis
+import model_router
+from batch import QuietStatus
+
+
+def _text_group(text):
+    return {"name": "long.txt", "mime_type": "text/plain", "bytes": text.encode("utf-8"), "text": text,
+            "tokens": analysis.estimate_text_tokens(text), "parts": [text]}
+
+
+def test_single_long_line_is_split_within_budget():
+    budget = 10_000
+    group = _text_group("會" * 400_000 + "x" * 100_000)   # 無換行
+    chunks = analysis.plan_chunks([group], budget, None)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert sum(tokens for _, _, tokens in chunk) <= budget
+    joined = "".join(parts[1] for chunk in chunks for _, parts, _ in chunk)
+    assert joined == group["text"]
+
+
+def test_line_breaks_are_kept_between_short_lines():
+    text = "\n".join(f"第 {i} 項：" + "討論" * 30 for i in range(2_000))
+    chunks = analysis.plan_chunks([_text_group(text)], 5_000, None)
+    assert len(chunks) > 1
+    assert "\n".join(parts[1] for chunk in chunks for _, parts, _ in chunk) == text
+
+
+def test_unsplittable_content_over_model_limit_is_rejected(monkeypatch):
+    monkeypatch.setattr(analysis, "MAP_REDUCE_THRESHOLD_TOKENS", 500)
+    monkeypatch.setattr(analysis, "MAP_CHUNK_TOKEN_BUDGET", 300)
+    monkeypatch.setattr(analysis, "MODEL_CONTEXT_TOKENS", 1_000)
+    # 壓縮音訊無法切分：1 MB 約 2,000 tokens
+    recording = analysis.MemoryFile("meeting.mp3", "audio/mpeg", b"\xff\xfb" * (512 * 1024))
+    result = analysis.analyze_content_with_gemini([recording], "談參", "", status_container=QuietStatus(), preprocess=False)
+    assert "超過模型輸入上限" in result["error"]
+
+
+def test_list_results_carry_meta_info():
+    notes = analysis.MemoryFile("notes.txt", "text/plain", "品項與數量".encode("utf-8"))
+    result = analysis.analyze_content_with_gemini([notes], "數據提取 (Excel)", "", status_container=QuietStatus())
+    assert isinstance(result, list)
+    meta = analysis.get_meta_info(result)
+    assert meta["model"] in model_router.MODEL_PRIORITY_LIST and meta["memory"] is not None
+    copied = copy.copy(result)
+    assert analysis.pop_meta_info(copied)["model"] == meta["model"]
+    assert analysis.get_meta_info(copied) is None and analysis.get_meta_info(result) is meta
@@ -0,0 +1,72 @@
+import wave
+from io import BytesIO
+
+import pytest
+
+import analysis
+
+np = pytest.importorskip("numpy")
+
+
+def test_multi_output_uses_the_highest_fidelity_profile():
+    extraction = analysis.PREPROCESS_PROFILES["數據提取 (Excel)"]
+    combined = analysis.get_preprocess_profile(analysis.multi_output_task(["Memo (指定格式)", "數據提取 (Excel)"]))
+    assert combined == extraction
+    memo_only = analysis.get_preprocess_profile(analysis.multi_output_task(["Memo (指定格式)", "談參"]))
+    assert memo_only == analysis.PREPROCESS_PROFILES["default"]
+
+
+def _wav(seconds, rate=44100, channels=2, silence=()):
+    # 440 Hz 正弦波；silence 為 (開始秒, 結束秒) 的靜音區段
+    t = np.arange(int(seconds * rate)) / rate
+    tone = 0.5 * np.sin(2 * np.pi * 440 * t)
+    for start, end in silence:
+        tone[int(start * rate):int(end * rate)] = 0
+    out = BytesIO()
+    with wave.open(out, "wb") as dst:
+        dst.setnchannels(channels)
+        dst.setsampwidth(2)
+        dst.setframerate(rate)
+        dst.writeframes((np.repeat(tone[:, None], channels, axis=1) * 32767).astype("<i2").tobytes())
+    return out.getvalue()
+
+
+def _read(data):
+    with wave.open(BytesIO(data)) as src:
+        params = (src.getnchannels(), src.getframerate())
+        return params, np.frombuffer(src.readframes(src.getnframes()), dtype="<i2")
+
+
+KEEP_SILENCE = dict(analysis.PREPROCESS_PROFILES["default"], trim_silence=False)
+
+
+def test_wav_is_downmixed_and_resampled_without_changing_length_or_pitch():
+    data, mime_type, note = analysis._preprocess_wav(_wav(3), KEEP_SILENCE)
+    (channels, rate), samples = _read(data)
+    assert mime_type == "audio/wav" and (channels, rate) == (1, 16000)
+    assert abs(len(samples) - 3 * 16000) <= 1
+    crossings = np.count_nonzero(np.diff(np.signbit(samples)))
+    assert abs(crossings / 2 / 3 - 440) < 5
+    assert "2ch 44.1 kHz → 1ch 16 kHz" in note
+
+
+def test_block_boundaries_do_not_change_the_output(monkeypatch):
+    source = _wav(3)
+    whole, _, _ = analysis._preprocess_wav(source, KEEP_SILENCE)
+    monkeypatch.setattr(analysis, "WAV_BLOCK_SECONDS", 0.37)
+    blocked, _, _ = analysis._preprocess_wav(source, KEEP_SILENCE)
+    _, a = _read(whole)
+    _, b = _read(blocked)
+    assert len(a) == len(b) and np.abs(a.astype(np.int32) - b).max() <= 1
+
+
+def test_long_silence_is_trimmed_to_a_short_pause():
+    data, _, note = analysis._preprocess_wav(_wav(14, silence=[(2, 12)]), analysis.PREPROCESS_PROFILES["default"])
+    _, samples = _read(data)
+    seconds = len(samples) / 16000
+    assert 4 <= seconds <= 4 + analysis.SILENCE_KEEP_SECONDS + 0.1
+    assert "裁掉靜音" in note
+
+
+def test_wav_already_in_target_format_is_left_alone():
+    assert analysis._preprocess_wav(_wav(1, rate=16000, channels=1), KEEP_SILENCE) is None
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import analysis
+import model_router
+from batch import QuietStatus
+
+TASK = "Memo (指定格式)"
+PRIMARY, SECONDARY, LITE = model_router.MODEL_PRIORITY_LIST
+
+
+@pytest.fixture(autouse=True)
+def fresh_router(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_router, "_sync_limiter_from_ledger", lambda limiter, now: None)
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+    yield
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+
+
+def _daily_used():
+    return {m: model_router.MODEL_QUOTAS[m]["rpd"] - s["daily_left"] for m, s in model_router.get_rate_limit_snapshot().items()}
+
+
+def test_failed_call_does_not_use_daily_quota(monkeypatch):
+    monkeypatch.setattr(analysis, "STUB_FAILING_MODELS", [PRIMARY])
+    _, model_name = analysis._call_with_fallback(["會議紀錄"], {}, TASK, "test")
+    assert model_name == SECONDARY
+    assert _daily_used() == {PRIMARY: 0, SECONDARY: 1, LITE: 0}
+
+
+def test_all_failures_refund_daily_quota(monkeypatch):
+    monkeypatch.setattr(analysis, "STUB_FAILING_MODELS", list(model_router.MODEL_PRIORITY_LIST))
+    result, error = analysis._dispatch_models(["會議紀錄"], {}, TASK, QuietStatus())
+    assert result is None and error
+    assert set(_daily_used().values()) == {0}
+
+
+def test_hedge_loser_already_sent_keeps_its_charge(monkeypatch):
+    # 非串流的落後呼叫已送出，伺服器端仍會完成並計費，不可退還
+    monkeypatch.setattr(analysis, "STUB_LATENCY_SECONDS", 0.8)
+    result, model_name = analysis._dispatch_models(["會議紀錄"], {}, TASK, QuietStatus(), hedge_delay=0.5)
+    assert result is not None and model_name == PRIMARY
+    assert _daily_used() == {PRIMARY: 1, SECONDARY: 1, LITE: 0}
+
+
+def test_call_cancelled_before_sending_is_refunded():
+    assert model_router.acquire_model([PRIMARY], 100) == PRIMARY
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(analysis.CallCancelled):
+        analysis._call_model(PRIMARY, ["會議紀錄"], {}, TASK, "test", cancel_event=cancel_event)
+    assert _daily_used()[PRIMARY] == 0
+
+
+def _open_circuit(model_name, cooled_down):
+    for _ in range(model_router.CIRCUIT_FAILURE_THRESHOLD):
+        model_router.record_model_failure(model_name)
+    if cooled_down:
+        model_router.get_circuit_breakers()["models"][model_name]["opened_at"] -= model_router.CIRCUIT_COOLDOWN_SECONDS + 1
+
+
+def test_half_open_circuit_allows_a_single_probe():
+    _open_circuit(PRIMARY, cooled_down=False)
+    assert model_router.is_circuit_open(PRIMARY)
+    with pytest.raises(model_router.CircuitOpenError):
+        model_router.begin_model_call(PRIMARY)
+
+    _open_circuit(PRIMARY, cooled_down=True)
+    assert not model_router.is_circuit_open(PRIMARY)
+    assert model_router.begin_model_call(PRIMARY) is True       # 第一個呼叫者成為試探呼叫
+    assert model_router.is_circuit_open(PRIMARY)
+    with pytest.raises(model_router.CircuitOpenError):
+        model_router.begin_model_call(PRIMARY)                  # 試探在途時其餘呼叫不放行
+
+    model_router.record_model_failure(PRIMARY)                  # 試探失敗：重新冷卻
+    assert model_router.is_circuit_open(PRIMARY)
+    model_router.get_circuit_breakers()["models"][PRIMARY]["opened_at"] -= model_router.CIRCUIT_COOLDOWN_SECONDS + 1
+    assert model_router.begin_model_call(PRIMARY) is True
+    model_router.record_model_success(PRIMARY)                  # 試探成功：恢復正常
+    assert model_router.begin_model_call(PRIMARY) is False and not model_router.is_circuit_open(PRIMARY)
+
+
+def test_cancelled_probe_gives_up_its_slot():
+    _open_circuit(PRIMARY, cooled_down=True)
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(analysis.CallCancelled):
+        analysis._call_model(PRIMARY, ["會議紀錄"], {}, TASK, "test", cancel_event=cancel_event)
+    assert not model_router.is_circuit_open(PRIMARY)
@@ -0,0 +1,110 @@
+import pytest
+
+import exporters
+from fakes import FakeSheetsClient
+
+MEMO = {
+    "meeting_name": "預算審查會議",
+    "conclusions": ["通過第一案", "第二案延後"],
+    "discussion_points": [{"subtitle": "經費", "content": "增列 10%"}],
+    "attendees": [],
+    "filename_prefix": "Memo",
+}
+ROWS = [{"項目": "伺服器", "數量": 3}, {"項目": "授權", "數量": 10}]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(exporters, "SHEETS_BACKOFF_SECONDS", 0)
+
+
+def test_create_writes_rows_and_formatting_in_one_batch():
+    client = FakeSheetsClient()
+    url, message = exporters.create_google_sheet(MEMO, "Memo (指定格式)", {}, user_email="a@example.com", client=client)
+    assert message.startswith("✅")
+    sh = client.spreadsheets[url]
+    assert len(sh.batch_calls) == 1
+    assert sh.sheet1.rows[0] == ["meeting_name", "預算審查會議"]
+    assert ["", "經費", "增列 10%"] in sh.sheet1.rows
+    assert sh.shared == [("a@example.com", "user", "writer")]
+
+
+def test_all_empty_lists_still_create_a_sheet():
+    client = FakeSheetsClient()
+    url, message = exporters.create_google_sheet({"conclusions": [], "action_items": []}, "Memo (指定格式)", {}, client=client)
+    assert message.startswith("✅"), message
+    assert client.spreadsheets[url].sheet1.rows == []
+
+
+def test_append_to_existing_worksheet_and_new_worksheet():
+    client = FakeSheetsClient()
+    url, _ = exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, client=client)
+    sh = client.spreadsheets[url]
+
+    _, message = exporters.create_google_sheet(ROWS[:1], "數據提取 (Excel)", {}, target_url=url, client=client)
+    assert message.startswith("✅ 已附加 1 列")
+    assert sh.sheet1.rows == [["項目", "數量"], ["伺服器", 3], ["授權", 10], ["伺服器", 3]]   # 既有工作表不重複標題
+
+    _, message = exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, target_url=url, target_worksheet="第二批", client=client)
+    assert message.startswith("✅")
+    added = [ws for ws in sh.sheets if ws.title == "第二批"][0]
+    assert added.id == 1 and added.rows[0] == ["項目", "數量"]   # 新工作表附上標題
+    assert all(len(body["requests"]) > 1 for body in sh.batch_calls)   # 資料與格式同一次送出
+
+
+def test_appended_rows_follow_the_existing_header():
+    client = FakeSheetsClient()
+    url, _ = exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, client=client)
+    sh = client.spreadsheets[url]
+
+    exporters.create_google_sheet([{"單位": "台", "數量": 5, "項目": "螢幕"}], "數據提取 (Excel)", {}, target_url=url, client=client)
+    assert sh.sheet1.rows[0] == ["項目", "數量", "單位"]   # 多出的欄位補在標題最後
+    assert sh.sheet1.rows[-1] == ["螢幕", 5, "台"]
+    assert sh.sheet1.rows[1] == ["伺服器", 3]
+
+
+def test_empty_existing_worksheet_gets_a_header():
+    client = FakeSheetsClient()
+    url, _ = exporters.create_google_sheet({"conclusions": []}, "Memo (指定格式)", {}, client=client)
+    exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, target_url=url, client=client)
+    assert client.spreadsheets[url].sheet1.rows == [["項目", "數量"], ["伺服器", 3], ["授權", 10]]
+
+
+def test_non_dict_rows_are_written_to_the_first_column():
+    client = FakeSheetsClient()
+    url, message = exporters.create_google_sheet(ROWS + ["另有備品若干"], "數據提取 (Excel)", {}, client=client)
+    assert message.startswith("✅"), message
+    assert client.spreadsheets[url].sheet1.rows[-1] == ["另有備品若干", ""]
+
+
+def test_sheet1_lookup_is_retried():
+    client = FakeSheetsClient(fail_with=[None, 503])   # 建立成功，讀取 sheet1 時暫時失敗
+    url, message = exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, client=client)
+    assert message.startswith("✅"), message
+
+
+def test_quota_errors_are_retried():
+    client = FakeSheetsClient(fail_with=[429, 503])
+    url, message = exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, client=client)
+    assert message.startswith("✅") and url in client.spreadsheets
+
+
+def test_non_retryable_error_is_reported():
+    client = FakeSheetsClient(fail_with=[403])
+    url, message = exporters.create_google_sheet(ROWS, "數據提取 (Excel)", {}, client=client)
+    assert url is None and "403" in message
+
+
+def test_clients_are_pooled_per_credential(monkeypatch):
+    import gspread
+    from google.oauth2 import service_account
+    authorized = []
+    monkeypatch.setattr(service_account.Credentials, "from_service_account_info", classmethod(lambda cls, info, scopes=None: info["client_email"]))
+    monkeypatch.setattr(gspread, "authorize", lambda creds: authorized.append(creds) or FakeSheetsClient())
+    exporters.get_sheets_client_pool()["clients"].clear()
+
+    first = {"client_email": "bot@example.iam.gserviceaccount.com", "private_key_id": "k1"}
+    assert exporters.get_sheets_client(first) is exporters.get_sheets_client(dict(first))
+    other = exporters.get_sheets_client({"client_email": "bot@example.iam.gserviceaccount.com", "private_key_id": "k2"})
+    assert other is not exporters.get_sheets_client(first)
+    assert len(authorized) == 2
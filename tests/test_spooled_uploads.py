@@ -0,0 +1,65 @@
+import pytest
+
+import analysis
+import model_router
+from batch import QuietStatus
+from fakes import FakeUploadedFile
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def small_budget(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(analysis, "UPLOAD_SPOOL_THRESHOLD_BYTES", 1 * MB)
+    monkeypatch.setattr(analysis, "REQUEST_MEMORY_BUDGET_BYTES", 3 * MB)
+    monkeypatch.setattr(model_router, "_sync_limiter_from_ledger", lambda limiter, now: None)
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+    yield
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+
+
+def _upload(name, size, fill="會"):
+    data = (fill * size).encode("utf-8")[:size]
+    return FakeUploadedFile(name, "text/plain", data)
+
+
+def test_large_upload_is_spooled_and_small_one_stays_in_memory():
+    small, large = _upload("small.txt", 100 * 1024), _upload("large.txt", 2 * MB)
+    files = analysis.spool_uploads([small, large])
+    assert isinstance(files[0], analysis.MemoryFile)
+    assert isinstance(files[1], analysis.SpooledFile)
+    assert isinstance(files[1].getvalue(), memoryview) and files[1].size == 2 * MB
+    assert bytes(files[1].getvalue()) == large.getvalue()
+
+
+def test_uploads_beyond_the_memory_budget_are_spooled():
+    uploads = [_upload(f"part_{i}.txt", MB - 1) for i in range(5)]
+    files = analysis.spool_uploads(uploads)
+    assert [type(f).__name__ for f in files] == ["MemoryFile"] * 3 + ["SpooledFile"] * 2
+
+
+def test_spooled_copy_outlives_the_upload_and_hashes_the_same():
+    upload = _upload("large.txt", 2 * MB)
+    expected = analysis.compute_file_digests([upload])
+    spooled = analysis.spool_uploads([upload])
+    upload.close()   # rerun 後原上傳檔即失效
+    assert analysis.compute_file_digests(spooled) == expected
+
+
+def test_files_without_seek_are_kept_in_memory():
+    kept = analysis.MemoryFile("kept.txt", "text/plain", b"x" * (2 * MB))
+    assert analysis.spool_uploads([kept])[0].getvalue() is kept.data
+
+
+def test_spooled_upload_is_analysed_like_an_in_memory_one(monkeypatch):
+    monkeypatch.setattr(analysis, "UPLOAD_SPOOL_THRESHOLD_BYTES", 64 * 1024)
+    text = "第一項討論事項。\n" * 5_000
+    upload = FakeUploadedFile("notes.txt", "text/plain", text.encode("utf-8"))
+    assert upload.size > analysis.UPLOAD_SPOOL_THRESHOLD_BYTES
+    spooled = analysis.spool_uploads([upload])
+    assert isinstance(spooled[0], analysis.SpooledFile)
+    result = analysis.analyze_content_with_gemini(spooled, "談參", "", status_container=QuietStatus(), preprocess=False)
+    assert "error" not in result and result["discussion_points"]
@@ -0,0 +1,46 @@
+import pytest
+
+import analysis
+import model_router
+from batch import QuietStatus
+
+TASK = "談參"
+
+
+class PreviewStatus(QuietStatus):
+    def __init__(self):
+        self.previews = []
+
+    def empty(self):
+        return self
+
+    def markdown(self, text):
+        self.previews.append(text)
+
+
+@pytest.fixture(autouse=True)
+def fresh_router(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_router, "_sync_limiter_from_ledger", lambda limiter, now: None)
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+    yield
+    model_router.get_rate_limiter.clear()
+    model_router.get_circuit_breakers.clear()
+
+
+def test_stream_preview_parses_once_per_poll_not_per_chunk(monkeypatch):
+    parsed = []
+    parse = analysis.parse_partial_json
+    monkeypatch.setattr(analysis, "parse_partial_json", lambda text: parsed.append(len(text)) or parse(text))
+    monkeypatch.setattr(analysis, "STUB_STREAM_CHUNKS", 200)
+    monkeypatch.setattr(analysis, "STUB_LATENCY_SECONDS", 0.8)
+    status = PreviewStatus()
+
+    result, _ = analysis._dispatch_models(["會議紀錄"], {}, TASK, status, stream=True)
+
+    assert result["discussion_points"]
+    assert status.previews, "串流期間應至少呈現一次部分結果"
+    polls = 0.8 / analysis.STREAM_POLL_SECONDS
+    assert len(parsed) <= polls + 2
+    assert parsed == sorted(parsed)
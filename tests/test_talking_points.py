@@ -0,0 +1,34 @@
+import docx
+import pytest
+
+import exporters
+
+DATA = {
+    "title": "預算協調會談參",
+    "background": ["年度預算尚未定案"],
+    "discussion_points": [{"subtitle": "經費", "content": "追加三百萬"}, "人力配置另案討論", {"content": "時程"}],
+    "unit_opinion": "原則同意",
+}
+
+
+def _paragraphs(bio):
+    return [p.text for p in docx.Document(bio).paragraphs]
+
+
+@pytest.mark.parametrize("engine", [exporters.create_talking_points_docx_ooxml, exporters.create_talking_points_docx_python_docx])
+def test_bare_string_discussion_points(engine):
+    bio, file_name = engine(DATA)
+    paragraphs = _paragraphs(bio)
+    assert file_name == "TalkingPoints.docx"
+    assert "【經費】：追加三百萬" in paragraphs
+    assert "人力配置另案討論" in paragraphs
+    assert "：時程" in paragraphs
+
+
+def test_ooxml_failure_falls_back_to_python_docx(monkeypatch):
+    def broken(data):
+        raise TypeError("unexpected item")
+    monkeypatch.setattr(exporters, "TALKING_POINTS_ENGINE", "ooxml")
+    monkeypatch.setattr(exporters, "create_talking_points_docx_ooxml", broken)
+    bio, _ = exporters.create_talking_points_docx(DATA)
+    assert "【經費】：追加三百萬" in _paragraphs(bio)
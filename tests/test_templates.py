@@ -0,0 +1,67 @@
+import os
+from io import BytesIO
+
+import docx
+import pytest
+
+import analysis
+import exporters
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    exporters.get_template_registry.clear()
+    yield
+    exporters.get_template_registry.clear()
+
+
+def _template_bytes(greeting):
+    document = docx.Document()
+    document.add_paragraph(greeting + "，{{ name }}")
+    out = BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def _text(bio):
+    return "\n".join(p.text for p in docx.Document(bio).paragraphs)
+
+
+def test_path_template_is_parsed_once_until_the_file_changes(tmp_path):
+    path = tmp_path / "notice.docx"
+    path.write_bytes(_template_bytes("您好"))
+    entry = exporters.get_compiled_template(str(path))
+    assert exporters.get_compiled_template(str(path)) is entry
+
+    path.write_bytes(_template_bytes("敬啟者"))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    updated = exporters.get_compiled_template(str(path))
+    assert updated is not entry and updated["sha"] != entry["sha"]
+    assert _text(exporters.render_compiled_template(updated, {"name": "王科長"})) == "敬啟者，王科長"
+
+
+def test_uploaded_templates_are_keyed_by_content():
+    raw = _template_bytes("您好")
+    first = exporters.get_compiled_template(analysis.MemoryFile("a.docx", "application/octet-stream", raw))
+    second = exporters.get_compiled_template(analysis.MemoryFile("b.docx", "application/octet-stream", raw))
+    assert second is first
+
+
+def test_renders_do_not_share_state():
+    entry = exporters.get_compiled_template(analysis.MemoryFile("a.docx", "application/octet-stream", _template_bytes("您好")))
+    assert _text(exporters.render_compiled_template(entry, {"name": "甲"})) == "您好，甲"
+    assert _text(exporters.render_compiled_template(entry, {"name": "乙"})) == "您好，乙"
+    assert entry["renders"] == 2
+
+
+def test_registry_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(exporters, "TEMPLATE_REGISTRY_MAX_ENTRIES", 2)
+    uploads = [analysis.MemoryFile(f"{i}.docx", "application/octet-stream", _template_bytes(f"第 {i} 版")) for i in range(3)]
+    first = exporters.get_compiled_template(uploads[0])
+    exporters.get_compiled_template(uploads[1])
+    exporters.get_compiled_template(uploads[0])          # 重新使用，移到最新
+    exporters.get_compiled_template(uploads[2])          # 淘汰最久未用的 uploads[1]
+    shas = {entry["sha"] for entry in exporters.get_template_registry()["entries"].values()}
+    assert len(shas) == 2 and first["sha"] in shas
+    assert exporters.get_compiled_template(uploads[0]) is first
@@ -0,0 +1,60 @@
+import json
+import threading
+
+import pytest
+
+import model_router
+import usage_ledger
+
+
+@pytest.fixture
+def ledger(monkeypatch, tmp_path):
+    monkeypatch.setattr(usage_ledger, "USAGE_DB_FILE", str(tmp_path / "usage_ledger.db"))
+    monkeypatch.setattr(usage_ledger, "USAGE_LOG_FILE", str(tmp_path / "usage_log.json"))
+    usage_ledger.get_usage_db_local.clear()
+    yield tmp_path
+    usage_ledger.get_usage_db_local.clear()
+
+
+def test_legacy_json_is_imported_once(ledger):
+    legacy = {"date": "2026-10-16", "stats": {"gemini-2.5-flash": {"count": 7, "total_tokens": 1200}}}
+    (ledger / "usage_log.json").write_text(json.dumps(legacy), encoding="utf-8")
+    stats = usage_ledger.load_usage_data("2026-10-16")["stats"]["gemini-2.5-flash"]
+    assert (stats["count"], stats["input_tokens"], stats["output_tokens"]) == (7, 1200, 0)
+    assert (ledger / "usage_log.json.migrated").exists() and not (ledger / "usage_log.json").exists()
+
+    # 舊檔再次出現 (例如從備份還原) 也不重複匯入
+    (ledger / "usage_log.json").write_text(json.dumps(legacy), encoding="utf-8")
+    usage_ledger.get_usage_db_local.clear()
+    assert usage_ledger.load_usage_data("2026-10-16")["stats"]["gemini-2.5-flash"]["count"] == 7
+
+
+def test_calls_roll_up_into_daily_totals(ledger):
+    usage_ledger.update_usage_count("gemini-2.5-flash", 100, 20, 400.0, "談參", "s1")
+    usage_ledger.update_usage_count("gemini-2.5-flash", 50, 10, 200.0, "談參", "s2")
+    usage_ledger.update_usage_count("gemini-2.5-flash-lite", 10, 5)
+    stats = usage_ledger.load_usage_data()["stats"]
+    flash = stats["gemini-2.5-flash"]
+    assert (flash["count"], flash["input_tokens"], flash["output_tokens"], flash["total_tokens"]) == (2, 150, 30, 180)
+    assert flash["avg_latency_ms"] == 300.0
+    assert stats["gemini-2.5-flash-lite"]["count"] == 1
+    rows = usage_ledger.get_usage_db().execute("SELECT session_id FROM usage_calls WHERE model = 'gemini-2.5-flash' ORDER BY id").fetchall()
+    assert rows == [("s1",), ("s2",)]
+
+
+def test_concurrent_writers_do_not_lose_counts(ledger):
+    def writer():
+        for _ in range(25):
+            usage_ledger.update_usage_count("gemini-2.5-flash", 1, 1)
+    threads = [threading.Thread(target=writer) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert usage_ledger.load_usage_data()["stats"]["gemini-2.5-flash"]["count"] == 100
+
+
+def test_recent_usage_query_uses_ts_index(ledger):
+    conn = usage_ledger.get_usage_db()
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {model_router.RECENT_USAGE_QUERY}", (0.0,)).fetchall()
+    assert any("idx_usage_calls_ts" in row[-1] for row in plan)
@@ -0,0 +1,139 @@
+import functools
+import json
+import os
+import time
+import threading
+
+import streamlit as st
+
+# ==========================================
+# 1-1. ⏱️ 階段計時 (Trace spans)
+# ==========================================
+# 分析與文件產生的各階段以 trace_span 包住，每個 span 以 OTLP/JSON 格式 (一行一個 ResourceSpans)
+# 附加寫入 TRACE_FILE，可直接交給 OpenTelemetry Collector 的 otlpjson 檔案接收器；
+# 同時保留各階段最近的耗時樣本，供側邊欄效能面板計算 p50 / p95
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_FILE_MAX_BYTES = 20 * 1024 * 1024   # 超過即輪替為 .1
+TRACE_SAMPLE_WINDOW = 500                 # 每個階段保留的最近樣本數
+TRACE_SERVICE_NAME = "document-creator"
+
+@st.cache_resource
+def get_trace_state():
+    return {"lock": threading.Lock(), "samples": {}, "local": threading.local()}
+
+def _trace_stack():
+    local = get_trace_state()["local"]
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _export_span(span):
+    record = {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "app"}, "spans": [span]}],
+    }]}
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    state = get_trace_state()
+    with state["lock"]:
+        try:
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+                os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            pass   # 追蹤檔寫入失敗不影響主流程
+
+def _record_stage_sample(stage, duration_ms):
+    state = get_trace_state()
+    with state["lock"]:
+        samples = state["samples"].setdefault(stage, [])
+        samples.append(duration_ms)
+        if len(samples) > TRACE_SAMPLE_WINDOW:
+            del samples[:len(samples) - TRACE_SAMPLE_WINDOW]
+
+class trace_span:
+    # with trace_span("model.call", model=name) as span: ... span.set(output_tokens=...)
+    # 有 model (或 task) 屬性的階段另以「階段 · 模型」分開統計
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = _trace_stack()
+        parent = stack[-1] if stack else None
+        self.trace_id = parent[0] if parent else os.urandom(16).hex()
+        self.parent_id = parent[1] if parent else ""
+        self.span_id = os.urandom(8).hex()
+        stack.append((self.trace_id, self.span_id))
+        self.start_ns = time.time_ns()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        stack = _trace_stack()
+        if stack and stack[-1][1] == self.span_id:
+            stack.pop()
+        status = {"code": 1}
+        if exc_type is not None:
+            status = {"code": 2, "message": str(exc)[:200]}
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.start_ns + int(duration_ms * 1e6)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items() if v is not None],
+            "status": status,
+        }
+        _export_span(span)
+        if exc_type is None:
+            _record_stage_sample(self.name, duration_ms)
+            label = self.attributes.get("model") or self.attributes.get("task")
+            if label:
+                _record_stage_sample(f"{self.name} · {label}", duration_ms)
+        return False
+
+def bind_trace_context(fn):
+    # 工作執行緒沒有呼叫端的 span 堆疊；提交前以此包裝，讓子 span 掛在目前的 span 之下
+    stack = _trace_stack()
+    parent = stack[-1] if stack else None
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        local_stack = _trace_stack()
+        depth = len(local_stack)
+        if parent:
+            local_stack.append(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            del local_stack[depth:]
+    return wrapper
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+def get_stage_stats():
+    state = get_trace_state()
+    with state["lock"]:
+        snapshot = {stage: list(samples) for stage, samples in state["samples"].items() if samples}
+    return [
+        {"stage": stage, "count": len(samples), "p50_ms": _percentile(samples, 50), "p95_ms": _percentile(samples, 95)}
+        for stage, samples in sorted(snapshot.items())
+    ]
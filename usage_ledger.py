@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import streamlit as st
+
+# ==========================================
+# 1. 📊 本地用量記帳系統
+# ==========================================
+USAGE_LOG_FILE = "usage_log.json"    # 舊版 JSON 記帳檔，首次開啟帳本時自動匯入
+USAGE_DB_FILE = "usage_ledger.db"    # SQLite (WAL) 帳本：每次呼叫一筆，並維護每日 x 模型彙總
+
+USAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL,
+    task TEXT,
+    session_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_usage_calls_day_model ON usage_calls (day, model);
+CREATE INDEX IF NOT EXISTS idx_usage_calls_ts ON usage_calls (ts);
+CREATE TABLE IF NOT EXISTS usage_daily (
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    latency_ms_total REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, model)
+);
+CREATE TABLE IF NOT EXISTS ledger_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+@st.cache_resource
+def get_usage_db_local():
+    # sqlite3 連線不可跨執行緒共用，每個執行緒各自持有一條連線
+    return threading.local()
+
+def get_usage_db():
+    local = get_usage_db_local()
+    conn = getattr(local, "conn", None)
+    if conn is not None and getattr(local, "pid", None) == os.getpid():
+        return conn
+    conn = sqlite3.connect(USAGE_DB_FILE, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(USAGE_SCHEMA)
+    migrate_usage_json(conn)
+    local.conn = conn
+    local.pid = os.getpid()
+    return conn
+
+def migrate_usage_json(conn):
+    if not os.path.exists(USAGE_LOG_FILE):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM ledger_meta WHERE key = 'json_migrated'").fetchone():
+            conn.execute("COMMIT")
+            return
+        try:
+            with open(USAGE_LOG_FILE, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except (OSError, ValueError):
+            legacy = {}
+        day = legacy.get("date", datetime.now().strftime("%Y-%m-%d"))
+        for model_name, stat in legacy.get("stats", {}).items():
+            # 舊格式只記錄總 token 數，全數計入輸入 token
+            conn.execute(
+                """INSERT INTO usage_daily (day, model, count, input_tokens) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (day, model) DO UPDATE SET
+                       count = count + excluded.count,
+                       input_tokens = input_tokens + excluded.input_tokens""",
+                (day, model_name, stat.get("count", 0), stat.get("total_tokens", 0))
+            )
+        conn.execute("INSERT INTO ledger_meta (key, value) VALUES ('json_migrated', ?)", (datetime.now().isoformat(),))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    try:
+        os.replace(USAGE_LOG_FILE, f"{USAGE_LOG_FILE}.migrated")
+    except OSError:
+        pass
+
+def load_usage_data(day=None):
+    today_str = day or datetime.now().strftime("%Y-%m-%d")
+    data = {"date": today_str, "stats": {}}
+    try:
+        rows = get_usage_db().execute(
+            "SELECT model, count, input_tokens, output_tokens, latency_ms_total FROM usage_daily WHERE day = ?",
+            (today_str,)
+        ).fetchall()
+    except sqlite3.Error:
+        return data
+    for model_name, count, input_t, output_t, latency_total in rows:
+        data["stats"][model_name] = {
+            "count": count,
+            "total_tokens": input_t + output_t,
+            "input_tokens": input_t,
+            "output_tokens": output_t,
+            "avg_latency_ms": latency_total / count if count else 0.0,
+        }
+    return data
+
+def update_usage_count(model_name, input_tokens, output_tokens, latency_ms=None, task=None, session_id=None):
+    now = datetime.now()
+    day = now.strftime("%Y-%m-%d")
+    conn = get_usage_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """INSERT INTO usage_calls (ts, day, model, input_tokens, output_tokens, latency_ms, task, session_id)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (now.timestamp(), day, model_name, input_tokens, output_tokens, latency_ms, task, session_id)
+        )
+        conn.execute(
+            """INSERT INTO usage_daily (day, model, count, input_tokens, output_tokens, latency_ms_total)
+               VALUES (?, ?, 1, ?, ?, ?)
+               ON CONFLICT (day, model) DO UPDATE SET
+                   count = count + 1,
+                   input_tokens = input_tokens + excluded.input_tokens,
+                   output_tokens = output_tokens + excluded.output_tokens,
+                   latency_ms_total = latency_ms_total + excluded.latency_ms_total""",
+            (day, model_name, input_tokens, output_tokens, latency_ms or 0.0)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+# 背景工作執行緒沒有 Streamlit context，由工作執行緒記下提交工作時的 session
+SESSION_CONTEXT = threading.local()
+
+def current_session_id():
+    override = getattr(SESSION_CONTEXT, "session_id", None)
+    if override:
+        return override
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return ctx.session_id if ctx else None
+    except Exception:
+        return None